@@ -7,24 +7,170 @@
 import pygame
 from pygame.locals import *
 import helm_fonts
-from helm_controls import WheelControl, ChordControl
+from helm_controls import build_controls, control_factories, \
+    default_controls, max_controls, register_control
 import helm_globals
 import helm_midi
+import helm_layout
+from helm_events import EventBuffer, EventRouter, chord_event, rotate_event, \
+    latch_event, recall_event, chord_sources, PowermateReader
+from helm_presets import presets_from_config
+from helm_render import RenderThread, FrameScheduler, render_frame, \
+    snapshot_controls
+from helm_render_process import RenderProcess
+from helm_capture import FrameCapture
+from helm_ipc import StatePublisher
+from helm_async import AsyncRuntime
+from helm_pacing import FramePacer, PowerMeter, wake
+import helm_realtime
+import helm_metrics
 import configparser
+import os
+import time
+
+
+# Keyboard keys which trigger chords, and their helm_events source
+chord_keys = {pygame.K_a: 'a',
+              pygame.K_s: 's',
+              pygame.K_d: 'd',
+              pygame.K_z: 'z',
+              pygame.K_x: 'x',
+              pygame.K_c: 'c'}
+
+# Function keys recalling the presets, in config order
+preset_keys = {pygame.K_F1: 0, pygame.K_F2: 1, pygame.K_F3: 2,
+               pygame.K_F4: 3, pygame.K_F5: 4, pygame.K_F6: 5,
+               pygame.K_F7: 6, pygame.K_F8: 7, pygame.K_F9: 8,
+               pygame.K_F10: 9, pygame.K_F11: 10, pygame.K_F12: 11}
+
+# Touch and mouse events, see Helm.pointer()
+touch_down_types = (pygame.FINGERDOWN, pygame.MOUSEBUTTONDOWN)
+touch_move_types = (pygame.FINGERMOTION, pygame.MOUSEMOTION)
+touch_up_types = (pygame.FINGERUP, pygame.MOUSEBUTTONUP)
 
 
 class Helm:
-    def __init__(self, canvas_width=1920, canvas_height=1080, init_gfx=True,
+    def __init__(self, canvas_width=None, canvas_height=None, init_gfx=True,
                  configfile="helm.cfg"):
 
         self.fullscreen = False
 
+        # Canvas resolution, when not given by the caller.  Every control's
+        # geometry is worked out from this by helm_layout.
+        config_width = 1920
+        config_height = 1080
+        layout_cache = None
+
+        # Metrics served over HTTP on localhost:metrics_port, or on the
+        # metrics_socket Unix socket if set.  See helm_metrics.
+        self.metrics = False
+        self.metrics_port = 9464
+        self.metrics_socket = None
+
+        # Headless frame capture, see helm_capture
+        capture = False
+        capture_path = None
+        capture_fps = 5
+        capture_format = 'raw'
+
+        # Publish the key, mode, chord and notes to shared memory for other
+        # local processes, see helm_ipc
+        share_state = False
+        share_state_path = None
+
+        # The controls to build, in drawing order, by their
+        # helm_controls.control_factories names.  Controls left out are
+        # never built or imported.
+        self.control_names = default_controls
+
+        # Draw frames on their own thread, leaving the main loop to input
+        # and MIDI only
+        self.render_thread = False
+
+        # Or draw them in a separate process, leaving this one with input
+        # and MIDI only.  See helm_render_process.
+        self.render_process = False
+
+        # Run on an asyncio event loop, waking only for input, instead of
+        # polling every source each frame.  See helm_async.
+        self.async_runtime = False
+
+        # Frame pacing: max_fps while anything's moving (0 for the
+        # display's refresh rate) and idle_fps once it's all been still for
+        # a moment (0 to sleep until the next event).  vsync asks for
+        # tear free presentation, where the display allows.  See
+        # helm_pacing.
+        self.max_fps = 0
+        self.idle_fps = 15
+        self.vsync = False
+
+        # Performance mode for live sets: garbage collection only in idle
+        # loops, realtime priority, pinned CPUs and locked memory where the
+        # OS allows.  See helm_realtime.
+        self.performance = False
+        self.realtime_priority = 10
+        self.midi_cpus = None
+
         # By default this expects helm.cfg in the same directory as this script
         # In the format (with whichever appropriate values you like):
         #
         # [helm]
         # powermate = False
         # midi = False
+        # width = 1920
+        # height = 1080
+        # layout_cache = helm_layout.json
+        # metrics = False
+        # metrics_port = 9464
+        # metrics_socket = /tmp/helm_metrics.sock
+        # capture = False
+        # capture_path = /dev/shm/helm_frames
+        # capture_fps = 5
+        # capture_format = raw
+        # share_state = False
+        # share_state_path = /dev/shm/helm_state
+        # fullscreen = False
+        # midi_clock = False
+        # controls = wheel, chord
+        # midi_backend = mido
+        # midi_device = /dev/snd/midiC1D0
+        # midi_debug = False
+        # midi_quantize = 0
+        # tempo = 120
+        # midi_latency = 0.0
+        # render_thread = False
+        # render_process = False
+        # async_runtime = False
+        # max_fps = 0
+        # idle_fps = 15
+        # vsync = False
+        # performance = False
+        # realtime_priority = 10
+        # midi_cpus = 2
+        # release_time = 0.0
+        # voicing = octave
+        # midi_controls = False
+        # midi_input_callback = False
+        # midi_pads = 36, 37, 38, 39, 40, 41
+        # midi_encoder_cc = 16
+        # arpeggiator = False
+        # arp_division = 16
+        # arp_pattern = up
+        # arp_gate = 0.5
+        #
+        # [chords]
+        # a = 1
+        #
+        # [controls]
+        # meter = helm_meter:meter_control
+        #
+        # [preset verse]
+        # key = F#
+        # mode = Dorian
+        # octave = 3
+        # latched = 1, 3, 5
+        #
+        # with any number of presets, see helm_presets
 
         config = configparser.ConfigParser()
 
@@ -41,6 +187,154 @@ class Helm:
                 helm_globals.using_midi_clock = \
                     config['helm'].getboolean('midi_clock')
 
+                helm_globals.midi_backend = \
+                    config['helm'].get('midi_backend', fallback="mido")
+                helm_globals.midi_device = \
+                    config['helm'].get('midi_device', fallback=None)
+
+                helm_globals.midi_debug = \
+                    config['helm'].getboolean('midi_debug', fallback=False)
+
+                helm_globals.midi_quantize = \
+                    config['helm'].getint('midi_quantize', fallback=0)
+                helm_globals.tempo = \
+                    config['helm'].getfloat('tempo', fallback=120)
+                helm_globals.midi_latency = \
+                    config['helm'].getfloat('midi_latency', fallback=0.0)
+
+                self.render_thread = \
+                    config['helm'].getboolean('render_thread',
+                                              fallback=False)
+
+                self.render_process = \
+                    config['helm'].getboolean('render_process',
+                                              fallback=False)
+
+                self.async_runtime = \
+                    config['helm'].getboolean('async_runtime',
+                                              fallback=False)
+
+                self.max_fps = config['helm'].getint('max_fps', fallback=0)
+                self.idle_fps = config['helm'].getint('idle_fps',
+                                                      fallback=15)
+                self.vsync = config['helm'].getboolean('vsync',
+                                                       fallback=False)
+
+                self.performance = \
+                    config['helm'].getboolean('performance', fallback=False)
+                self.realtime_priority = \
+                    config['helm'].getint('realtime_priority', fallback=10)
+                self.midi_cpus = helm_realtime.parse_cpus(
+                    config['helm'].get('midi_cpus', fallback=""))
+
+                config_width = config['helm'].getint('width', fallback=1920)
+                config_height = config['helm'].getint('height',
+                                                      fallback=1080)
+                layout_cache = config['helm'].get('layout_cache',
+                                                  fallback=None)
+
+                self.metrics = config['helm'].getboolean('metrics',
+                                                         fallback=False)
+                self.metrics_port = config['helm'].getint('metrics_port',
+                                                          fallback=9464)
+                self.metrics_socket = config['helm'].get('metrics_socket',
+                                                         fallback=None)
+
+                capture = config['helm'].getboolean('capture',
+                                                    fallback=False)
+                capture_path = config['helm'].get('capture_path',
+                                                  fallback=None)
+                capture_fps = config['helm'].getfloat('capture_fps',
+                                                      fallback=5)
+                capture_format = config['helm'].get('capture_format',
+                                                    fallback='raw')
+
+                share_state = config['helm'].getboolean('share_state',
+                                                        fallback=False)
+                share_state_path = config['helm'].get('share_state_path',
+                                                      fallback=None)
+
+                helm_globals.release_time = \
+                    config['helm'].getfloat('release_time', fallback=0.0)
+
+                voicing = config['helm'].get('voicing', fallback="octave")
+                if voicing in helm_globals.voicings:
+                    helm_globals.voicing = voicing
+                else:
+                    print("Unknown voicing {}, using {}".format(
+                        voicing, helm_globals.voicing))
+
+                helm_globals.using_midi_controls = \
+                    config['helm'].getboolean('midi_controls',
+                                              fallback=False)
+
+                helm_globals.midi_input_callback = \
+                    config['helm'].getboolean('midi_input_callback',
+                                              fallback=False)
+
+                if 'midi_pads' in config['helm']:
+                    helm_globals.midi_pads = tuple(
+                        int(pad) for pad in
+                        config['helm']['midi_pads'].split(','))
+
+                helm_globals.midi_encoder_cc = \
+                    config['helm'].getint('midi_encoder_cc',
+                                          fallback=helm_globals.
+                                          midi_encoder_cc)
+
+                helm_globals.using_arpeggiator = \
+                    config['helm'].getboolean('arpeggiator', fallback=False)
+
+                arp_division = config['helm'].getint('arp_division',
+                                                     fallback=16)
+                if arp_division > 0:
+                    helm_globals.arp_division = arp_division
+                else:
+                    print("Arpeggiator division must be at least 1, "
+                          "using {}".format(helm_globals.arp_division))
+
+                helm_globals.arp_pattern = \
+                    config['helm'].get('arp_pattern', fallback="up")
+
+                helm_globals.arp_gate = \
+                    config['helm'].getfloat('arp_gate', fallback=0.5)
+
+                # Optional [chords] section, choosing which of the
+                # helm_globals.chord_types each chord key plays, e.g.
+                # d = 1, 3, 5, 7
+                if config.has_section('chords'):
+                    for source in config['chords']:
+                        if config['chords'][source] in \
+                                helm_globals.chord_types:
+                            chord_sources[source] = config['chords'][source]
+
+                # Optional [controls] section, adding controls from other
+                # modules, as "module:function" making the control for a
+                # helm_layout.Layout.  controls then turns them on.
+                if config.has_section('controls'):
+                    for name in config['controls']:
+                        register_control(name, config['controls'][name])
+                if config['helm'].get('controls'):
+                    names = [name.strip() for name in
+                             config['helm']['controls'].split(',')
+                             if name.strip()]
+                    unknown = [name for name in names
+                               if name not in control_factories]
+                    if unknown:
+                        print("Unknown controls:", ", ".join(unknown))
+                    names = tuple(name for name in names
+                                  if name in control_factories)
+                    if len(names) > max_controls:
+                        print("Too many controls, at most {}.  Using the "
+                              "defaults".format(max_controls))
+                    else:
+                        self.control_names = names
+
+                try:
+                    helm_globals.presets = presets_from_config(config)
+                except ValueError as error:
+                    print("Preset error:", error)
+
             except configparser.Error:
                 print("Config file error.  Maintaining defaults")
         else:
@@ -63,25 +357,38 @@ class Helm:
             powermate_path += "event-if00"
             self.powermate = Powermate(powermate_path)
 
+        # Work out every chord in every key, mode and voicing up front
+        helm_globals.theory = helm_globals.TheoryTables()
+
         helm_globals.midi = helm_midi.Midi()
 
         # Graphics attributes
         # Clock, for tracking events and frame rate
         self.clock = pygame.time.Clock()
 
-        self.canvas_width = canvas_width
-        self.canvas_height = canvas_height
+        self.canvas_width = canvas_width or config_width
+        self.canvas_height = canvas_height or config_height
+
+        # Positions, sizes, radii and fonts for this resolution
+        self.layout_cache = layout_cache
+        self.layout = helm_layout.layout_for(self.canvas_width,
+                                             self.canvas_height,
+                                             cache_file=layout_cache)
 
         self.r = int(
-            (canvas_height * .8) / 2)  # R is half of __% of the screen
+            (self.canvas_height * .8) / 2)  # R is half of __% of the screen
 
         self.running = False  # will be True once self.run() is called
 
+        if not init_gfx:
+            # No display to open, but run() still needs SDL's event queue
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
         # Initialize the canvas
         pygame.init()
 
         # Initialize the fonts
-        helm_fonts.init_fonts()
+        helm_fonts.init_fonts(self.layout.font_sizes)
 
         if init_gfx:
             # If this is being run headless, turn initGfx to False
@@ -91,219 +398,371 @@ class Helm:
                     [self.canvas_width, self.canvas_height], pygame.NOFRAME)
                 pygame.display.toggle_fullscreen()
                 # Workaround for pygame.FULLSCREEN going blank in Ubuntu
+            elif self.vsync:
+                try:
+                    # vsync needs one of SDL's renderers, which SCALED
+                    # gives it
+                    self.canvas = pygame.display.set_mode(
+                        [self.canvas_width, self.canvas_height],
+                        pygame.SCALED, vsync=1)
+                except pygame.error:
+                    print("No vsync on this display")
+                    self.canvas = pygame.display.set_mode(
+                        [self.canvas_width, self.canvas_height])
             else:
                 self.canvas = pygame.display.set_mode(
                     [self.canvas_width, self.canvas_height])
             pygame.display.set_caption('helm')  # Set the window title for fun
+        else:
+            # Headless: draw to an offscreen canvas, which can be captured
+            self.canvas = pygame.Surface([self.canvas_width,
+                                          self.canvas_height])
+
+        # Capture rendered frames to shared memory for monitoring, at most
+        # capture_fps times a second
+        self.capture = None
+        if capture:
+            self.capture = FrameCapture(self.canvas_width,
+                                        self.canvas_height,
+                                        path=capture_path,
+                                        fps=capture_fps,
+                                        frame_format=capture_format)
+
+        # Every state change is published here for other processes
+        self.state_publisher = None
+        if share_state:
+            self.state_publisher = StatePublisher(share_state_path)
 
         # controlSurfaces list contains each controlSystem object that is
-        # rendered.
-        # Declare controlSystem objects, set them up and init them,
-        # then append() them
-        # to this list.  Then each in turn will get a drawControl() call and
-        # their
-        # surface attribute will be blit to the canvas.
-        self.controlSurfaces = []
-
-        # ffWheel (fourth/fifth wheel) handles keystrokes related to key,
-        #   mode root, and note selection around a circle of fifths.
-
-        # The size of the ffWheel's surface will be __% of the screen
-        control_ff_wheel_size = int(self.canvas_height * 0.98)
-        # Create a ffWheel control.  Init.
-        control_ff_wheel = WheelControl(canvas_size=control_ff_wheel_size)
-
-        # control_chord handles keystrokes related to which chord notes
-        #   to trigger, such a major triad/etc.  It takes a wheelControl
-        #   argument to link up with the ffWheel and pass chord info
-
-        # Append the ffWheel to the controlSurfaces list
-        self.controlSurfaces.append(control_ff_wheel)
-
-        # The size of the control_chord surface will be __% of the screen
-        control_chord_size = int(self.canvas_width * 0.40)
-        # Create a chord control.  Init.
-        control_chord = ChordControl(canvas_size=control_chord_size,
-                                     blit_x=int(self.canvas_width / 2) + 130 +
-                                     helm_globals.canvas_margin,
-                                     blit_y=helm_globals.canvas_margin + 30)
-
-        # Append the chord control to the controlSurfaces list
-        self.controlSurfaces.append(control_chord)
-
-    def run(self):
-        self.running = True
+        # rendered.  Each in turn will get a drawControl() call and
+        # their surface attribute will be blit to the canvas.
+        # See helm_controls.build_controls()
+        self.controlSurfaces = build_controls(self.layout,
+                                              self.control_names)
+
+        # Sorts each loop's events by the controls which handle them
+        self.router = EventRouter(self.controlSurfaces)
+
+        # The state as of the last update(), to diff against
+        self.last_state = helm_globals.key.state
+
+        # finger -> the control it came down on, see handle_event()
+        self.touches = {}
+
+        if self.performance:
+            # The clock port's callback thread sets itself up the first
+            # time it runs
+            helm_globals.midi.clock_thread_setup = \
+                helm_realtime.MidiThreadSetup(self.realtime_priority,
+                                              self.midi_cpus)
+
+    def handle_event(self, event, events):
+        # Turn one pygame event in to modifier changes and entries in
+        # events, the EventBuffer handed to every control's
+        # update_control()
+        if event.type == QUIT:  # If the window 'close' button...
+            self.running = False
+        if event.type == pygame.KEYDOWN:
+            # Hold 'e' to rotate the "key" ring
+            if event.key == pygame.K_e:
+                helm_globals.key.set_rotation_ring("key")
+
+            # Hold 'w' to rotate both rings in unison
+            if event.key == pygame.K_w:
+                helm_globals.key.set_rotation_ring("all")
+
+            # Hold 'q' to hang notes: preventing note offs
+            if event.key == pygame.K_q:
+                helm_globals.key.set_notes_latched(True)
+
+            # esc to quit
+            if event.key == pygame.K_ESCAPE:
+                self.running = False
+
+            if event.key == pygame.K_COMMA:
+                rotate_event(events, -1, 1)
+            if event.key == pygame.K_PERIOD:
+                rotate_event(events, 1, -1)
+
+            if event.key in preset_keys:
+                recall_event(events, preset_keys[event.key])
+
+            if not helm_globals.key.notes_latched:
+                if event.key in chord_keys:
+                    chord_event(events, chord_keys[event.key],
+                                start=True)
+
+        if event.type == pygame.KEYUP:
+            if event.key == pygame.K_e or \
+               event.key == pygame.K_w:
+                helm_globals.key.set_rotation_ring("mode")
+
+            if event.key == pygame.K_q:
+                helm_globals.key.set_notes_latched(False)
+
+            if not helm_globals.key.notes_latched:
+                if event.key in chord_keys:
+                    chord_event(events, chord_keys[event.key],
+                                start=False)
+            else:
+                # In this case the latch key is held, record the
+                # latched notes
+                latch_event(events)
+
+        if event.type in touch_down_types:
+            touch = self.pointer(event)
+            if touch:
+                finger, x, y = touch
+                for control in self.controlSurfaces:
+                    if control.contains(x, y):
+                        self.touches[finger] = control
+                        control.touch_down(finger, x - control.blit_x,
+                                           y - control.blit_y, events)
+                        break
+        elif event.type in touch_move_types:
+            touch = self.pointer(event)
+            if touch and touch[0] in self.touches:
+                finger, x, y = touch
+                control = self.touches[finger]
+                control.touch_move(finger, x - control.blit_x,
+                                   y - control.blit_y, events)
+        elif event.type in touch_up_types:
+            touch = self.pointer(event)
+            if touch and touch[0] in self.touches:
+                finger, x, y = touch
+                control = self.touches.pop(finger)
+                control.touch_up(finger, x - control.blit_x,
+                                 y - control.blit_y, events)
+
+    def pointer(self, event):
+        # (finger, x, y) on the canvas for a touch, or a mouse event with
+        # the left button, otherwise None
+        if event.type in (pygame.FINGERDOWN, pygame.FINGERMOTION,
+                          pygame.FINGERUP):
+            # Touch positions are fractions of the window
+            return ((event.touch_id, event.finger_id),
+                    int(event.x * self.canvas_width),
+                    int(event.y * self.canvas_height))
+        if getattr(event, 'touch', False):
+            # SDL's mouse copy of a touch, which is handled as a finger
+            return None
+        if event.type == pygame.MOUSEMOTION:
+            if not event.buttons[0]:
+                return None
+        elif event.button != 1:
+            return None
+        return 'mouse', event.pos[0], event.pos[1]
+
+    def update(self, events):
+        # Hand this loop's events to the controls, each only the kinds it
+        # handles, then let everything which depends on the state catch up
+        for controlSurface, inbox in zip(self.controlSurfaces,
+                                         self.router.route(events)):
+            controlSurface.update_control(
+                inbox)  # update control attributes with the events
+
+        # Diff against the state of the last loop, so controls only
+        # redraw when something they show has changed
+        state = helm_globals.key.state
+        if state is not self.last_state:
+            changed = state.diff(self.last_state)
+            for controlSurface in self.controlSurfaces:
+                controlSurface.state_changed(changed)
+            if self.state_publisher:
+                self.state_publisher.publish(state)
+            self.last_state = state
 
-        self.canvas.fill(helm_globals.color_black)
+        # ... and, forward along any MIDI messages received at the
+        # secondary MIDI interface, if found and enabled
+        if helm_globals.using_midi_clock:
+            helm_globals.midi.forward_messages()
+
+        # Turn off any notes whose timed release has come due
+        helm_globals.midi.update()
+
+    def draw_frame(self, scheduler, renderer=None):
+        # Drawing is expensive.
+        # Ask the scheduler which of the control surfaces needing a
+        # re-draw get one this frame, and return them
+        drawing = scheduler.plan()
+
+        if renderer:
+            # Show anything the renderer has finished since last time
+            renderer.present()
+
+        if drawing:
+            # Snapshot the controls' state and either hand it to the
+            # render thread, or draw it right here when running single
+            # threaded.
+            snapshots = snapshot_controls(self.controlSurfaces, drawing)
+            if renderer:
+                renderer.submit(snapshots)
+            else:
+                render_frame(self.canvas, self.controlSurfaces, snapshots,
+                             scheduler)
+                if self.capture:
+                    self.capture.capture(self.canvas)
+        elif self.capture and not renderer:
+            # Capture the last frame drawn, if it came too soon to be
+            self.capture.flush(self.canvas)
+        return drawing
+
+    def count_loop(self, events, loop_started):
+        helm_metrics.events_per_loop.set(len(events))
+        helm_metrics.events_total.inc(len(events))
+        helm_metrics.loop_seconds.observe(time.perf_counter() -
+                                          loop_started)
+
+    def busy(self, events, scheduler):
+        # Whether there's anything moving, to keep the frame rate up for,
+        # or a frame still to be captured
+        return bool(events) or bool(scheduler.deferred) or \
+            any(control.needs_rendering for control in self.controlSurfaces) \
+            or (self.capture is not None and self.capture.dirty)
+
+    def pacer(self):
+        # A FramePacer for this config.  The Powermate and MIDI controls on
+        # a callback wake an idle loop, see run_loop(), but polled MIDI
+        # controls can't, so they keep it at the frame rate.  The MIDI
+        # clock is forwarded on its own port's thread, whatever the pace.
+        return FramePacer(self.clock, max_fps=self.max_fps,
+                          idle_fps=self.idle_fps,
+                          polling=helm_globals.using_midi_controls and
+                          not helm_globals.midi.controls_queued,
+                          power=PowerMeter())
+
+    def run_loop(self, scheduler, renderer=None, collector=None,
+                 pacer=None):
+        # Input events, in order, emptied each loop.  See helm_events.
+        events = EventBuffer()
+        pacer = pacer or self.pacer()
+        # The event which woke the last idle wait
+        woken_by = None
+
+        # Input read on other threads wakes an idle wait as it comes in
+        helm_globals.midi.notify = wake
+        powermate = None
+        if helm_globals.using_griffin_powermate:
+            powermate = PowermateReader(self.powermate, wake)
+            powermate.start()
 
         # The main running loop
         while self.running:
 
-            # Drawing is expensive.
-            # Poll all of the control surfaces and see if
-            # Anyone needs a re-draw
-            needs_rendering = False
-            for control_surface in self.controlSurfaces:
-                if control_surface.needs_rendering:
-                    needs_rendering = True
-
-            if needs_rendering:
-                # First, draw the screen:
-                # Loop through each controlSystem added to the controlSurfaces
-                for controlSurface in self.controlSurfaces:
-                    # The drawControl method should update the control's visual
-                    # elements and
-                    # draw to the control's surface
-                    controlSurface.draw_control()
-                    # Blit the control's surface to the canvas
-                    self.canvas.blit(controlSurface.surface,
-                                     [controlSurface.blit_x,
-                                      controlSurface.blit_y])
-                pygame.display.update()
+            # First, draw the screen
+            drawing = self.draw_frame(scheduler, renderer)
 
             # Next, Update controls and everything in preparation for the
             # next loop through:
-            events = {}  # Record events seen during this execution here.
-            # Key is a label, usually pygame event
+            loop_started = time.perf_counter()
+            events.clear()  # Record events seen during this execution here.
+            # Each is an InputEvent, in the order it happened
             # The controlSurfaces themselves should know what to look for
             # and what to do.
+            if woken_by is not None:
+                self.handle_event(woken_by, events)
             for event in pygame.event.get():
-                if event.type == QUIT:  # If the window 'close' button...
-                    self.running = False
-                if event.type == pygame.KEYDOWN:
-                    # Hold 'e' to rotate the "key" ring
-                    if event.key == pygame.K_e:
-                        helm_globals.rotation_ring = "key"
-
-                    # Hold 'w' to rotate both rings in unison
-                    if event.key == pygame.K_w:
-                        helm_globals.rotation_ring = "all"
-
-                    # Hold 'q' to hang notes: preventing note offs
-                    if event.key == pygame.K_q:
-                        helm_globals.notes_latched = True
-
-                    # esc to quit
-                    if event.key == pygame.K_ESCAPE:
-                        self.running = False
-
-                    if event.key == pygame.K_COMMA:
-                        if helm_globals.rotation_ring in ("key", "all"):
-                            events[",_down_1"] = {'rotate': True,
-                                                  'wheel': 'key', 'dir': 'ccw'}
-                        if helm_globals.rotation_ring in ("mode", "all"):
-                            events[",_down_2"] = {'rotate': True,
-                                                  'wheel': 'chord',
-                                                  'dir': 'cw'}
-                    if event.key == pygame.K_PERIOD:
-                        if helm_globals.rotation_ring in ("key", "all"):
-                            events["._down_1"] = {'rotate': True,
-                                                  'wheel': 'key', 'dir': 'cw'}
-                        if helm_globals.rotation_ring in ("mode", "all"):
-                            events["._down_2"] = {'rotate': True,
-                                                  'wheel': 'chord',
-                                                  'dir': 'ccw'}
-
-                    if not helm_globals.notes_latched:
-                        if event.key == pygame.K_a:
-                            events["a_down"] = {'trigger_note': True,
-                                                'chord': '1', 'start': True}
-                        if event.key == pygame.K_s:
-                            events["s_down"] = {'trigger_note': True,
-                                                'chord': '1, 5', 'start': True}
-                        if event.key == pygame.K_d:
-                            if helm_globals.rotation_ring == "key":
-                                events["d_down"] = {'trigger_note': True,
-                                                    'chord': '7',
-                                                    'start': True}
-                            else:
-                                events["d_down"] = {'trigger_note': True,
-                                                    'chord': '1, 3, 5',
-                                                    'start': True}
-                        if event.key == pygame.K_z:
-                            events["z_down"] = {'trigger_note': True,
-                                                'chord': '2',
-                                                'start': True}
-                        if event.key == pygame.K_x:
-                            events["x_down"] = {'trigger_note': True,
-                                                'chord': '4', 'start': True}
-                        if event.key == pygame.K_c:
-                            events["c_down"] = {'trigger_note': True,
-                                                'chord': '6',
-                                                'start': True}
-
-                if event.type == pygame.KEYUP:
-                    if event.key == pygame.K_e or \
-                       event.key == pygame.K_w:
-                        helm_globals.rotation_ring = "mode"
-
-                    if event.key == pygame.K_q:
-                        helm_globals.notes_latched = False
-
-                    if not helm_globals.notes_latched:
-                        if event.key == pygame.K_a:
-                            events["a_up"] = {'trigger_note': True,
-                                              'chord': '1', 'stop': True}
-                        if event.key == pygame.K_s:
-                            events["s_up"] = {'trigger_note': True,
-                                              'chord': '1, 5', 'stop': True}
-                        if event.key == pygame.K_d:
-                            if helm_globals.rotation_ring == "key":
-                                events["d_up"] = {'trigger_note': True,
-                                                  'chord': '7',
-                                                  'stop': True}
-                            else:
-                                events["d_up"] = {'trigger_note': True,
-                                                  'chord': '1, 3, 5',
-                                                  'stop': True}
-                        if event.key == pygame.K_z:
-                            events["z_up"] = {'trigger_note': True,
-                                              'chord': '2',
-                                              'stop': True}
-                        if event.key == pygame.K_x:
-                            events["x_up"] = {'trigger_note': True,
-                                              'chord': '4', 'stop': True}
-                        if event.key == pygame.K_c:
-                            events["c_up"] = {'trigger_note': True,
-                                              'chord': '6',
-                                              'stop': True}
-                    else:
-                        # In this case the latch key is held, record the
-                        # latched notes
-                        helm_globals.midi.latch()
-
-            if helm_globals.using_griffin_powermate:
-                event = self.powermate.read_event(timeout=0)
-                if event:
-                    if event[2] == -1:
-                        if helm_globals.rotation_ring in ("key", "all"):
-                            events[",_down_1"] = {'rotate': True,
-                                                  'wheel': 'key', 'dir': 'ccw'}
-                        if helm_globals.rotation_ring in ("mode", "all"):
-                            events[",_down_2"] = {'rotate': True,
-                                                  'wheel': 'chord',
-                                                  'dir': 'ccw'}
-                    if event[2] == 1:
-                        if helm_globals.rotation_ring in ("key", "all"):
-                            events["._down_1"] = {'rotate': True,
-                                                  'wheel': 'key', 'dir': 'cw'}
-                        if helm_globals.rotation_ring in ("mode", "all"):
-                            events["._down_2"] = {'rotate': True,
-                                                  'wheel': 'chord',
-                                                  'dir': 'cw'}
+                self.handle_event(event, events)
 
-            for controlSurface in self.controlSurfaces:
-                controlSurface.update_control(
-                    events)  # update control attributes with a dict of events
+            if powermate:
+                powermate.drain(events)
+
+            # Pads and encoders on a MIDI controller
+            if helm_globals.using_midi_controls:
+                helm_globals.midi.poll_controls(events)
+
+            self.update(events)
 
-            # ... and, forward along any MIDI messages received at the
-            # secondary MIDI interface, if found and enabled
-            if helm_globals.using_midi_clock:
-                helm_globals.midi.forward_messages()
+            if collector:
+                # Collect garbage in loops which had nothing to do
+                collector.update(not drawing and not events)
 
-            self.clock.tick(60)  # 60 fps
+            self.count_loop(events, loop_started)
+
+            # Up to the display's refresh rate while anything's moving,
+            # otherwise wait for input at idle_fps
+            woken_by = pacer.pace(self.busy(events, scheduler),
+                                  helm_globals.midi.voices.next_release())
+
+        if powermate:
+            powermate.stop()
+
+    def run(self):
+        self.running = True
+
+        self.canvas.fill(helm_globals.color_black)
+
+        # Serve metrics to Prometheus or anything else that asks
+        metrics_server = None
+        if self.metrics:
+            metrics_server = helm_metrics.MetricsServer(
+                port=self.metrics_port, socket_path=self.metrics_socket)
+            metrics_server.start()
+
+        # Budgets each control's drawing, see FrameScheduler
+        scheduler = FrameScheduler(self.controlSurfaces)
+
+        renderer = None
+        if self.render_process:
+            renderer = RenderProcess(self.canvas, self.controlSurfaces,
+                                     layout_cache=self.layout_cache,
+                                     capture=self.capture,
+                                     scheduler=scheduler,
+                                     control_names=self.control_names)
+            renderer.start()
+        elif self.render_thread:
+            renderer = RenderThread(self.canvas, self.controlSurfaces,
+                                    capture=self.capture,
+                                    scheduler=scheduler)
+            renderer.start()
+
+        if self.state_publisher:
+            self.state_publisher.publish(self.last_state)
+
+        collector = None
+        if self.performance:
+            # After the other threads have started, so they keep normal
+            # priority.  This thread reads input and sends the MIDI.
+            print("Performance mode:",
+                  helm_realtime.realtime_priority(self.realtime_priority))
+            if helm_realtime.pin_cpus(self.midi_cpus):
+                print("MIDI on CPUs", sorted(self.midi_cpus))
+            if helm_realtime.lock_memory():
+                print("Memory locked")
+            helm_realtime.freeze_gc()
+            collector = helm_realtime.IdleCollector()
+
+        scheduler_thread = helm_globals.midi.scheduler
+        if scheduler_thread and scheduler_thread.ident is None:
+            # Started after performance mode's setup, so it gets the same
+            # priority and CPUs, unless a note has started it already
+            scheduler_thread.start()
+
+        pacer = self.pacer()
+        if self.async_runtime:
+            AsyncRuntime(self, scheduler, renderer=renderer,
+                         collector=collector, pacer=pacer).run()
+        else:
+            self.run_loop(scheduler, renderer, collector, pacer)
+        print(pacer.summary())
 
         # If we've reached this point, we've escaped the run: loop.  Quit.
+        if collector:
+            helm_realtime.thaw_gc()
+        if renderer:
+            renderer.stop()
+        if self.capture:
+            self.capture.close()
+        if self.state_publisher:
+            self.state_publisher.close()
+        if metrics_server:
+            metrics_server.stop()
+        # Don't leave anything hanging on the synth
+        helm_globals.midi.all_notes_off()
+        if helm_globals.midi.scheduler:
+            # Sends anything still waiting, the notes off above included
+            helm_globals.midi.scheduler.stop()
+            print(helm_globals.midi.scheduler.summary())
         if helm_globals.using_midi:
             helm_globals.midi.inport.close()
             helm_globals.midi.outport.close()
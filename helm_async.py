@@ -0,0 +1,175 @@
+import asyncio
+import time
+import pygame
+import helm_globals
+import helm_pacing
+from helm_events import EventBuffer, powermate_event
+from helm_render_process import RenderProcess
+
+# The asyncio runtime: an alternative to Helm.run()'s polling loop.
+#
+# Every input source is a producer on one event loop, and nothing runs
+# until one of them has something.  The Powermate's evdev device is
+# watched with add_reader(), and MIDI ports deliver on mido's callback
+# threads, which hand over to the loop with call_soon_threadsafe().  Each
+# producer adds its events to the shared EventBuffer and wakes
+# the frames() coroutine, which updates the controls and draws.
+#
+# SDL has no file descriptor to wait on.  Where the video driver can
+# sleep until there's an event, pygame.event.wait() blocks for it on an
+# executor thread, and the keyboard, touch and window events come back to
+# the loop as they happen, with nothing polling while idle.  The loop
+# only calls pygame.event.get() once the wait has returned, so SDL is
+# never pumped from two threads at once.  helm_pacing.wake() ends the
+# wait when it's time to stop.
+#
+# Other drivers' waits poll every millisecond inside SDL, so pygame's
+# queue is pumped here instead: once a frame, or every idle_poll seconds
+# headless, where the only events are those posted to the queue.
+#
+# While the wheel is animating, or a redraw is deferred, frames() keeps
+# going at the frame rate.  Once everything has settled it sleeps until
+# the next input, or the next timed note release.
+
+# SDL video drivers which sleep in pygame.event.wait()
+waiting_drivers = {'x11', 'wayland', 'windows', 'cocoa'}
+# SDL video drivers with no input devices of their own
+inputless_drivers = {'dummy', 'offscreen'}
+
+
+class AsyncRuntime(object):
+    def __init__(self, helm, scheduler, renderer=None, collector=None,
+                 frame_budget=1 / 60, pacer=None, idle_poll=0.25):
+        self.helm = helm
+        self.scheduler = scheduler  # helm_render.FrameScheduler
+        self.renderer = renderer  # helm_render.RenderThread, if threaded
+        self.collector = collector  # helm_realtime.IdleCollector
+        self.frame_budget = frame_budget
+        self.idle_poll = idle_poll  # Seconds between pumps, headless
+        self.pacer = pacer  # helm_pacing.FramePacer, to account for
+
+        # Input events since the last update, added to by every producer
+        self.events = EventBuffer()
+
+        # Made on the event loop, in main()
+        self.loop = None
+        self.wake = None
+
+        self.frames_run = 0
+        # The wait for pygame events, and how many times it's returned
+        self.pygame_wait = None
+        self.pygame_wakeups = 0
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+
+        powermate_fd = None
+        if helm_globals.using_griffin_powermate:
+            powermate_fd = self.helm.powermate.dev.fileno()
+            self.loop.add_reader(powermate_fd, self.powermate_ready)
+
+        helm_globals.midi.listen(self.notify)
+
+        # A render worker process says when a frame is ready to show
+        presenting = isinstance(self.renderer, RenderProcess)
+        if presenting:
+            self.loop.add_reader(self.renderer.fileno(),
+                                 self.renderer.present)
+
+        # The first frame draws everything
+        self.wake.set()
+        try:
+            await asyncio.gather(self.pygame_events(), self.frames())
+        finally:
+            if self.pygame_wait and not self.pygame_wait.done():
+                # Don't leave the executor blocked waiting
+                helm_pacing.wake()
+            if powermate_fd is not None:
+                self.loop.remove_reader(powermate_fd)
+            if presenting:
+                self.loop.remove_reader(self.renderer.fileno())
+
+    def notify(self):
+        # Wake frames() from any thread, e.g. mido's callbacks
+        self.loop.call_soon_threadsafe(self.wake.set)
+
+    def powermate_ready(self):
+        # The knob's device is readable.  Take everything it has.
+        while True:
+            event = self.helm.powermate.read_event(timeout=0)
+            if not event:
+                break
+            powermate_event(self.events, event)
+        self.wake.set()
+
+    async def pygame_events(self):
+        driver = pygame.display.get_driver()
+        while self.helm.running:
+            if driver in waiting_drivers:
+                self.pygame_wait = self.loop.run_in_executor(
+                    None, pygame.event.wait)
+                event = await self.pygame_wait
+                self.helm.handle_event(event, self.events)
+            elif driver in inputless_drivers:
+                await asyncio.sleep(self.idle_poll)
+            else:
+                await asyncio.sleep(self.frame_budget)
+            self.pygame_wakeups += 1
+            for event in pygame.event.get():
+                self.helm.handle_event(event, self.events)
+            if self.events:
+                self.wake.set()
+        # Let frames() see that it's time to stop
+        self.wake.set()
+
+    async def frames(self):
+        while self.helm.running:
+            await self.wake.wait()
+            self.wake.clear()
+            if not self.helm.running:
+                break
+
+            frame_started = time.perf_counter()
+            busy = self.frame()
+
+            if busy:
+                # Come round again at the frame rate
+                await asyncio.sleep(max(0.0, self.frame_budget -
+                                        (time.perf_counter() -
+                                         frame_started)))
+                self.wake.set()
+            else:
+                self.sleep_until_release()
+
+    def frame(self):
+        # Update with everything that's come in, then draw.  Returns True
+        # if there's more to do next frame.
+        events = self.events
+        loop_started = time.perf_counter()
+        if helm_globals.using_midi_controls:
+            helm_globals.midi.poll_controls(events)
+        self.helm.update(events)
+
+        drawing = self.helm.draw_frame(self.scheduler, self.renderer)
+        self.frames_run += 1
+
+        if self.collector:
+            self.collector.update(not drawing and not events)
+        self.helm.count_loop(events, loop_started)
+        busy = self.helm.busy(events, self.scheduler)
+        events.clear()
+
+        if self.pacer:
+            self.pacer.account(self.pacer.busy(busy))
+        return busy
+
+    def sleep_until_release(self):
+        # Nothing's moving, but a timed note release might be coming up
+        release_at = helm_globals.midi.voices.next_release()
+        if release_at is not None:
+            self.loop.call_later(max(0.0, release_at - time.monotonic()),
+                                 self.wake.set)
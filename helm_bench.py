@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import mido.ports
+import helm_globals
+from helm_midi import MidoOutput, RawMidiOutput, RtmidiOutput
+from helm_schedule import NoteScheduler
+
+# Benchmarks for helm's hot paths, printing the cost of one operation:
+#
+#   python helm_bench.py               Time everything
+#   python helm_bench.py --check       ... and fail on a regression
+#   python helm_bench.py --save        ... and store them as the baselines
+#
+# Each benchmark is timed several times over and the fastest run kept,
+# as timeit does, see per_call().  The theory and wheel benchmarks go
+# through all 12 keys in all 7 modes, with every chord_definitions entry
+# where there's a chord to work out.  Notes and MIDI go nowhere:
+#
+#   key_rotate_key, key_rotate_chord   Key transitions
+#   derive_scales                      diatonic and chord_scale, which
+#                                      HelmState works out when the key or
+#                                      mode changes
+#   calculate_chord                    One chord_definitions entry
+#   wheel_rotate_wheel,                One detent of the WheelControl's
+#   wheel_rotate_chord                 rings
+#   notes_trigger                      Midi.notes_trigger on or off, to a
+#                                      NullPort through mido
+#   midi_send_note                     One note message through
+#                                      Midi.send_note, end to end, to a
+#                                      NullPort through mido
+#   midi_output <backend>              One note message through each
+#                                      helm_midi output which can run here
+#   midi_schedule_error                Not a cost: how far off its time a
+#                                      NoteScheduler sends each note, on
+#                                      average, in real time
+#
+# Baselines are stored in baselines_file, seconds per operation.  A
+# benchmark is a regression if it's more than threshold (a fraction)
+# slower than its baseline.  Baselines only mean something on the
+# machine they were saved on, so save new ones when that changes.
+
+baselines_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'helm_bench.json')
+threshold = 0.5
+
+
+class NullPort(mido.ports.BaseOutput):
+    # A mido output port which drops every message, after mido has done
+    # all its usual checking and copying
+    def _send(self, msg):
+        pass
+
+
+def per_call(function, min_seconds=0.1, repeat=5):
+    # Seconds per call of function().  Like timeit's autorange, the calls
+    # per run go up 1, 2, 5, 10, 20, ... until a run takes min_seconds,
+    # then the best of repeat runs is kept.
+    calls = 1
+    while True:
+        for multiple in (1, 2, 5):
+            seconds = timed(function, calls * multiple)
+            if seconds >= min_seconds:
+                calls *= multiple
+                best = seconds
+                for _ in range(repeat - 1):
+                    best = min(best, timed(function, calls))
+                return best / calls
+        calls *= 10
+
+
+def timed(function, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return time.perf_counter() - started
+
+
+def every_key_and_mode():
+    # A HelmState in each of the 12 keys and 7 modes
+    return [helm_globals.HelmState(current_key=key, current_key_mode=mode,
+                                   current_chord_root=key)
+            for key in range(12) for mode in range(7)]
+
+
+def theory_benchmarks():
+    # (name, function, operations per call)
+    states = every_key_and_mode()
+    chord_defs = list(helm_globals.chord_definitions.values())
+    key = helm_globals.Key()
+
+    def rotate_key():
+        for _ in range(12):
+            key.rotate_key(add_by=1)
+
+    def rotate_chord():
+        for _ in range(12):
+            key.rotate_chord(add_by=1)
+
+    def derive_scales():
+        for state in states:
+            state.rotate_key_mode(add_by=1)
+
+    def calculate_chord():
+        for state in states:
+            for chord_def in chord_defs:
+                state.calculate_chord(chord_def)
+
+    return [('key_rotate_key', rotate_key, 12),
+            ('key_rotate_chord', rotate_chord, 12),
+            ('derive_scales', derive_scales, len(states)),
+            ('calculate_chord', calculate_chord,
+             len(states) * len(chord_defs))]
+
+
+def helm_benchmarks(helm):
+    # Benchmarks of a Helm's controls and MIDI, as
+    # (name, function, operations per call)
+    wheel = helm.controlSurfaces[0]
+    midi = helm_globals.midi
+    chords = [(state, chord_def) for state in every_key_and_mode()
+              for chord_def in helm_globals.chord_definitions.values()]
+
+    def rotate_wheel():
+        # Once round the key ring, through every key, and back
+        wheel.rotate_wheel(1, 36)
+        wheel.rotate_wheel(-1, 36)
+
+    def rotate_chord():
+        # Once round the mode ring, through every mode, and back
+        wheel.rotate_chord(1, 21)
+        wheel.rotate_chord(-1, 21)
+
+    def notes_trigger():
+        for state, chord_def in chords:
+            helm_globals.key.state = state
+            notes = state.calculate_chord(chord_def)
+            midi.notes_trigger(mode="on", notes=notes, source='bench')
+            midi.notes_trigger(mode="off", notes=notes, source='bench')
+
+    def send_note():
+        midi.send_note('note_on', 60, 100)
+        midi.send_note('note_off', 60, 0)
+
+    return [('wheel_rotate_wheel', rotate_wheel, 72),
+            ('wheel_rotate_chord', rotate_chord, 42),
+            ('notes_trigger', notes_trigger, len(chords) * 2),
+            ('midi_send_note', send_note, 2)]
+
+
+def midi_outputs():
+    # (name, output) for each output backend which can run here
+    outputs = [("mido", MidoOutput(NullPort())),
+               ("rawmidi", RawMidiOutput(os.devnull))]
+    try:
+        outputs.append(("rtmidi", RtmidiOutput("helm_bench",
+                                               virtual=True)))
+    except ImportError:
+        pass
+    return outputs
+
+
+def bench_midi_output(output, min_seconds=0.1, repeat=5):
+    # Seconds per note message, alternating on and off
+    def note():
+        output.send_note('note_on', 0, 60, 100)
+        output.send_note('note_off', 0, 60, 0)
+    return per_call(note, min_seconds, repeat) / 2
+
+
+def schedule_error(notes=20, spacing=0.005, repeat=5):
+    # Mean seconds each note goes out off its time, sending one every
+    # spacing seconds through a NoteScheduler to nowhere.  As with
+    # per_call(), the best of repeat runs is kept.
+    best = None
+    for _ in range(repeat):
+        scheduler = NoteScheduler(lambda *note: None)
+        first = time.perf_counter() + spacing
+        for note in range(notes):
+            scheduler.schedule(first + (note * spacing), None, 'note_on',
+                               60, 100)
+        time.sleep(max(0.0, first + (notes * spacing) -
+                       time.perf_counter()))
+        scheduler.stop()
+        error = scheduler.error_sum / scheduler.dispatched
+        best = error if best is None else min(best, error)
+    return best
+
+
+def run_benchmarks(helm, min_seconds=0.1, repeat=5):
+    # {name: seconds per operation} for every benchmark.  Leaves the key
+    # and the MIDI output as they were.
+    results = {}
+    state = helm_globals.key.state
+    outport = getattr(helm_globals.midi, 'outport', None)
+    using_midi = helm_globals.using_midi
+    helm_globals.midi.outport = MidoOutput(NullPort())
+    helm_globals.using_midi = True
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            for name, function, operations in \
+                    theory_benchmarks() + helm_benchmarks(helm):
+                results[name] = per_call(function, min_seconds,
+                                         repeat) / operations
+    finally:
+        helm_globals.midi.all_notes_off()
+        helm_globals.midi.outport = outport
+        helm_globals.using_midi = using_midi
+        helm_globals.key.state = state
+
+    for name, output in midi_outputs():
+        results['midi_output ' + name] = bench_midi_output(
+            output, min_seconds, repeat)
+        output.close()
+    results['midi_schedule_error'] = schedule_error(repeat=repeat)
+    return results
+
+
+def load_baselines(path=None):
+    try:
+        with open(path or baselines_file) as baselines:
+            return json.load(baselines)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baselines(results, path=None):
+    with open(path or baselines_file, 'w') as baselines:
+        json.dump(results, baselines, indent=2, sort_keys=True)
+        baselines.write('\n')
+
+
+def regressions(results, baselines, threshold=threshold):
+    # {name: (seconds, baseline)} for each benchmark more than threshold
+    # slower than its baseline.  Benchmarks without one are left out.
+    return {name: (seconds, baselines[name])
+            for name, seconds in results.items()
+            if name in baselines and
+            seconds > baselines[name] * (1 + threshold)}
+
+
+def main(min_seconds=0.1, check=False, save=False, threshold=threshold,
+         report=print):
+    # Returns the regressions found, if checking
+    from helm import Helm
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        bench_helm = Helm(init_gfx=False)
+    results = run_benchmarks(bench_helm, min_seconds)
+    baselines = load_baselines()
+    for name, seconds in sorted(results.items()):
+        line = "{:<24} {:10.3f} us".format(name, seconds * 1e6)
+        if name in baselines:
+            line += "  ({:+.0%} on baseline)".format(
+                seconds / baselines[name] - 1)
+        report(line)
+
+    found = {}
+    if check:
+        found = regressions(results, baselines, threshold)
+        for name, (seconds, baseline) in sorted(found.items()):
+            report("REGRESSION {}: {:.3f} us, baseline {:.3f} us".format(
+                name, seconds * 1e6, baseline * 1e6))
+    if save:
+        save_baselines(results)
+        report("Saved baselines to " + baselines_file)
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time helm's hot paths, per operation")
+    parser.add_argument('--min-seconds', type=float, default=0.1,
+                        help="Shortest run of each benchmark to time")
+    parser.add_argument('--check', action='store_true',
+                        help="Exit 1 if anything is more than --threshold "
+                             "slower than its baseline")
+    parser.add_argument('--threshold', type=float, default=threshold,
+                        help="Slowdown allowed, as a fraction of the "
+                             "baseline (default {})".format(threshold))
+    parser.add_argument('--save', action='store_true',
+                        help="Store these results as the baselines")
+    args = parser.parse_args()
+    sys.exit(1 if main(min_seconds=args.min_seconds, check=args.check,
+                       save=args.save, threshold=args.threshold) else 0)
@@ -0,0 +1,215 @@
+import io
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import pygame
+
+# Headless frame capture.
+#
+# Frames are written to a ring buffer in a memory-mapped file, so another
+# local process can watch the instrument without a display.  The file is:
+#
+#   header: magic, width, height, slots, slot_size, format, latest seq
+#   slots:  seq, length, timestamp, then length bytes of frame data
+#
+# A slot's seq is zeroed before its data is written and set afterwards,
+# so a reader which sees the same seq before and after copying a slot
+# knows it got a whole frame.
+#
+# Capturing only copies the canvas.  Encoding, which can take 100 ms for
+# a 1080p PNG, and writing are done by a thread of its own, so neither
+# holds up the thread drawing.
+
+header_format = '<4sIIIIIQ'
+header_size = struct.calcsize(header_format)
+slot_header_format = '<QId'
+slot_header_size = struct.calcsize(slot_header_format)
+magic = b'HELM'
+
+# Frame data formats
+format_raw = 0  # Raw RGB bytes, width * height * 3
+format_png = 1  # A PNG file
+
+formats = {'raw': format_raw, 'png': format_png}
+
+
+def default_path():
+    # Shared memory if the OS has it, otherwise the temp directory
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') \
+        else tempfile.gettempdir()
+    return os.path.join(directory, 'helm_frames')
+
+
+class FrameCapture(object):
+    # Writes frames into the ring buffer, at most fps times a second, and
+    # never more than one at a time
+    def __init__(self, width, height, path=None, slots=4, fps=5,
+                 frame_format='raw'):
+        self.path = path or default_path()
+        self.width = width
+        self.height = height
+        self.slots = slots
+        self.frame_format = formats[frame_format]
+        # Room for a raw frame.  PNGs of the wheel come out far smaller.
+        self.slot_size = slot_header_size + (width * height * 3)
+        self.interval = 1 / fps
+        self.last_capture = None
+        self.seq = 0
+        # Whether a frame was rendered too soon after the last capture,
+        # and is still to be captured by flush()
+        self.dirty = False
+
+        # The frame being written, copied from the canvas, and whether
+        # the writer thread is still at it
+        self.frame = pygame.Surface((width, height))
+        self.writing = False
+        self.frame_ready = threading.Condition()
+        self.capturing = True
+        self.writer = threading.Thread(target=self.write_frames,
+                                       name="helm-capture", daemon=True)
+
+        size = header_size + (self.slot_size * slots)
+        with open(self.path, 'wb') as frames_file:
+            frames_file.truncate(size)
+        self.frames_file = open(self.path, 'r+b')
+        self.frames = mmap.mmap(self.frames_file.fileno(), size)
+        self.write_header()
+        self.writer.start()
+
+    def write_header(self):
+        struct.pack_into(header_format, self.frames, 0, magic, self.width,
+                         self.height, self.slots, self.slot_size,
+                         self.frame_format, self.seq)
+
+    def capture(self, canvas, now=None):
+        # Called whenever a frame has been rendered.  Returns True if the
+        # frame was handed to the writer thread, False if it was too soon
+        # after the last one or the last is still being written.  It's
+        # then left for flush().
+        if now is None:
+            now = time.monotonic()
+        if self.writing or (self.last_capture is not None and
+                            now - self.last_capture < self.interval):
+            self.dirty = True
+            return False
+        self.last_capture = now
+        self.dirty = False
+
+        self.frame.blit(canvas, (0, 0))
+        with self.frame_ready:
+            self.writing = True
+            self.frame_ready.notify_all()
+        return True
+
+    def write_frames(self):
+        # The writer thread
+        while True:
+            with self.frame_ready:
+                while not self.writing and self.capturing:
+                    self.frame_ready.wait()
+                if not self.writing:
+                    break
+            self.write(self.frame)
+            with self.frame_ready:
+                self.writing = False
+                self.frame_ready.notify_all()
+
+    def wait(self):
+        # Until the frame handed over last has been written
+        with self.frame_ready:
+            while self.writing:
+                self.frame_ready.wait()
+
+    def write(self, frame):
+        if self.frame_format == format_png:
+            encoded = io.BytesIO()
+            pygame.image.save(frame, encoded, "frame.png")
+            data = encoded.getvalue()
+        else:
+            data = pygame.image.tobytes(frame, 'RGB')
+        if slot_header_size + len(data) > self.slot_size:
+            return
+
+        self.seq += 1
+        offset = header_size + ((self.seq % self.slots) * self.slot_size)
+        struct.pack_into(slot_header_format, self.frames, offset,
+                         0, 0, 0.0)
+        start = offset + slot_header_size
+        self.frames[start:start + len(data)] = data
+        struct.pack_into(slot_header_format, self.frames, offset,
+                         self.seq, len(data), time.time())
+        self.write_header()
+
+    def flush(self, canvas, now=None):
+        # Called, from whichever thread draws on canvas, while nothing is
+        # being rendered.  Captures the latest frame once it's due, if one
+        # was skipped, so the last frame of an animation isn't lost.
+        return self.dirty and self.capture(canvas, now)
+
+    def close(self):
+        # After writing any frame handed over already
+        with self.frame_ready:
+            self.capturing = False
+            self.frame_ready.notify_all()
+        self.writer.join()
+        self.frames.close()
+        self.frames_file.close()
+
+
+class FrameReader(object):
+    # Reads the latest frame written by a FrameCapture, from any process
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.frames_file = open(self.path, 'rb')
+        self.frames = mmap.mmap(self.frames_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        (file_magic, self.width, self.height, self.slots, self.slot_size,
+         self.frame_format, _) = struct.unpack_from(header_format,
+                                                    self.frames, 0)
+        if file_magic != magic:
+            raise ValueError("Not a helm frame capture: " + self.path)
+
+    def latest(self):
+        # (seq, timestamp, data) of the newest whole frame, or None
+        for _ in range(3):
+            seq = struct.unpack_from(header_format, self.frames, 0)[6]
+            if seq == 0:
+                return None
+            offset = header_size + ((seq % self.slots) * self.slot_size)
+            slot_seq, length, timestamp = struct.unpack_from(
+                slot_header_format, self.frames, offset)
+            start = offset + slot_header_size
+            data = self.frames[start:start + length]
+            if slot_seq == seq and struct.unpack_from(
+                    slot_header_format, self.frames, offset)[0] == seq:
+                return seq, timestamp, data
+        # The writer kept lapping us, try again later
+        return None
+
+    def latest_surface(self):
+        frame = self.latest()
+        if frame is None:
+            return None
+        if self.frame_format == format_png:
+            return pygame.image.load(io.BytesIO(frame[2]), "frame.png")
+        return pygame.image.frombytes(frame[2], (self.width, self.height),
+                                      'RGB')
+
+    def close(self):
+        self.frames.close()
+        self.frames_file.close()
+
+
+if __name__ == "__main__":
+    # Save the latest captured frame:
+    # python helm_capture.py frame.png [capture path]
+    reader = FrameReader(sys.argv[2] if len(sys.argv) > 2 else None)
+    surface = reader.latest_surface()
+    if surface is None:
+        print("No frames captured yet")
+    else:
+        pygame.image.save(surface, sys.argv[1])
@@ -1,8 +1,17 @@
+import importlib
+import math
 import pygame
 from helm_shapes import ShapeWheel, ShapeWheelRay, ShapeWheelSlice, \
                         ShapeNotesList
 import helm_globals
+import helm_events
 import helm_fonts
+import helm_layout
+import helm_metrics
+
+
+# Transparent parts of a ControlSystem.layer().  Nothing is drawn in it.
+layer_colorkey = (255, 0, 255)
 
 
 class ControlSystem(object):
@@ -14,6 +23,12 @@ class ControlSystem(object):
         self.canvas_width = kwargs.get('canvas_size', 100)
         self.canvas_height = kwargs.get('canvas_size', 100)
 
+        # Sizes and radii for the current canvas resolution
+        self.layout = kwargs.get('layout', None)
+        if self.layout is None:
+            self.layout = helm_layout.layout_for(
+                helm_layout.reference_width, helm_layout.reference_height)
+
         self.color = kwargs.get('color', helm_globals.color_orange)
         self.color_bg = kwargs.get('color_bg', helm_globals.color_black)
         self.color_accent = kwargs.get('color_accent',
@@ -43,23 +58,42 @@ class ControlSystem(object):
         # For now, set to True so we get an initial render.
         self.needs_rendering = True
 
+        # Render budget for draw_control, in seconds.  A deferrable control
+        # may have its redraws put off while frames are running long, see
+        # helm_render.FrameScheduler.
+        self.render_budget = kwargs.get('render_budget', 0.008)
+        self.deferrable = kwargs.get('deferrable', False)
+
+        # Animation frames to move on by per update.  Set above 1 by the
+        # FrameScheduler when frames are too slow to show every one.
+        self.animation_step = 1
+
+        # HelmState fields this control draws.  A change to any of them
+        # flags a redraw, see state_changed()
+        self.state_fields = set()
+
+        # helm_events kinds update_control() is handed.  It only ever sees
+        # events of these kinds, see helm_events.EventRouter.
+        self.event_kinds = set()
+
     def init_surface(self):
         pass
 
-    def draw_polygon(self, shape, width, color):
-        pygame.draw.polygon(self.surface, color, shape.coordinates, width)
+    def draw_polygon(self, shape, width, color, surface=None):
+        pygame.draw.polygon(surface or self.surface, color,
+                            shape.coordinates, width)
 
-    def draw_key_labels(self, shape, labels):
+    def draw_key_labels(self, shape, labels, key):
         coord_pair = 0
         for coordinates in shape.coordinates:
-            if (coord_pair >= helm_globals.key.current_key) and \
-               (coord_pair <= (helm_globals.key.current_key + 5)) and \
-                    (helm_globals.key.current_key in range(7)):
+            if (coord_pair >= key.current_key) and \
+               (coord_pair <= (key.current_key + 5)) and \
+                    (key.current_key in range(7)):
                 # sharps
                 note_label = labels[coord_pair]['sharpName']
             else:
                 note_label = labels[coord_pair]['noteName']
-            if helm_globals.key.current_key == coord_pair:
+            if key.current_key == coord_pair:
                 font = helm_fonts.font['medium_bold']
             else:
                 font = helm_fonts.font['medium']
@@ -71,80 +105,174 @@ class ControlSystem(object):
             coord_pair += 1
 
     def draw_label(self, coordinates, degrees, text_label, font,
-                   color):
-        text = font.render(text_label, False, color)
-        text = pygame.transform.rotate(text, degrees)
+                   color, surface=None):
+        text = helm_fonts.glyph(text_label, font, color, degrees)
         text_x_center = int(text.get_width() / 2)
         text_y_center = int(text.get_height() / 2)
         # Bit on to the surface:
-        self.surface.blit(text, [coordinates[0] - text_x_center,
-                                 coordinates[1] - text_y_center])
+        (surface or self.surface).blit(text,
+                                       (coordinates[0] - text_x_center,
+                                        coordinates[1] - text_y_center))
+
+    def layer(self, fill=None):
+        # A surface the size of this control's, to draw part of it once
+        # and blit every frame.  Without a fill it's transparent, through
+        # the layer_colorkey.
+        surface = pygame.Surface(self.surface.get_size())
+        if fill is None:
+            surface.fill(layer_colorkey)
+            surface.set_colorkey(layer_colorkey)
+        else:
+            surface.fill(fill)
+        return surface
+
+    def snapshot(self):
+        # Everything draw_control needs, detached from the live state so
+        # drawing can happen on another thread
+        return helm_globals.key.snapshot()
+
+    def state_changed(self, changed):
+        # changed is a set of HelmState field names, from HelmState.diff().
+        # Only redraw if this control actually shows one of them.
+        if self.state_fields.intersection(changed):
+            self.needs_rendering = True
 
-    def draw_control(self):
+    def draw_control(self, snapshot):
         pass
 
     def update_control(self, events):
+        # Called every loop with this loop's events of the event_kinds
+        # this control handles, in order
         pass
 
+    def contains(self, x, y):
+        # Is canvas point (x, y) on this control's surface
+        return 0 <= x - self.blit_x < self.surface.get_width() and \
+            0 <= y - self.blit_y < self.surface.get_height()
+
+    # Touch and mouse input.  finger tells apart fingers down at the same
+    # time, and (x, y) is on this control's surface.  A finger's move and
+    # up go to the control it came down on, even once it's moved off.
+    # Like update_control, nothing here should change the state, only add
+    # to events.
+    def touch_down(self, finger, x, y, events):
+        pass
+
+    def touch_move(self, finger, x, y, events):
+        pass
+
+    def touch_up(self, finger, x, y, events):
+        pass
+
+
+class WheelTouch(object):
+    # A finger down on one of the WheelControl's rings
+    __slots__ = ('wheel', 'slice_no', 'angle', 'turning', 'turned')
+
+    def __init__(self, wheel, slice_no, angle):
+        self.wheel = wheel  # "key" or "chord"
+        self.slice_no = slice_no  # Where it came down
+        self.angle = angle  # Where it is now, in degrees
+        self.turning = 0  # Degrees dragged towards the next detent
+        self.turned = False  # Dragged at least a detent, so not a tap
+
 
 class ChordControl(ControlSystem):
     def __init__(self, **kwargs):
         # Run superclass __init__ to inherit all of those instance attributes
         super(self.__class__, self).__init__(**kwargs)
 
-        self.canvas_height = 600
+        # The chord labels can wait a few frames when drawing falls behind
+        self.render_budget = kwargs.get('render_budget', 0.002)
+        self.deferrable = kwargs.get('deferrable', True)
+
+        self.canvas_height = self.layout.chord_height
         self.surface = pygame.Surface(
             (int(self.canvas_width + (helm_globals.canvas_margin * 2)),
              int(self.canvas_height + (helm_globals.canvas_margin * 2))))
 
+        # The note labels and chord squares depend on key and mode only
+        self.state_fields = {'current_key', 'chord_scale'}
+
+        # One line of note boxes per chord definition, worked out once
+        self.lines = []
+        line_spacing = 0
+        for chord_def in helm_globals.chord_definitions:
+            line_coords = ShapeNotesList(
+                spacing_width=self.layout.chord_spacing_width,
+                line_spacing=line_spacing,
+                left_margin=self.layout.chord_left_margin)
+            label_coords = (line_coords.coordinates[0][0] -
+                            self.layout.chord_label_offset,
+                            line_coords.coordinates[0][1])
+            self.lines.append((chord_def, line_coords, label_coords))
+            line_spacing += self.layout.chord_line_spacing
+
+        # Touch hit-testing.  The note boxes are a regular grid, one row
+        # per line, so the row under a point is a division rather than a
+        # test of every box.  A row reaches from the left edge to the
+        # right of its last box.
+        first_box = self.lines[0][1].coordinates_boxes[0]
+        last_box = self.lines[0][1].coordinates_boxes[-1]
+        self.rows_top = first_box[1]
+        self.rows_right = last_box[0] + last_box[2]
+        self.row_height = first_box[3]
+        self.row_pitch = max(1, self.layout.chord_line_spacing)
+        # finger -> chord_def of the row it's holding
+        self.touches = {}
+
     def update_control(self, events):
+        # The notes themselves are triggered by the WheelControl.  This
+        # control redraws when the key or mode changes, see state_changed()
         self.needs_rendering = False
-        # Handle the dict of events passed in for this update
-        for event in events:
-            if 'trigger_note' in events[event] and \
-                    events[event]['trigger_note']:
-                # Calculate chord formula in form of key.notes index list
-                notes_trigger = helm_globals.key.calculate_chord(
-                    helm_globals.chord_definitions[events[event]['chord']])
-                print("notes_effected:", notes_trigger)
-                if 'start' in events[event] and events[event]['start']:
-                    self.needs_rendering = True
-                    print("event:", event)
-                    print("events[event]:", events[event])
-                    print("events[event]['chord']:", events[event]['chord'])
-                    helm_globals.midi.notes_trigger(mode="on",
-                                                    notes=notes_trigger)
-                if 'stop' in events[event] and events[event]['stop']:
-                    self.needs_rendering = True
-                    print("event:", event)
-                    print("events[event]:", events[event])
-                    print("events[event]['chord']:", events[event]['chord'])
-                    helm_globals.midi.notes_trigger(mode="off",
-                                                    notes=notes_trigger)
-
-    def draw_squares(self, shape, color, width, chord_def):
-        for note in helm_globals.key.calculate_chord(chord_def):
-            rect = pygame.Rect(
-                shape.coordinates_boxes[note])
-            pygame.draw.rect(self.surface, color, rect, width)
-
-    def draw_control(self):
+
+    def row_at(self, x, y):
+        # The chord_def of the row under (x, y), or None
+        if not 0 <= x < self.rows_right or y < self.rows_top:
+            return None
+        row, down = divmod(y - self.rows_top, self.row_pitch)
+        if row >= len(self.lines) or down >= self.row_height:
+            return None
+        return self.lines[row][0]
+
+    def touch_down(self, finger, x, y, events):
+        # Hold a row to play its chord, like holding a chord key
+        chord_def = self.row_at(x, y)
+        if chord_def is None:
+            return
+        self.touches[finger] = chord_def
+        if not helm_globals.key.notes_latched:
+            helm_events.chord_event(events, ('touch', finger), True,
+                                    chord=chord_def)
+
+    def touch_up(self, finger, x, y, events):
+        chord_def = self.touches.pop(finger, None)
+        if chord_def is None:
+            return
+        if not helm_globals.key.notes_latched:
+            helm_events.chord_event(events, ('touch', finger), False,
+                                    chord=chord_def)
+        else:
+            helm_events.latch_event(events)
+
+    def draw_squares(self, shape, color, width, chord_def, key):
+        for note in key.calculate_chord(chord_def):
+            pygame.draw.rect(self.surface, color,
+                             shape.coordinates_boxes[note], width)
+
+    def draw_control(self, snapshot):
+        key = snapshot
+
         self.surface.fill(self.color_bg)
 
-        line_spacing = 0
-        for chord_def in helm_globals.chord_definitions:
-            line_coords = ShapeNotesList(spacing_width=44,
-                                         line_spacing=line_spacing,
-                                         left_margin=226)
+        for chord_def, line_coords, label_coords in self.lines:
             self.draw_squares(line_coords, self.color, 1,
-                              helm_globals.chord_definitions[chord_def])
-            self.draw_key_labels(line_coords, helm_globals.key.notes)
-            self.draw_label((line_coords.coordinates[0][0]-168,
-                             line_coords.coordinates[0][1]),
+                              helm_globals.chord_definitions[chord_def], key)
+            self.draw_key_labels(line_coords, key.notes, key)
+            self.draw_label(label_coords,
                             0,
                             chord_def,
                             helm_fonts.font['small_bold'], self.color)
-            line_spacing += 60
 
 
 class WheelControl(ControlSystem):
@@ -154,26 +282,25 @@ class WheelControl(ControlSystem):
         self.r = int(self.canvas_height / 2)
         # rotate_offset tracks the overall rotation of the wheel in degrees
         # As the user rotates the wheel, this value is incremented/decremented
-        self.rotate_offset = 0
-
-        # rotate_offset_note tracks overall rotation, but for the selected
+        # rotate_offset_chord tracks overall rotation, but for the selected
         # note
-        self.rotate_offset_chord = 0
+        # Both are kept in the HelmState, see the properties below.
+
+        self.state_fields = {'current_key', 'notes_on', 'rotate_offset',
+                             'rotate_offset_chord'}
+
+        # The wheel plays the chords and turns the rings
+        self.event_kinds = {helm_events.TRIGGER, helm_events.LATCH,
+                            helm_events.ROTATE, helm_events.SELECT,
+                            helm_events.RECALL}
 
         # These are used to track rotation animation of the wheel
-        # rotate_steps tracks how many remaining frames of rotation are left
-        # to animate for key wheel rotation
-        # rotate_iterator will be 1 or -1, and is added to rotate_offset once
-        # per cycle until rotate_steps runs out
-        self.rotate_steps = 0
-        self.rotate_iterator = 0
-
-        # These are used to track rotation animation of the note selection
-        # rotate_steps_note tracks how many remaining frames of rotation are
-        # left to animate for note selection
-        # rotate_iterator_note, same as above but for note selection
-        self.rotate_steps_chord = 0
-        self.rotate_iterator_chord = 0
+        # rotate_target is where rotate_offset is heading.  Each frame
+        # rotate_offset moves up to rotate_speedup degrees towards it.
+        self.rotate_target = 0
+
+        # Same as above but for note selection
+        self.rotate_target_chord = 0
 
         # rotate_amount is how many degrees to hop per event
         # 1 degree per event makes turning the circle sloooow
@@ -182,260 +309,484 @@ class WheelControl(ControlSystem):
         # animation super quick.  Factors of 30 will work best
         self.rotate_speedup = 10
 
+        # Detent table: (offset mod one slice, direction) -> True if
+        # turning one more detent that way crosses in to the next slice.
+        # Clockwise crosses on reaching 20 degrees in to a slice,
+        # counterclockwise on reaching 10.
+        self.detent_edges = {}
+        for phase in range(0, 30, self.rotate_amount):
+            self.detent_edges[(phase, 1)] = \
+                (phase + self.rotate_amount) % 30 == 20
+            self.detent_edges[(phase, -1)] = \
+                (phase - self.rotate_amount) % 30 == 10
+
         # The circle is divided in to 12 segments
         # But if want a _side_ to be oriented upwards, not a _point_
         # then back it up an additional 1/24th of a circle
         self.offset_degrees = int(-360 / 24)
 
-    def rotate_wheel(self, direction):
+        # Everything on the wheel which doesn't rotate, worked out once
+        self.radii = self.layout.wheel_radii
+        size = self.r * 2
+        self.ray_key = ShapeWheelRay(canvas_size=size,
+                                     r=self.radii['rays'],
+                                     slice_no=0)
+        self.ray_fifths = ShapeWheelRay(canvas_size=size,
+                                        r=self.radii['rays'],
+                                        slice_no=1)
+        self.ray_fourths = ShapeWheelRay(canvas_size=size,
+                                         r=self.radii['rays'],
+                                         slice_no=11)
+        self.slices_fill = [
+            ShapeWheelSlice(canvas_size=size,
+                            r=self.radii['slice_fill'],
+                            slice_no=i,
+                            offset_degrees=self.offset_degrees)
+            for i in [0, 1, 2, 3, 4, 5, 11]]
+        self.slices_outline = [
+            ShapeWheelSlice(canvas_size=size,
+                            r=self.radii['slice_outline'],
+                            slice_no=i,
+                            offset_degrees=self.offset_degrees)
+            for i in [0, 1, 2, 3, 4, 5, 11]]
+        self.slices_highlight = [
+            ShapeWheelSlice(canvas_size=size,
+                            r=self.radii['highlight'],
+                            slice_no=i,
+                            offset_degrees=self.offset_degrees)
+            for i in range(12)]
+
+        # Touch hit-testing.  The slice under a point comes from its angle
+        # around the centre, looked up in hit_slices (a slice for every
+        # whole degree, from the slice geometry), and the ring from its
+        # distance out, against hit_rings.  Either way it's a lookup, so a
+        # touch costs the same wherever it lands.
+        self.origin = (self.slices_highlight[0].origin_x,
+                       self.slices_highlight[0].origin_y)
+        self.hit_slices = self.slice_table(self.slices_highlight)
+        # (squared radius, ring) from the centre out.  The key labels go
+        # round outside the slices, the chord pointer inside them.
+        self.hit_rings = ((self.radii['slice_fill'] ** 2, 'chord'),
+                          (self.r ** 2, 'key'))
+        # Detents per slice
+        self.slice_steps = 30 // self.rotate_amount
+        # finger -> WheelTouch
+        self.touches = {}
+
+        self.label_rays = [
+            (label,
+             ShapeWheelRay(canvas_size=size,
+                           r=self.radii['step_labels'],
+                           slice_no=label),
+             ShapeWheelRay(canvas_size=size,
+                           r=self.radii['triad_labels'],
+                           slice_no=label),
+             ShapeWheelRay(canvas_size=size,
+                           r=self.radii['mode_labels'],
+                           slice_no=label))
+            for label in helm_globals.note_wheel_labels]
+
+        # The rotating rings by angle, rotate_offset % 360.  They only
+        # ever come to rest on a few angles, so each is worked out once.
+        self.label_circles = {}
+        self.pointers = {}
+
+        # Everything which doesn't change is drawn once, on to these
+        # layers, by draw_layers().  Every frame blits them rather than
+        # drawing the labels and polygons all over again.
+        self.background = None
+        self.slices_layer = None
+        self.labels_layer = None
+
+    @property
+    def rotate_offset(self):
+        return helm_globals.key.state.rotate_offset
+
+    @rotate_offset.setter
+    def rotate_offset(self, rotate_offset):
+        helm_globals.key.set_rotate_offsets(rotate_offset=rotate_offset)
+
+    @property
+    def rotate_offset_chord(self):
+        return helm_globals.key.state.rotate_offset_chord
+
+    @rotate_offset_chord.setter
+    def rotate_offset_chord(self, rotate_offset_chord):
+        helm_globals.key.set_rotate_offsets(
+            rotate_offset_chord=rotate_offset_chord)
+
+    def rotate_wheel(self, direction, steps=1):
         # Set direction to 1 for clockwise rotation
         # Set direction to -1 for counterclockwise rotation
-        # It's an integer of degrees added to the overall rotation
-        # If this is called and there is no rotation currently, begin
-        #   rotation immediately
-        if (self.rotate_steps == 0) or (self.rotate_iterator != direction):
-            self.rotate_steps = int(self.rotate_amount / self.rotate_speedup) \
-                                    - self.rotate_steps
-            self.rotate_iterator = direction
-
-            print("self.rotate_offset:", self.rotate_offset,
-                  "rotate_offset + rotate_amount:",
-                  self.rotate_offset +
-                  (self.rotate_amount * self.rotate_iterator),
-                  "mod 360/12:",
-                  (self.rotate_offset +
-                   (self.rotate_iterator * self.rotate_amount)) % (360/12),
-                  "self.rotate_amount:", self.rotate_amount,
-                  "self.rotate_iterator:", self.rotate_iterator)
-
-            # Edge detection around the wheel
-            # With the current rotate_amount (360/36),
-            # If the rotation iterator is 1 and the abs value of the rotation
-            #   amt mod (360/12) reaches 20, time to rotate the key.
-            # If the rotation iterator is -1 and the abs value of the rotation
-            #   amt mod (360/12) reaches 10, time to rotate as well.
-            if ((self.rotate_iterator == 1) and
-                (abs((self.rotate_offset +
-                 (self.rotate_amount * self.rotate_iterator))
-                 % (360/12)) == 20)) or \
-                ((self.rotate_iterator == -1) and
-                 (abs((self.rotate_offset +
-                  (self.rotate_amount * self.rotate_iterator))
-                  % (360/12)) == 10)):
-
+        # Turns the key ring by steps detents of rotate_amount degrees.
+        # The key changes straight away, the animation catches up over the
+        # next frames.
+        state = helm_globals.key.state
+        target = self.rotate_target
+        for _ in range(steps):
+            # Edge detection around the wheel, from the detent table
+            if self.detent_edges[(target % 30, direction)]:
                 # Set the key index as we turn around
-                # Subtract because of the rotating-disk mechanic, the chosen
-                # option is OPPOSITE direction of the disk turning
-                helm_globals.key.rotate_key(add_by=(-1 *
-                                                    self.rotate_iterator))
-
+                # Subtract because of the rotating-disk mechanic, the
+                # chosen option is OPPOSITE direction of the disk turning
                 # Change the chord, too
-                helm_globals.key.rotate_chord(add_by=(-1
-                                                      * self.rotate_iterator))
+                state = state.rotate_key(add_by=-direction)\
+                    .rotate_chord(add_by=-direction)
+            target += self.rotate_amount * direction
+        helm_globals.key.state = state
+        self.rotate_target = target
 
-    def rotate_chord(self, direction):
+    def rotate_chord(self, direction, steps=1):
         # Set direction to 1 for clockwise rotation
         # Set direction to -1 for counterclockwise rotation
-        # It's an integer of degrees added to the overall rotation
-        # If this is called and there is no rotation currently, begin
-        #   rotation immediately
-
-        if (self.rotate_steps_chord == 0) or \
-                (self.rotate_iterator_chord != direction):
-            self.rotate_steps_chord = int(self.rotate_amount /
-                                          self.rotate_speedup) \
-                                      - self.rotate_steps_chord
-            self.rotate_iterator_chord = direction
-
-            if ((self.rotate_iterator_chord == 1) and
-                (abs((self.rotate_offset_chord +
-                      (self.rotate_amount * self.rotate_iterator_chord))
-                     % (360/12)) == 20)) or \
-                ((self.rotate_iterator_chord == -1) and
-                 (abs((self.rotate_offset_chord +
-                       (self.rotate_amount * self.rotate_iterator_chord))
-                      % (360/12)) == 10)):
-
-                # Change the mode
-                helm_globals.key.rotate_key_mode(
-                    add_by=self.rotate_iterator_chord)
-
-                if (abs((helm_globals.key.current_chord_root -
-                         helm_globals.key.current_key) % 12) <= 5) or \
-                        (abs((helm_globals.key.current_chord_root -
-                              helm_globals.key.current_key) % 12) == 11):
-                    # Change the chord
-                    helm_globals.key.rotate_chord(
-                        add_by=self.rotate_iterator_chord)
-
-                # Handle the "rollover" as the pointer skips past non-Diotonics
-                # if helm_globals.chord_position == 6:
-                if abs((helm_globals.key.current_chord_root -
-                        helm_globals.key.current_key) % 12) == 6:
-                    helm_globals.key.rotate_chord(set_to=(11 + helm_globals.
-                                                          key.current_key))
-                    self.rotate_offset_chord += 150
-
-                if abs((helm_globals.key.current_chord_root -
-                        helm_globals.key.current_key) % 12) == 10:
-                    helm_globals.key.rotate_chord(set_to=(5 + helm_globals.
-                                                          key.current_key))
-                    self.rotate_offset_chord -= 150
+        # Turns the mode ring by steps detents.  Each step is a couple of
+        # table lookups (see helm_globals.chord_transitions), so a fast
+        # encoder spin is applied exactly, all at once, even in the middle
+        # of an animation.
+        state = helm_globals.key.state
+        target = self.rotate_target_chord
+        jump = 0
+        for _ in range(steps):
+            if self.detent_edges[(target % 30, direction)]:
+                position = (state.current_chord_root -
+                            state.current_key) % 12
+                mode_delta, position, angle = \
+                    helm_globals.chord_transitions[(position, direction)]
+                # Change the mode and the chord.  The pointer skips past
+                # the non-diatonic slices by angle degrees.
+                state = state.rotate_key_mode(add_by=mode_delta)\
+                    .rotate_chord(set_to=state.current_key + position)
+                jump += angle
+            target += self.rotate_amount * direction
+        helm_globals.key.state = state
+        self.rotate_target_chord = target + jump
+        if jump:
+            self.rotate_offset_chord += jump
+
+    def select_slice(self, wheel, slice_no):
+        # Turn a ring the short way round to bring slice_no under control
+        if wheel == "key":
+            # The key ring turns the key label on slice_no to the top.  It
+            # turns the opposite way to the key, so counterclockwise for
+            # the slices to the right.
+            slices = slice_no if slice_no <= 6 else slice_no - 12
+            if slices:
+                self.rotate_wheel(-1 if slices > 0 else 1,
+                                  abs(slices) * self.slice_steps)
+        elif slice_no in helm_globals.chord_positions:
+            # The chord ring only stops on diatonic chords, so count the
+            # chords passed clockwise with the transition table
+            state = helm_globals.key.state
+            position = (state.current_chord_root - state.current_key) % 12
+            chords = 0
+            while position != slice_no:
+                position = \
+                    helm_globals.chord_transitions[(position, 1)][1]
+                chords += 1
+            if chords > len(helm_globals.chord_positions) // 2:
+                self.rotate_chord(-1, (len(helm_globals.chord_positions) -
+                                       chords) * self.slice_steps)
+            elif chords:
+                self.rotate_chord(1, chords * self.slice_steps)
+
+    def recall(self, preset):
+        # Jump straight to a helm_presets.Preset: one state transition,
+        # then each ring turned the short way round to match, animated in
+        # one go, and one batch of MIDI for the preset's latched chord
+        state = helm_globals.key.state
+
+        # The key ring turns the opposite way to the key, a slice a key
+        self.rotate_target += 30 * ((state.current_key - preset.key + 6)
+                                    % 12 - 6)
+
+        # The chord ring passes a diatonic chord per mode, skipping the
+        # gap, as rotate_chord() would
+        chords = (preset.mode - state.current_key_mode + 3) % 7 - 3
+        direction = 1 if chords > 0 else -1
+        position = (state.current_chord_root - state.current_key) % 12
+        jump = 0
+        for _ in range(abs(chords)):
+            position, angle = \
+                helm_globals.chord_transitions[(position, direction)][1:]
+            self.rotate_target_chord += 30 * direction + angle
+            jump += angle
+        if jump:
+            self.rotate_offset_chord += jump
+
+        helm_globals.key.state = state.jump(preset.key, preset.mode,
+                                            preset.chord_root)
+        helm_globals.midi.recall(preset.octave, preset.latched)
+
+    def slice_table(self, slices):
+        # Slice number for each whole degree around the centre, as polar()
+        # measures them, from the corners of slices
+        table = [None] * 360
+        for shape in slices:
+            start = self.polar(*shape.coordinates[1])[0]
+            end = self.polar(*shape.coordinates[2])[0]
+            for angle in range(start, start + (end - start) % 360):
+                table[angle % 360] = shape.slice_no
+        # The corners are rounded to whole pixels, which can leave a degree
+        # between two slices.  It goes to the one before.
+        for angle in range(360):
+            if table[angle] is None:
+                table[angle] = table[angle - 1]
+        return table
+
+    def polar(self, x, y):
+        # (whole degrees around the centre, squared distance from it) for
+        # (x, y) on the surface, with degrees as the Shapes measure them:
+        # 90 at the top and increasing clockwise
+        dx = self.origin[0] - x
+        dy = self.origin[1] - y
+        return (math.floor(math.degrees(math.atan2(dy, dx))) % 360,
+                dx * dx + dy * dy)
+
+    def touch_down(self, finger, x, y, events):
+        angle, distance = self.polar(x, y)
+        for limit, wheel in self.hit_rings:
+            if distance <= limit:
+                self.touches[finger] = WheelTouch(
+                    wheel, self.hit_slices[angle], angle)
+                return
+
+    def touch_move(self, finger, x, y, events):
+        # Dragging turns the ring with the finger, a detent for every
+        # rotate_amount degrees
+        touch = self.touches.get(finger)
+        if touch is None:
+            return
+        angle = self.polar(x, y)[0]
+        touch.turning += (angle - touch.angle + 180) % 360 - 180
+        touch.angle = angle
+        steps = int(touch.turning / self.rotate_amount)
+        if steps:
+            touch.turning -= steps * self.rotate_amount
+            touch.turned = True
+            helm_events.ring_event(events, touch.wheel,
+                                   1 if steps > 0 else -1, abs(steps))
+
+    def touch_up(self, finger, x, y, events):
+        # A tap, rather than a drag, selects the slice tapped
+        self.touch_move(finger, x, y, events)
+        touch = self.touches.pop(finger, None)
+        if touch is not None and not touch.turned:
+            helm_events.select_event(events, touch.wheel, touch.slice_no)
 
     def update_control(self, events):
         self.needs_rendering = False
-        # Handle the dict of events passed in for this update
+        # Handle the events passed in for this update, in the order they
+        # happened.  See helm_events.
         for event in events:
 
-            if 'trigger_note' in events[event] and \
-                    events[event]['trigger_note']:
-                notes_effected = helm_globals.key.calculate_chord(
-                    helm_globals.chord_definitions[events[event]['chord']])
-                if 'start' in events[event] and events[event]['start']:
-                    self.needs_rendering = True
-                    helm_globals.midi.notes_trigger(mode="on",
-                                                    notes=notes_effected)
-                    helm_globals.midi.notes_prior = notes_effected
-                if 'stop' in events[event] and events[event]['stop']:
-                    self.needs_rendering = True
-                    # Turn off the currently selected notes, plus the prior
-                    # fired notes:
-                    notes_effected.extend(helm_globals.midi.notes_prior)
-                    helm_globals.midi.notes_trigger(mode="off",
-                                                    notes=notes_effected)
-
-            if 'rotate' in events[event] and events[event]['rotate']:
-                if events[event]['wheel'] == "key":
-                    if events[event]['dir'] == "cw":
-                        self.rotate_wheel(1)
-                    if events[event]['dir'] == "ccw":
-                        self.rotate_wheel(-1)
-                if events[event]['wheel'] == "chord":
-                    if events[event]['dir'] == "cw":
-                        self.rotate_chord(1)
-                    if events[event]['dir'] == "ccw":
-                        self.rotate_chord(-1)
-
-        # Perform any animation steps needed for this update
-        if self.rotate_steps > 0:
+            if event.kind == helm_events.LATCH:
+                # In order with the chords started and stopped this loop
+                helm_globals.midi.latch()
+
+            elif event.kind == helm_events.TRIGGER:
+                # The source (which key or pad) holds the notes it starts,
+                # so its stop turns off whatever it started, even if the
+                # key has been rotated in the meantime.
+                self.needs_rendering = True
+                helm_globals.midi.chord_trigger(
+                    "on" if event.start else "off", event.chord,
+                    event.source)
+
+            elif event.kind == helm_events.ROTATE:
+                if event.wheel == "key":
+                    self.rotate_wheel(event.direction, event.steps)
+                if event.wheel == "chord":
+                    self.rotate_chord(event.direction, event.steps)
+
+            elif event.kind == helm_events.SELECT:
+                self.select_slice(event.wheel, event.slice_no)
+
+            elif event.kind == helm_events.RECALL:
+                self.recall(event.preset)
+
+        # Perform any animation steps needed for this update, skipping
+        # frames if the FrameScheduler says drawing is behind
+        speedup = self.rotate_speedup * self.animation_step
+        if self.rotate_offset != self.rotate_target:
             self.needs_rendering = True
-            self.rotate_offset += (self.rotate_iterator * self.rotate_speedup)
-            self.rotate_steps -= 1
+            self.rotate_offset += max(-speedup,
+                                      min(speedup,
+                                          self.rotate_target -
+                                          self.rotate_offset))
 
-        if self.rotate_steps_chord > 0:
+        if self.rotate_offset_chord != self.rotate_target_chord:
             self.needs_rendering = True
-            self.rotate_offset_chord += (self.rotate_iterator_chord *
-                                         self.rotate_speedup)
-            self.rotate_steps_chord -= 1
+            self.rotate_offset_chord += max(-speedup,
+                                            min(speedup,
+                                                self.rotate_target_chord -
+                                                self.rotate_offset_chord))
+
+    def draw_layers(self):
+        # Draw the parts of the wheel which never change on to their
+        # layers.  Needs the fonts, so it waits for the first frame.
+        self.background = self.layer(fill=self.color_bg)
+        # Key label, wheel position 0
+        self.draw_label(self.ray_key.coordinates[1],
+                        self.ray_key.degrees[0],
+                        "Key",
+                        helm_fonts.font['medium'],
+                        self.color, self.background)
+
+        # Labels for directions, wheel positions 1 and 11
+        self.draw_label(self.ray_fifths.coordinates[1],
+                        self.ray_fifths.degrees[0],
+                        "5ths >",
+                        helm_fonts.font['medium'],
+                        self.color_accent, self.background)
+        self.draw_label(self.ray_fourths.coordinates[1],
+                        self.ray_fourths.degrees[0],
+                        "< 4ths",
+                        helm_fonts.font['medium'],
+                        self.color_accent, self.background)
+
+        self.slices_layer = self.layer()
+        for polygon in self.slices_fill:
+            # Inner triangles bg color fill
+            self.draw_polygon(polygon, 0, self.color_accent,
+                              self.slices_layer)
+        for polygon in self.slices_outline:
+            # Outlines
+            self.draw_polygon(polygon, 1, self.color, self.slices_layer)
 
-    def draw_control(self):
+        self.labels_layer = self.layer()
+        for label, step_ray, triad_ray, mode_ray in self.label_rays:
+            self.draw_label(step_ray.coordinates[1],
+                            step_ray.degrees[0],
+                            str(helm_globals.note_wheel_labels[label]
+                                ["step"]),
+                            helm_fonts.font['medium_bold'],
+                            self.color_bg, self.labels_layer)
+            self.draw_label(triad_ray.coordinates[1],
+                            triad_ray.degrees[0],
+                            str(helm_globals.note_wheel_labels[label]
+                                ["triad"]),
+                            helm_fonts.font['small_bold'],
+                            self.color_bg, self.labels_layer)
+            self.draw_label(mode_ray.coordinates[1],
+                            mode_ray.degrees[0]+90,
+                            str(helm_globals.note_wheel_labels[label]
+                                ["mode"]),
+                            helm_fonts.font['small_bold'],
+                            self.color_bg, self.labels_layer)
+
+    def draw_control(self, snapshot):
+        key = snapshot
+
+        if self.background is None:
+            self.draw_layers()
 
         ####################
         # Background stuff #
         ####################
 
-        self.surface.fill(self.color_bg)
-
-        # Key label
-        for i in [0]:  # Wheel position 0
-            polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                    r=self.r,
-                                    slice_no=i)
-            self.draw_label(polygon.coordinates[1],
-                            polygon.degrees[0],
-                            "Key",
-                            helm_fonts.font['medium'],
-                            self.color)
-
-        # Labels for directions
-        for i in [1]:  # Wheel position 1
-            polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                    r=self.r,
-                                    slice_no=i)
-            self.draw_label(polygon.coordinates[1],
-                            polygon.degrees[0],
-                            "5ths >",
-                            helm_fonts.font['medium'],
-                            self.color_accent)
-        for i in [11]:  # Wheel position 11
-            polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                    r=self.r,
-                                    slice_no=i)
-            self.draw_label(polygon.coordinates[1],
-                            polygon.degrees[0],
-                            "< 4ths",
-                            helm_fonts.font['medium'],
-                            self.color_accent)
+        # Background fill, "Key", "5ths >" and "< 4ths"
+        self.surface.blit(self.background, (0, 0))
 
         # Draw the reference circle
-        # This uses self.rotate_offset, so it's a rotating layer
-        label_circle = ShapeWheel(canvas_size=self.r * 2,
-                                  r=self.r - 56,
-                                  offset_degrees=self.rotate_offset)
-        self.draw_key_labels(label_circle, helm_globals.key.notes)
+        # This uses rotate_offset, so it's a rotating layer.
+        angle = key.rotate_offset % 360
+        label_circle = self.label_circles.get(angle)
+        if label_circle is None:
+            helm_metrics.shape_misses.inc()
+            label_circle = ShapeWheel(canvas_size=self.r * 2,
+                                      r=self.radii['key_labels'],
+                                      offset_degrees=angle)
+            self.label_circles[angle] = label_circle
+        else:
+            helm_metrics.shape_hits.inc()
+        self.draw_key_labels(label_circle, key.notes, key)
 
         # Draw the slices
-        for i in [0, 1, 2, 3, 4, 5, 11]:
-            # Inner triangles bg color fill
-            polygon = ShapeWheelSlice(canvas_size=self.r * 2,
-                                      r=self.r - 70,
-                                      slice_no=i,
-                                      offset_degrees=self.offset_degrees)
-            self.draw_polygon(polygon, 0, self.color_accent)
-
-            # Outlines
-            polygon = ShapeWheelSlice(canvas_size=self.r * 2,
-                                      r=self.r - 12,
-                                      slice_no=i,
-                                      offset_degrees=self.offset_degrees)
-            self.draw_polygon(polygon, 1, self.color)
+        self.surface.blit(self.slices_layer, (0, 0))
 
         for i in range(12):
             # "Currently playing" highlights, if on:
-            if ((i + helm_globals.key.current_key) % 12) \
-                    in helm_globals.key.notes_on:
-                polygon = ShapeWheelSlice(canvas_size=self.r * 2,
-                                          r=self.r - 160,
-                                          slice_no=i,
-                                          offset_degrees=self.offset_degrees)
-                self.draw_polygon(polygon, 0, self.color)
-
-        for label in helm_globals.note_wheel_labels:
-            polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                    r=self.r - 200,
-                                    slice_no=label)
-            self.draw_label(polygon.coordinates[1],
-                            polygon.degrees[0],
-                            str(helm_globals.note_wheel_labels[label]
-                                ["step"]),
-                            helm_fonts.font['medium_bold'],
-                            self.color_bg)
-            polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                    r=self.r - 240,
-                                    slice_no=label)
-            self.draw_label(polygon.coordinates[1],
-                            polygon.degrees[0],
-                            str(helm_globals.note_wheel_labels[label]
-                                ["triad"]),
-                            helm_fonts.font['small_bold'],
-                            self.color_bg)
-            polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                    r=self.r - 365,
-                                    slice_no=label)
-            self.draw_label(polygon.coordinates[1],
-                            polygon.degrees[0]+90,
-                            str(helm_globals.note_wheel_labels[label]
-                                ["mode"]),
-                            helm_fonts.font['small_bold'],
-                            self.color_bg)
+            if ((i + key.current_key) % 12) in key.notes_on:
+                self.draw_polygon(self.slices_highlight[i], 0, self.color)
+
+        # Step, triad and mode labels
+        self.surface.blit(self.labels_layer, (0, 0))
 
         # Draw the selected note indicator
-        polygon = ShapeWheelRay(canvas_size=self.r * 2,
-                                r=self.r - 126,
-                                slice_no=0,
-                                offset_degrees=self.rotate_offset_chord)
+        angle = key.rotate_offset_chord % 360
+        polygon = self.pointers.get(angle)
+        if polygon is None:
+            helm_metrics.shape_misses.inc()
+            polygon = ShapeWheelRay(canvas_size=self.r * 2,
+                                    r=self.radii['pointer'],
+                                    slice_no=0,
+                                    offset_degrees=angle)
+            self.pointers[angle] = polygon
+        else:
+            helm_metrics.shape_hits.inc()
         self.draw_label(polygon.coordinates[1],
                         polygon.degrees[0],
                         "↑",
                         helm_fonts.font['x_large'],
                         self.color)
+
+
+def wheel_control(layout):
+    # ffWheel (fourth/fifth wheel) handles keystrokes related to key,
+    #   mode root, and note selection around a circle of fifths.
+    # The size of the ffWheel's surface comes from the layout
+    return WheelControl(canvas_size=layout.wheel_size, layout=layout)
+
+
+def chord_control(layout):
+    # control_chord handles keystrokes related to which chord notes
+    #   to trigger, such a major triad/etc.
+    # The size and position of the control_chord surface come from
+    # the layout
+    return ChordControl(canvas_size=layout.chord_size,
+                        blit_x=layout.chord_blit_x,
+                        blit_y=layout.chord_blit_y,
+                        layout=layout)
+
+
+# The controls helm can draw, by name, each a function making the control
+# for a layout.  A "module:function" string stands in for a function in
+# a module which is only imported when the control is built, so controls
+# which are turned off cost nothing at startup.  More are added with
+# register_control(), or the config's [controls] section.
+control_factories = {'wheel': wheel_control,
+                     'chord': chord_control}
+
+# The controls built when the config doesn't choose, in drawing order
+default_controls = ('wheel', 'chord')
+
+# The most controls helm can draw: helm_render_process asks for a frame
+# with one bit per control in 16
+max_controls = 16
+
+
+def register_control(name, factory):
+    control_factories[name] = factory
+
+
+def make_control(name, layout):
+    # Raises ValueError for a control nobody registered
+    if name not in control_factories:
+        raise ValueError("Unknown control: {}".format(name))
+    factory = control_factories[name]
+    if isinstance(factory, str):
+        module_name, _, function_name = factory.partition(':')
+        factory = getattr(importlib.import_module(module_name),
+                          function_name)
+    return factory(layout)
+
+
+def build_controls(layout, names=default_controls):
+    # Every control helm draws, in drawing order, sized and placed by
+    # layout.  names are control_factories entries.  Used by Helm and by
+    # the render worker process, which draws its own copies.  Raises
+    # ValueError for more than max_controls.
+    if len(names) > max_controls:
+        raise ValueError("{} controls, at most {} can be drawn".format(
+            len(names), max_controls))
+    return [make_control(name, layout) for name in names]
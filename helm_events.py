@@ -0,0 +1,231 @@
+import collections
+import threading
+import time
+import helm_globals
+
+# Building the events handed to each control's update_control().
+# Every input source (keyboard, Powermate, MIDI controllers, touch) goes
+# through these, so they all produce exactly the same events.
+#
+# Events are InputEvent records in an EventBuffer, kept in the order they
+# happened.  A key pressed twice in one loop, or the knob and the keyboard
+# turning the same ring, are separate events, and a down and an up in the
+# same loop are handled in the order they came.
+
+# Chord trigger sources and the chord_definitions entry each one plays
+chord_sources = {'a': '1',
+                 's': '1, 5',
+                 'd': '1, 3, 5',
+                 'z': '2',
+                 'x': '4',
+                 'c': '6'}
+
+# InputEvent kinds
+TRIGGER = 'trigger'  # A chord starting or stopping
+ROTATE = 'rotate'  # A ring turning
+LATCH = 'latch'  # A chord key let go of while notes are latched
+SELECT = 'select'  # A ring turned to bring a wheel slice under control
+RECALL = 'recall'  # A jump to one of the helm_globals.presets
+
+
+class InputEvent(object):
+    # One event.  The records are reused by the EventBuffer, so don't hold
+    # on to one after the loop it came in.
+    __slots__ = ('time', 'kind', 'source', 'chord', 'start', 'wheel',
+                 'direction', 'steps', 'slice_no', 'preset')
+
+    def __init__(self):
+        self.time = 0.0  # time.monotonic() when it was added
+        self.kind = None
+        self.source = None  # TRIGGER: the key or pad holding the chord
+        self.chord = None  # TRIGGER: a helm_globals.chord_types entry
+        self.start = False  # TRIGGER: True to start, False to stop
+        self.wheel = None  # ROTATE, SELECT: "key" or "chord"
+        self.direction = 0  # ROTATE: 1 clockwise, -1 counterclockwise
+        self.steps = 1  # ROTATE: detents turned
+        self.slice_no = 0  # SELECT: the wheel slice tapped on
+        self.preset = None  # RECALL: a helm_presets.Preset
+
+    def __repr__(self):
+        return "InputEvent(" + ", ".join(
+            "{}={!r}".format(field, getattr(self, field))
+            for field in self.__slots__) + ")"
+
+
+class EventBuffer(object):
+    # Ring buffer of InputEvents.  Input is added at the tail during a
+    # loop, the controls iterate over it in order in update_control(), and
+    # clear() hands the records back to be reused.  The records are made
+    # up front, so steady playing allocates nothing.  If a loop brings in
+    # more events than there are records, the buffer doubles in size
+    # rather than drop any.
+    def __init__(self, size=64):
+        self.records = [InputEvent() for _ in range(size)]
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def __iter__(self):
+        size = len(self.records)
+        for position in range(self.head, self.tail):
+            yield self.records[position % size]
+
+    def add(self, kind):
+        # The next record, stamped and ready for its fields to be set
+        size = len(self.records)
+        if self.tail - self.head == size:
+            self.grow()
+            size = len(self.records)
+        event = self.records[self.tail % size]
+        self.tail += 1
+        event.time = time.monotonic()
+        event.kind = kind
+        return event
+
+    def grow(self):
+        size = len(self.records)
+        self.records = [self.records[position % size]
+                        for position in range(self.head, self.tail)] + \
+            [InputEvent() for _ in range(size)]
+        self.tail -= self.head
+        self.head = 0
+
+    def clear(self):
+        self.head = self.tail
+
+
+class EventRouter(object):
+    # Hands each control only the events it handles, see a ControlSystem's
+    # event_kinds.  route() goes through the loop's events once, adding
+    # each to the inbox of every control subscribed to its kind, in the
+    # order they happened.  A control which handles no events always gets
+    # an empty inbox, however busy the input.
+    def __init__(self, controls):
+        self.inboxes = [[] for _ in controls]
+        self.subscribers = {}  # kind -> inboxes
+        for control, inbox in zip(controls, self.inboxes):
+            for kind in control.event_kinds:
+                self.subscribers.setdefault(kind, []).append(inbox)
+
+    def route(self, events):
+        # One list of events per control, in the controls' order.  The
+        # lists are reused, so like the records themselves they're only
+        # good until the next route().
+        for inbox in self.inboxes:
+            inbox.clear()
+        for event in events:
+            for inbox in self.subscribers.get(event.kind, ()):
+                inbox.append(event)
+        return self.inboxes
+
+
+def chord_event(events, source, start, chord=None):
+    # Start or stop the chord belonging to source, or for sources with no
+    # chord of their own, such as a finger on a chord row, chord
+    if chord is None:
+        chord = chord_sources[source]
+        if source == 'd' and helm_globals.key.rotation_ring == "key":
+            # 'd' plays the 7 while the key ring is under control
+            chord = '7'
+    event = events.add(TRIGGER)
+    event.source = source
+    event.chord = chord
+    event.start = start
+
+
+def latch_event(events):
+    # A chord key let go of while notes are latched.  Everything sounding
+    # at this point in the events is handed over to the latch.
+    events.add(LATCH)
+
+
+def rotate_event(events, key_dir, chord_dir, steps=1):
+    # Rotate whichever ring(s) are under control.  The key and chord rings
+    # each get their own direction, 1 for clockwise or -1, since a
+    # keyboard press turns them opposite ways while a knob turns both the
+    # same way.
+    if helm_globals.key.rotation_ring in ("key", "all"):
+        ring_event(events, 'key', key_dir, steps)
+    if helm_globals.key.rotation_ring in ("mode", "all"):
+        ring_event(events, 'chord', chord_dir, steps)
+
+
+def ring_event(events, wheel, direction, steps=1):
+    # Rotate one ring, "key" or "chord", whatever the rotation_ring.  For
+    # input aimed at a ring, such as a drag on it.
+    event = events.add(ROTATE)
+    event.wheel = wheel
+    event.direction = direction
+    event.steps = steps
+
+
+def select_event(events, wheel, slice_no):
+    # Turn one ring the short way round until slice_no of the wheel is
+    # under control: the key at the top for the key ring, the chord under
+    # the pointer for the chord ring.  Worked out by the WheelControl when
+    # it gets to this event, so turns earlier in the loop count.
+    event = events.add(SELECT)
+    event.wheel = wheel
+    event.slice_no = slice_no
+
+
+def recall_event(events, number):
+    # Recall the preset number, counting from 0 in config order, if there
+    # is one
+    if 0 <= number < len(helm_globals.presets):
+        event = events.add(RECALL)
+        event.preset = helm_globals.presets[number]
+
+
+def knob_event(events, direction, steps=1):
+    # A turn of a rotary control, e.g. the Powermate or a MIDI encoder.
+    # direction is 1 for clockwise, -1 for counterclockwise.  steps is how
+    # many detents it turned since the last event.
+    if direction in (1, -1):
+        rotate_event(events, direction, direction, steps)
+
+
+# pypowermate's Powermate.EVENT_ROTATE, evdev's EV_REL.  The other kind
+# it reports, EVENT_BUTTON, is the knob being pressed.
+powermate_rotate = 0x02
+
+
+def powermate_event(events, event):
+    # One (time, kind, value) event from Powermate.read_event().  A turn's
+    # value is the detents turned since the last, more than one at a time
+    # when spun fast, negative counterclockwise.
+    _, kind, value = event
+    if kind == powermate_rotate and value:
+        knob_event(events, 1 if value > 0 else -1, abs(value))
+
+
+class PowermateReader(threading.Thread):
+    # Reads the Powermate on a thread of its own, so the main loop needn't
+    # poll it and can sleep while idle.  Each event is queued for drain()
+    # and notify() called, from this thread, e.g. helm_pacing.wake().
+    def __init__(self, powermate, notify, timeout=0.5):
+        super(PowermateReader, self).__init__(name="helm-powermate",
+                                              daemon=True)
+        self.powermate = powermate
+        self.notify = notify
+        self.timeout = timeout  # Seconds between looks at reading
+        self.pending = collections.deque()
+        self.reading = True
+
+    def run(self):
+        while self.reading:
+            event = self.powermate.read_event(timeout=self.timeout)
+            if event:
+                self.pending.append(event)
+                self.notify()
+
+    def drain(self, events):
+        # Add the events for everything read since the last loop
+        while self.pending:
+            powermate_event(events, self.pending.popleft())
+
+    def stop(self):
+        self.reading = False
+        self.join()
@@ -1,14 +1,48 @@
 import pygame
+import helm_metrics
 # Fonts used throughout the project
 
 font = {}
 
+# Rendered, rotated text surfaces, see glyph()
+glyphs = {}
+glyphs_max = 4096
 
-def init_fonts():
+
+def init_fonts(font_sizes=None):
     # Don't call this until after pygame.init() in the master module.
     # On Mac OS, this initialization is very slow and takes several seconds.
+    # font_sizes comes from the Layout for the current canvas resolution
     global font
-    font = {'small_bold': pygame.font.SysFont('courier', 24, bold=True),
-            'medium': pygame.font.SysFont('courier', 32),
-            'medium_bold': pygame.font.SysFont('courier', 32, bold=True),
-            'x_large': pygame.font.SysFont('courier', 80)}
+    if font_sizes is None:
+        font_sizes = {'small_bold': 24,
+                      'medium': 32,
+                      'medium_bold': 32,
+                      'x_large': 80}
+    font = {'small_bold': pygame.font.SysFont(
+                'courier', font_sizes['small_bold'], bold=True),
+            'medium': pygame.font.SysFont(
+                'courier', font_sizes['medium']),
+            'medium_bold': pygame.font.SysFont(
+                'courier', font_sizes['medium_bold'], bold=True),
+            'x_large': pygame.font.SysFont(
+                'courier', font_sizes['x_large'])}
+    glyphs.clear()
+
+
+def glyph(text_label, text_font, color, degrees):
+    # text_label rendered in text_font and rotated by degrees.  Labels are
+    # redrawn at the same few angles over and over, so each one is only
+    # rendered and rotated once.
+    cache_key = (text_label, text_font, color, degrees)
+    text = glyphs.get(cache_key)
+    if text is not None:
+        helm_metrics.glyph_hits.inc()
+    else:
+        helm_metrics.glyph_misses.inc()
+        if len(glyphs) >= glyphs_max:
+            glyphs.clear()
+        text = text_font.render(text_label, False, color)
+        text = pygame.transform.rotate(text, degrees)
+        glyphs[cache_key] = text
+    return text
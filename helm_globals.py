@@ -1,3 +1,5 @@
+import array
+
 # Griffin Powermate support for Linux systems only
 # Can't install the dependency evdev unless running linux, because
 # part of the install process checks for kernel header files and so on.
@@ -11,6 +13,45 @@ using_griffin_powermate = False
 using_midi = False
 using_midi_clock = False
 midi = None
+# How notes reach the outport, see helm_midi.open_output(): "mido", or
+# raw bytes through "rtmidi" or to the "rawmidi" midi_device file
+midi_backend = "mido"
+midi_device = None
+
+# Print every trigger and note message.  Off by default: the prints are
+# on the note path, and on the clock thread for the arpeggiator.
+midi_debug = False
+
+# Seconds a note keeps sounding after its key is released
+release_time = 0.0
+
+# How triggered chords are voiced, one of the voicings below
+voicing = "octave"
+
+# Playing helm from a MIDI controller on the inport, see
+# Midi.poll_controls().  midi_pads are the note numbers of the pads
+# which play the a, s, d, z, x and c chords.  midi_encoder_cc is a
+# relative encoder which behaves like the Powermate.
+using_midi_controls = False
+midi_input_callback = False  # Receive on mido's thread instead of polling
+midi_pads = (36, 37, 38, 39, 40, 41)
+midi_encoder_cc = 16
+midi_sustain_cc = 64
+
+# Arpeggiate held chords against the external clock on the clock inport.
+# See helm_midi.Arpeggiator for the settings.
+using_arpeggiator = False
+arp_division = 16
+arp_pattern = "up"
+arp_gate = 0.5
+
+# Timestamped note output, see helm_schedule.  midi_quantize is steps
+# per whole note to quantize played notes to, 0 for off, with tempo the
+# beats per minute until the clock inport's clock is running.
+# midi_latency is the outport's latency to make up for, in seconds.
+midi_quantize = 0
+tempo = 120
+midi_latency = 0.0
 
 # If I try to render things like text, corners of polygons, etc right up
 # against the edge of a surface, then there is often clipping.  So, track
@@ -44,70 +85,231 @@ note_wheel_labels = {11: {"step": 4,
                      }
 
 
-class Key(object):
-    def __init__(self):
-        self.current_key = 0
-        self.current_chord_root = 0
-        self.current_key_mode = 0
-        self.notes_on = []  # List containing key.notes indices currently
-        # playing 0-11
-
-        self.notes = [
-            {'noteName': 'C', 'sharpName': 'C', 'kbNum': 0},
-            {'noteName': 'G', 'sharpName': 'G', 'kbNum': 7},
-            {'noteName': 'D', 'sharpName': 'D', 'kbNum': 2},
-            {'noteName': 'A', 'sharpName': 'A', 'kbNum': 9},
-            {'noteName': 'E', 'sharpName': 'E', 'kbNum': 4},
-            {'noteName': 'B', 'sharpName': 'B', 'kbNum': 11},
-            {'noteName': 'Gb', 'sharpName': 'F#', 'kbNum': 6},
-            {'noteName': 'Db', 'sharpName': 'C#', 'kbNum': 1},
-            {'noteName': 'Ab', 'sharpName': 'G#', 'kbNum': 8},
-            {'noteName': 'Eb', 'sharpName': 'D#', 'kbNum': 3},
-            {'noteName': 'Bb', 'sharpName': 'A#', 'kbNum': 10},
-            {'noteName': 'F', 'sharpName': 'E#', 'kbNum': 5}
-                    ]
-
-        self.diatonic = [0, 1, 2, 3, 4, 5, 11]
-        self.chord_scale = [0, 1, 2, 3, 4, 5, 11]
-        self.key_scale_ordered = [0, 2, 4, 11, 1, 3, 5]
+# The twelve notes, in circle of fifths order.  key.notes indices 0-11
+# used throughout the project index in to this.
+key_notes = (
+    {'noteName': 'C', 'sharpName': 'C', 'kbNum': 0},
+    {'noteName': 'G', 'sharpName': 'G', 'kbNum': 7},
+    {'noteName': 'D', 'sharpName': 'D', 'kbNum': 2},
+    {'noteName': 'A', 'sharpName': 'A', 'kbNum': 9},
+    {'noteName': 'E', 'sharpName': 'E', 'kbNum': 4},
+    {'noteName': 'B', 'sharpName': 'B', 'kbNum': 11},
+    {'noteName': 'Gb', 'sharpName': 'F#', 'kbNum': 6},
+    {'noteName': 'Db', 'sharpName': 'C#', 'kbNum': 1},
+    {'noteName': 'Ab', 'sharpName': 'G#', 'kbNum': 8},
+    {'noteName': 'Eb', 'sharpName': 'D#', 'kbNum': 3},
+    {'noteName': 'Bb', 'sharpName': 'A#', 'kbNum': 10},
+    {'noteName': 'F', 'sharpName': 'E#', 'kbNum': 5}
+)
+
+
+class HelmState(object):
+    # One immutable, consistent view of the instrument: key, mode, chord,
+    # sounding notes, input modifiers and wheel rotation.
+    #
+    # Nothing here is ever modified in place.  Every transition returns a
+    # new HelmState, so a reader (the renderer, a MIDI thread, a replay
+    # tool) holding a reference always sees a consistent state with no
+    # locking, and two states can be diff()ed to find what changed.
+    __slots__ = ('current_key', 'current_key_mode', 'current_chord_root',
+                 'notes_on', 'rotation_ring', 'notes_latched',
+                 'rotate_offset', 'rotate_offset_chord',
+                 'diatonic', 'chord_scale')
+
+    # Shared, never changes
+    notes = key_notes
+
+    def __init__(self, current_key=0, current_key_mode=0,
+                 current_chord_root=0, notes_on=frozenset(),
+                 rotation_ring="mode", notes_latched=False,
+                 rotate_offset=0, rotate_offset_chord=0):
+        init = object.__setattr__
+        init(self, 'current_key', current_key % 12)
+        init(self, 'current_key_mode', current_key_mode % 7)
+        init(self, 'current_chord_root', current_chord_root % 12)
+        # key.notes indices currently playing 0-11
+        init(self, 'notes_on', frozenset(notes_on))
+        # Which ring is under control: "key", "mode", "all"
+        init(self, 'rotation_ring', rotation_ring)
+        # When true, don't stop notes on keyUps
+        init(self, 'notes_latched', notes_latched)
+        # Overall wheel rotation in degrees, and the selected note pointer's
+        init(self, 'rotate_offset', rotate_offset)
+        init(self, 'rotate_offset_chord', rotate_offset_chord)
+        self._derive()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("HelmState is immutable, use its transitions")
+
+    def __repr__(self):
+        return "HelmState(" + ", ".join(
+            "{}={!r}".format(field, getattr(self, field))
+            for field in self.__slots__) + ")"
+
+    def _derive(self):
+        # diatonic and chord_scale only depend on key and mode, so they are
+        # worked out once per transition rather than by every reader
+        diatonic = tuple((self.current_key + i) % 12
+                         for i in (0, 1, 2, 3, 4, 5, 11))
+        object.__setattr__(self, 'diatonic', diatonic)
+        object.__setattr__(self, 'chord_scale', tuple(
+            diatonic[i % 7] for i in range(self.current_key_mode,
+                                           self.current_key_mode + 7)))
 
-    def update_diatonic(self):
-        self.diatonic = []
-        for i in [0, 1, 2, 3, 4, 5, 11]:
-            self.diatonic.append(
-                (self.current_key + i) % 12
-            )
+    def _replace(self, **changes):
+        # Copy-on-write: a new state sharing every unchanged field
+        state = object.__new__(HelmState)
+        for field in self.__slots__:
+            object.__setattr__(state, field,
+                               changes.get(field, getattr(self, field)))
+        if 'current_key' in changes or 'current_key_mode' in changes:
+            state._derive()
+        return state
 
-    def update_chord_scale(self):
-        self.chord_scale = []
-        for i in range(self.current_key_mode, self.current_key_mode + 7):
-            self.chord_scale.append(self.diatonic[i % 7])
+    def diff(self, other):
+        # Field names which differ between this state and other.  Used to
+        # redraw only the controls showing something that changed.
+        if other is None:
+            return set(self.__slots__)
+        return {field for field in self.__slots__
+                if getattr(self, field) != getattr(other, field)}
 
     def rotate_key(self, add_by=0):
-        self.current_key += add_by
-        self.current_key = self.current_key % 12  # Rollover range 0-11
-        self.update_diatonic()
+        return self._replace(current_key=(self.current_key + add_by) % 12)
 
     def rotate_key_mode(self, add_by=0):
-        self.current_key_mode += add_by
-        self.current_key_mode = self.current_key_mode % 7
+        return self._replace(
+            current_key_mode=(self.current_key_mode + add_by) % 7)
 
     def rotate_chord(self, add_by=0, set_to=None):
-        self.current_chord_root += add_by
-
+        current_chord_root = self.current_chord_root + add_by
         if set_to is not None:
-            self.current_chord_root = set_to
+            current_chord_root = set_to
+        return self._replace(current_chord_root=current_chord_root % 12)
+
+    def note_on(self, notes):
+        return self._replace(notes_on=self.notes_on.union(notes))
+
+    def note_off(self, notes):
+        return self._replace(notes_on=self.notes_on.difference(notes))
+
+    def set_notes_on(self, notes):
+        return self._replace(notes_on=frozenset(notes))
+
+    def jump(self, current_key, current_key_mode, current_chord_root):
+        # Straight to another key, mode and chord, however far away
+        return self._replace(current_key=current_key % 12,
+                             current_key_mode=current_key_mode % 7,
+                             current_chord_root=current_chord_root % 12)
 
-        self.current_chord_root = self.current_chord_root % 12  # Rollover ...
+    def set_rotation_ring(self, rotation_ring):
+        return self._replace(rotation_ring=rotation_ring)
 
-        self.update_chord_scale()
+    def set_notes_latched(self, notes_latched):
+        return self._replace(notes_latched=notes_latched)
+
+    def set_rotate_offsets(self, rotate_offset=None,
+                           rotate_offset_chord=None):
+        changes = {}
+        if rotate_offset is not None:
+            changes['rotate_offset'] = rotate_offset
+        if rotate_offset_chord is not None:
+            changes['rotate_offset_chord'] = rotate_offset_chord
+        return self._replace(**changes)
 
     def calculate_chord(self, chord_def):
         chord = []
         for note in chord_def:
-            chord.append(self.chord_scale[chord_slices_dict[note]])
+            # Degrees past 7 land on the same slice as degree - 7
+            chord.append(self.chord_scale[chord_slices_dict[
+                (note - 1) % 7 + 1]])
         return chord
 
+    def chord_notes(self, chord_index, voicing_index):
+        # Note numbers for one of the chord_types in one of the voicings,
+        # from the prebuilt theory tables
+        return theory.lookup(self.current_key, self.current_key_mode,
+                             chord_index, voicing_index)
+
+
+class Key(object):
+    # Holds the current HelmState.  Everything that changes the instrument
+    # goes through here, swapping self.state for the next state.  Swapping
+    # a reference is atomic, so readers just grab self.state (or call
+    # snapshot()) and never need a lock.
+    def __init__(self):
+        self.state = HelmState()
+        self.notes = key_notes
+        self.key_scale_ordered = [0, 2, 4, 11, 1, 3, 5]
+
+    @property
+    def current_key(self):
+        return self.state.current_key
+
+    @property
+    def current_key_mode(self):
+        return self.state.current_key_mode
+
+    @property
+    def current_chord_root(self):
+        return self.state.current_chord_root
+
+    @property
+    def notes_on(self):
+        return self.state.notes_on
+
+    @property
+    def diatonic(self):
+        return self.state.diatonic
+
+    @property
+    def chord_scale(self):
+        return self.state.chord_scale
+
+    @property
+    def rotation_ring(self):
+        return self.state.rotation_ring
+
+    @property
+    def notes_latched(self):
+        return self.state.notes_latched
+
+    def rotate_key(self, add_by=0):
+        self.state = self.state.rotate_key(add_by)
+
+    def rotate_key_mode(self, add_by=0):
+        self.state = self.state.rotate_key_mode(add_by)
+
+    def rotate_chord(self, add_by=0, set_to=None):
+        self.state = self.state.rotate_chord(add_by, set_to)
+
+    def note_on(self, notes):
+        self.state = self.state.note_on(notes)
+
+    def note_off(self, notes):
+        self.state = self.state.note_off(notes)
+
+    def set_notes_on(self, notes):
+        self.state = self.state.set_notes_on(notes)
+
+    def set_rotation_ring(self, rotation_ring):
+        self.state = self.state.set_rotation_ring(rotation_ring)
+
+    def set_notes_latched(self, notes_latched):
+        self.state = self.state.set_notes_latched(notes_latched)
+
+    def set_rotate_offsets(self, rotate_offset=None,
+                           rotate_offset_chord=None):
+        self.state = self.state.set_rotate_offsets(rotate_offset,
+                                                   rotate_offset_chord)
+
+    def calculate_chord(self, chord_def):
+        return self.state.calculate_chord(chord_def)
+
+    def snapshot(self):
+        # States are immutable, so the current one is already a snapshot
+        return self.state
+
 
 key = Key()
 
@@ -143,11 +345,136 @@ chord_definitions = {'1': (1, ),
                      '4': (4, ),
                      '6': (6, )}
 
-# The main module handles input, but some of the other modules
-# may need to know some input states:
-rotation_ring = "mode"  # Which ring is under control: "key", "mode", "all"
+# Chord root positions around the circle, relative to the key, that the
+# mode ring can point at
+chord_positions = (0, 1, 2, 3, 4, 5, 11)
+
+
+def chord_transition(position, direction):
+    # Turning the mode ring one slice in direction (1 or -1) from chord
+    # root position.  Returns (mode delta, new position, angular delta).
+    # The pointer skips past the five non-diatonic slices (6 to 10) in one
+    # 150 degree jump.
+    position = (position + direction) % 12
+    angle = 0
+    if position == 6:
+        position = 11
+        angle = 150
+    if position == 10:
+        position = 5
+        angle = -150
+    return direction, position, angle
+
+
+# (position, direction) -> (mode delta, new position, angular delta), for
+# WheelControl.rotate_chord
+chord_transitions = {(position, direction):
+                     chord_transition(position, direction)
+                     for position in chord_positions
+                     for direction in (1, -1)}
+
+# Every chord the theory tables know how to play: the chord_definitions
+# shown on the ChordControl, plus sevenths, ninths, sixths and sus chords.
+# Degrees past 7 are compound intervals, an octave above degree - 7.
+chord_types = dict(chord_definitions)
+chord_types.update({'1, 3, 5, 7': (1, 3, 5, 7),
+                    '1, 3, 5, 7, 9': (1, 3, 5, 7, 9),
+                    '1, 3, 5, 9': (1, 3, 5, 9),
+                    '1, 3, 5, 6': (1, 3, 5, 6),
+                    '1, 2, 5': (1, 2, 5),
+                    '1, 4, 5': (1, 4, 5),
+                    '1, 4, 5, 7': (1, 4, 5, 7),
+                    '1, 5, 9': (1, 5, 9),
+                    '1, 3, 7, 11': (1, 3, 7, 11),
+                    '1, 3, 5, 7, 9, 13': (1, 3, 5, 7, 9, 13)})
+
+# How the notes of a chord are spread out:
+# octave - every note in the single octave starting at C (the original
+#          helm sound)
+# close  - root position, stacked upwards from the chord root
+# inv1, inv2, inv3 - close, with the lowest 1, 2 or 3 notes up an octave
+# drop2  - close, with the second highest note down an octave
+# spread - close, with every other note up an octave
+voicings = ('octave', 'close', 'inv1', 'inv2', 'inv3', 'drop2', 'spread')
+
+
+class TheoryTables(object):
+    # Every chord type in every voicing, for every key and mode, worked
+    # out once at startup and packed in to a flat array of note numbers.
+    # Triggering a chord is then a single index lookup, however complex
+    # the chord.
+    #
+    # Notes are semitones above the C of the lowest octave, Midi adds its
+    # own octave offset.  The chord root isn't a separate axis: the chord
+    # scale always starts on it, and that is set by the key and mode.
+    def __init__(self, chord_types=chord_types, voicings=voicings):
+        self.chord_index = {name: i for i, name in enumerate(chord_types)}
+        self.voicing_index = {name: i for i, name in enumerate(voicings)}
+        self.stride = max(len(chord_def)
+                          for chord_def in chord_types.values())
+        self.notes = array.array('B')
+        self.lengths = array.array('B')
+
+        for current_key in range(12):
+            for current_key_mode in range(7):
+                state = HelmState(current_key=current_key,
+                                  current_key_mode=current_key_mode)
+                for chord_def in chord_types.values():
+                    for voicing in voicings:
+                        chord = self.voice_chord(state, chord_def, voicing)
+                        self.lengths.append(len(chord))
+                        self.notes.extend(chord)
+                        self.notes.extend([0] * (self.stride - len(chord)))
+
+    def index(self, current_key, current_key_mode, chord_index,
+              voicing_index):
+        return (((current_key * 7 + current_key_mode)
+                 * len(self.chord_index) + chord_index)
+                * len(self.voicing_index) + voicing_index)
+
+    def lookup(self, current_key, current_key_mode, chord_index,
+               voicing_index):
+        i = self.index(current_key, current_key_mode, chord_index,
+                       voicing_index)
+        return self.notes[i * self.stride:i * self.stride + self.lengths[i]]
+
+    @staticmethod
+    def voice_chord(state, chord_def, voicing):
+        root = state.notes[state.chord_scale[0]]['kbNum']
+        pitches = []
+        for degree in chord_def:
+            pitch_class = state.notes[state.chord_scale[
+                chord_slices_dict[(degree - 1) % 7 + 1]]]['kbNum']
+            if voicing == 'octave':
+                pitches.append(pitch_class)
+            else:
+                pitches.append(root + (pitch_class - root) % 12 +
+                               12 * ((degree - 1) // 7))
+        pitches.sort()
+
+        if voicing in ('inv1', 'inv2', 'inv3'):
+            inversion = min(int(voicing[-1]), len(pitches) - 1)
+            pitches = pitches[inversion:] + \
+                [pitch + 12 for pitch in pitches[:inversion]]
+        if voicing == 'drop2' and len(pitches) >= 3:
+            pitches = [pitches[-2] - 12] + pitches[:-2] + pitches[-1:]
+            if pitches[0] < 0:
+                pitches = [pitch + 12 for pitch in pitches]
+        if voicing == 'spread':
+            pitches = [pitch + 12 * (i % 2)
+                       for i, pitch in enumerate(pitches)]
+        return sorted(pitches)
+
+
+# Built by Helm at startup, see TheoryTables
+theory = None
+
+# helm_presets.Preset from the config, in order
+presets = []
 
-notes_latched = False  # When true, don't stop notes on keyUps
+# Input states the other modules need to know about (which ring is under
+# control, whether notes are latched) live in key.state alongside the
+# rest of the instrument's state.
 
 # Define some colors for convenience and readability
 color_black = (0, 0, 0)
@@ -0,0 +1,150 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+# The instrument's state, shared with other local processes (lighting
+# cues, a second display) through a small memory-mapped file.
+#
+# The file has a fixed layout:
+#
+#   header: magic, layout version, seq
+#   state:  timestamp, key, mode, chord root, rotation ring, latched,
+#           notes_on mask, diatonic mask, rotate_offset, rotate_offset_chord
+#
+# The masks have bit n set for key.notes index n, i.e. slice n of the
+# wheel.
+#
+# seq is a seqlock.  There is one writer, helm's main loop, which makes
+# seq odd, writes the state, then makes it even again.  A reader copies
+# the state only when seq is even and the same before and after, so any
+# number of readers can poll as often as they like without ever making
+# the writer wait.
+
+header_format = '<4sIQ'
+header_size = struct.calcsize(header_format)
+state_format = '<dBBBBBxHHxxii'
+state_size = struct.calcsize(state_format)
+seq_offset = struct.calcsize('<4sI')
+magic = b'HLMS'
+layout_version = 1
+
+rotation_rings = ("mode", "key", "all")
+
+fields = ('timestamp', 'current_key', 'current_key_mode',
+          'current_chord_root', 'rotation_ring', 'notes_latched',
+          'notes_on', 'diatonic', 'rotate_offset', 'rotate_offset_chord')
+
+
+def default_path():
+    # Shared memory if the OS has it, otherwise the temp directory
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') \
+        else tempfile.gettempdir()
+    return os.path.join(directory, 'helm_state')
+
+
+def note_mask(notes):
+    mask = 0
+    for note in notes:
+        mask |= 1 << note
+    return mask
+
+
+def mask_notes(mask):
+    return frozenset(note for note in range(12) if mask & (1 << note))
+
+
+class StatePublisher(object):
+    # Writes each new HelmState in to the shared file.  Only ever call
+    # publish() from one thread.
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.seq = 0
+        size = header_size + state_size
+        with open(self.path, 'wb') as state_file:
+            state_file.truncate(size)
+        self.state_file = open(self.path, 'r+b')
+        self.shared = mmap.mmap(self.state_file.fileno(), size)
+        struct.pack_into(header_format, self.shared, 0, magic,
+                         layout_version, self.seq)
+
+    def publish(self, state):
+        # Odd while writing
+        self.seq += 1
+        struct.pack_into('<Q', self.shared, seq_offset, self.seq)
+        struct.pack_into(state_format, self.shared, header_size,
+                         time.time(),
+                         state.current_key,
+                         state.current_key_mode,
+                         state.current_chord_root,
+                         rotation_rings.index(state.rotation_ring),
+                         state.notes_latched,
+                         note_mask(state.notes_on),
+                         note_mask(state.diatonic),
+                         state.rotate_offset,
+                         state.rotate_offset_chord)
+        self.seq += 1
+        struct.pack_into('<Q', self.shared, seq_offset, self.seq)
+
+    def close(self):
+        self.shared.close()
+        self.state_file.close()
+
+
+class StateReader(object):
+    # Reads the latest state written by a StatePublisher, from any process
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.state_file = open(self.path, 'rb')
+        self.shared = mmap.mmap(self.state_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        file_magic, version, _ = struct.unpack_from(header_format,
+                                                    self.shared, 0)
+        if file_magic != magic or version != layout_version:
+            raise ValueError("Not a helm state file: " + self.path)
+
+    def seq(self):
+        # Changes whenever the state does, so a poller can cheaply tell
+        # if there's anything new.  Odd while a write is under way.
+        return struct.unpack_from('<Q', self.shared, seq_offset)[0]
+
+    def read(self, retries=100):
+        # (seq, dict of fields) for the latest whole state, or None if
+        # nothing has been published yet or the writer kept interrupting
+        for _ in range(retries):
+            seq = self.seq()
+            if seq == 0:
+                return None
+            if seq % 2:
+                continue
+            values = struct.unpack_from(state_format, self.shared,
+                                        header_size)
+            if self.seq() == seq:
+                state = dict(zip(fields, values))
+                state['rotation_ring'] = \
+                    rotation_rings[state['rotation_ring']]
+                state['notes_latched'] = bool(state['notes_latched'])
+                state['notes_on'] = mask_notes(state['notes_on'])
+                state['diatonic'] = mask_notes(state['diatonic'])
+                return seq, state
+        return None
+
+    def close(self):
+        self.shared.close()
+        self.state_file.close()
+
+
+if __name__ == "__main__":
+    # Print each state as it changes:
+    # python helm_ipc.py [state path]
+    reader = StateReader(sys.argv[1] if len(sys.argv) > 1 else None)
+    last_seq = None
+    while True:
+        if reader.seq() != last_seq:
+            latest = reader.read()
+            if latest:
+                last_seq, state = latest
+                print(state)
+        time.sleep(0.005)
@@ -0,0 +1,138 @@
+import json
+import os
+import helm_globals
+
+# helm was drawn up on a 1920x1080 canvas.  Every size and position below
+# is the 1920x1080 value, scaled to whatever canvas helm is running on.
+reference_width = 1920
+reference_height = 1080
+
+# Radii around the wheel, as pixels in from the wheel's edge at 1920x1080
+reference_wheel_r = 529
+reference_wheel_insets = {'rays': 0,  # "Key", "5ths >", "< 4ths"
+                          'slice_outline': 12,
+                          'key_labels': 56,
+                          'slice_fill': 70,
+                          'pointer': 126,
+                          'highlight': 160,
+                          'step_labels': 200,
+                          'triad_labels': 240,
+                          'mode_labels': 365}
+
+reference_chord_size = 768
+reference_font_sizes = {'small_bold': 24,
+                        'medium': 32,
+                        'medium_bold': 32,
+                        'x_large': 80}
+
+# Layouts worked out so far, by (canvas_width, canvas_height)
+layouts = {}
+
+
+class Layout(object):
+    # Every control's position, size, radii and font sizes for one canvas
+    # resolution.  Worked out once, so neither startup of the controls nor
+    # drawing a frame does any layout arithmetic.
+    fields = ('canvas_width', 'canvas_height',
+              'wheel_size', 'wheel_radii',
+              'chord_size', 'chord_height', 'chord_blit_x', 'chord_blit_y',
+              'chord_spacing_width', 'chord_line_spacing',
+              'chord_left_margin', 'chord_label_offset',
+              'font_sizes')
+
+    def __init__(self, canvas_width=reference_width,
+                 canvas_height=reference_height, **computed):
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        if computed:
+            # Loaded from a saved layout
+            for field in self.fields[2:]:
+                setattr(self, field, computed[field])
+        else:
+            self.compute()
+
+    def compute(self):
+        margin = helm_globals.canvas_margin
+
+        # The fourth/fifth wheel fills the height of the screen
+        self.wheel_size = int(self.canvas_height * 0.98)
+        wheel_r = int(self.wheel_size / 2)
+        wheel_scale = wheel_r / reference_wheel_r
+        self.wheel_radii = {
+            name: wheel_r - int(inset * wheel_scale)
+            for name, inset in reference_wheel_insets.items()}
+
+        # The chord control sits to the right of the wheel, using up to
+        # 40% of the width of the screen
+        self.chord_blit_x = self.wheel_size + (margin * 2) + \
+            int(22 * wheel_scale)
+        self.chord_blit_y = margin + int(30 * wheel_scale)
+        self.chord_size = max(1, min(
+            int(self.canvas_width * 0.40),
+            self.canvas_width - self.chord_blit_x - (margin * 2)))
+        chord_scale = self.chord_size / reference_chord_size
+        self.chord_height = int(600 * chord_scale)
+        self.chord_spacing_width = max(1, int(44 * chord_scale))
+        self.chord_line_spacing = int(60 * chord_scale)
+        self.chord_left_margin = int(226 * chord_scale)
+        self.chord_label_offset = int(168 * chord_scale)
+
+        font_scale = min(wheel_scale, chord_scale)
+        self.font_sizes = {name: max(6, int(size * font_scale))
+                           for name, size in reference_font_sizes.items()}
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def save(self, path):
+        # Add this layout to a JSON file of layouts keyed by resolution.  A
+        # file which can't be read is started afresh, and one which can't
+        # be written is left as it is.
+        saved = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as layout_file:
+                    saved = json.load(layout_file)
+            except (OSError, ValueError):
+                pass
+            if not isinstance(saved, dict):
+                saved = {}
+        saved[resolution_name(self.canvas_width, self.canvas_height)] = \
+            self.to_dict()
+        try:
+            with open(path, "w") as layout_file:
+                json.dump(saved, layout_file, indent=2, sort_keys=True)
+        except OSError as error:
+            print("Could not save the layout cache:", error)
+
+
+def resolution_name(canvas_width, canvas_height):
+    return "{}x{}".format(canvas_width, canvas_height)
+
+
+def layout_for(canvas_width, canvas_height, cache_file=None):
+    # The Layout for this resolution.  Each resolution is only worked out
+    # once per run.  With a cache_file, layouts are read from it if saved
+    # there before, and saved to it otherwise.
+    resolution = (canvas_width, canvas_height)
+    if resolution in layouts:
+        return layouts[resolution]
+
+    layout = None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as layout_file:
+                saved = json.load(layout_file)
+            computed = saved.get(resolution_name(*resolution))
+            if computed:
+                layout = Layout(**computed)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            print("Layout cache error.  Recomputing layout")
+
+    if layout is None:
+        layout = Layout(*resolution)
+        if cache_file:
+            layout.save(cache_file)
+
+    layouts[resolution] = layout
+    return layout
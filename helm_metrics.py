@@ -0,0 +1,215 @@
+import http.server
+import os
+import socketserver
+import threading
+
+# Metrics about a running helm, served in the Prometheus text format.
+#
+# Updating a metric is a plain attribute or dict update with no locks,
+# so the main loop, the render thread and the MIDI clock thread never
+# wait on a scrape.  Counters keep a running total per thread, so any
+# number of threads can count.  Gauges and histograms each have a
+# single writing thread.  A scrape reads whatever values are there at
+# that moment.
+
+registry = []
+
+
+class Counter(object):
+    __slots__ = ('name', 'help', 'values')
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}  # thread ident -> that thread's total
+
+    def inc(self, amount=1):
+        ident = threading.get_ident()
+        self.values[ident] = self.values.get(ident, 0) + amount
+
+    @property
+    def value(self):
+        # list() copies the values in one step, even if another thread
+        # adds itself meanwhile
+        return sum(list(self.values.values()))
+
+    def exposition(self):
+        return ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} counter".format(self.name),
+                "{} {}".format(self.name, self.value)]
+
+
+class Gauge(object):
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def exposition(self):
+        return ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, self.value)]
+
+
+class Histogram(object):
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def exposition(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                self.name, bucket, cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name,
+                                                        self.count))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+
+def counter(name, help_text):
+    metric = Counter(name, help_text)
+    registry.append(metric)
+    return metric
+
+
+def gauge(name, help_text):
+    metric = Gauge(name, help_text)
+    registry.append(metric)
+    return metric
+
+
+def histogram(name, help_text, buckets):
+    metric = Histogram(name, help_text, buckets)
+    registry.append(metric)
+    return metric
+
+
+def exposition():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.exposition())
+    return "\n".join(lines) + "\n"
+
+
+# Seconds, around a 60 fps frame
+frame_buckets = (0.001, 0.002, 0.005, 0.010, 0.0167, 0.025, 0.050, 0.100,
+                 0.250, 1.0)
+
+frame_seconds = histogram('helm_frame_seconds',
+                          'Time to draw and present a frame',
+                          frame_buckets)
+loop_seconds = histogram('helm_loop_seconds',
+                         'Time spent on input, controls and MIDI per loop',
+                         frame_buckets)
+frames_superseded = counter('helm_frames_superseded_total',
+                            'Frames replaced by a newer one before drawing')
+redraws_deferred = counter('helm_redraws_deferred_total',
+                           'Control redraws put off by the frame scheduler')
+events_per_loop = gauge('helm_events_queued',
+                        'Input events handled in the latest loop')
+events_total = counter('helm_events_total', 'Input events handled')
+notes_fired = counter('helm_notes_fired_total',
+                      'Note on and off messages sent')
+notes_dropped = counter('helm_notes_dropped_total',
+                        'Note messages which could not be sent')
+arp_notes_fired = counter('helm_arp_notes_fired_total',
+                          'Note messages sent by the arpeggiator')
+clock_forwarded = counter('helm_clock_forwarded_total',
+                          'Messages forwarded from the clock inport')
+dispatch_error = histogram('helm_midi_dispatch_error_seconds',
+                           'How far off time scheduled MIDI went out',
+                           (0.00005, 0.0001, 0.0002, 0.0005, 0.001,
+                            0.002, 0.005, 0.010))
+gc_collections = counter('helm_gc_collections_total',
+                         'Garbage collections run in performance mode')
+pacing_active = gauge('helm_pacing_active',
+                      '1 while running at the active frame rate, 0 idle')
+cpu_fraction = gauge('helm_cpu_fraction',
+                     'CPU seconds per second at the current pacing')
+wakeups_saved = gauge('helm_wakeups_saved',
+                      'Loops not run against a fixed 60 fps loop')
+power_watts = gauge('helm_power_watts',
+                    'Power drawn from the battery, where it says')
+glyph_hits = counter('helm_glyph_cache_hits_total',
+                     'Labels drawn from the glyph cache')
+glyph_misses = counter('helm_glyph_cache_misses_total',
+                       'Labels rendered and rotated')
+shape_hits = counter('helm_shape_cache_hits_total',
+                     'Wheel shapes drawn from the geometry cache')
+shape_misses = counter('helm_shape_cache_misses_total',
+                       'Wheel shapes worked out for a new angle')
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Scrapes would otherwise print a line each
+        pass
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix sockets have no client address, but the HTTP handler
+        # expects a (host, port)
+        request, _ = super(UnixMetricsServer, self).get_request()
+        return request, ("local", 0)
+
+
+class MetricsServer(object):
+    # Serves exposition() over HTTP, on localhost:port or a Unix socket
+    def __init__(self, port=9464, socket_path=None):
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.server = UnixMetricsServer(socket_path, MetricsHandler)
+        else:
+            self.server = http.server.ThreadingHTTPServer(
+                ("127.0.0.1", port), MetricsHandler)
+            self.server.daemon_threads = True
+        self.socket_path = socket_path
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="helm-metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
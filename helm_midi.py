@@ -1,5 +1,292 @@
+import collections
+import os
+import threading
+import time
 import mido
 import helm_globals
+import helm_events
+import helm_metrics
+import helm_schedule
+
+
+class VoiceAllocator(object):
+    # Tracks which source (a chord key, a pad, the latch, ...) is holding
+    # which MIDI note numbers.
+    #
+    # A note is reference counted by its holders: it sounds when the first
+    # source presses it and only stops when the last one lets go, so two
+    # chords sharing notes don't churn off/on messages and overlapping keys
+    # can't leave a note hanging.  Releases can be delayed (timed release)
+    # or held back by sustain.
+    #
+    # This class only does the bookkeeping.  Every method returns the MIDI
+    # note numbers which need an on or off message, and Midi sends them.
+    def __init__(self):
+        self.holders = {}  # midi note -> set of sources holding it
+        self.held = {}  # source -> set of midi notes it holds
+        self.sustain = False
+        self.sustained = set()  # Released while sustain was down
+        self.pending_releases = {}  # source -> time.monotonic() to release
+
+    def sounding(self):
+        # Every note which currently has an on without a matching off
+        return self.sustained.union(self.holders)
+
+    def press(self, source, notes):
+        # source now holds exactly notes.  Returns (notes_on, notes_off).
+        # Anything source held before but isn't part of notes is released.
+        self.pending_releases.pop(source, None)
+        sounding_before = self.sounding()
+        notes = set(notes)
+        held = self.held.get(source, set())
+        notes_off = self._release_notes(source, held.difference(notes))
+        for note in notes:
+            self.holders.setdefault(note, set()).add(source)
+        self.held[source] = notes
+        notes_on = sorted(notes.difference(sounding_before))
+        return notes_on, notes_off
+
+    def release(self, source, delay=0, now=None):
+        # Let go of everything source holds.  Returns notes_off.
+        # With a delay, the release is scheduled instead and picked up by
+        # due() once the time has passed.
+        if delay > 0:
+            if now is None:
+                now = time.monotonic()
+            if source in self.held:
+                self.pending_releases[source] = now + delay
+            return []
+        self.pending_releases.pop(source, None)
+        return self._release_notes(source, self.held.pop(source, set()))
+
+    def due(self, now=None):
+        # Perform any timed releases whose time has come.  Returns notes_off
+        if not self.pending_releases:
+            return []
+        if now is None:
+            now = time.monotonic()
+        notes_off = []
+        for source in [source for source, release_at
+                       in self.pending_releases.items() if release_at <= now]:
+            notes_off.extend(self.release(source))
+        return notes_off
+
+    def next_release(self):
+        # time.monotonic() of the soonest timed release, or None
+        if not self.pending_releases:
+            return None
+        return min(self.pending_releases.values())
+
+    def set_sustain(self, sustain):
+        # Releases are held back while sustain is down.  Lifting it returns
+        # the notes nobody is holding any more.
+        self.sustain = sustain
+        if sustain:
+            return []
+        notes_off = sorted(self.sustained.difference(self.holders))
+        self.sustained = set()
+        return notes_off
+
+    def hand_over(self, source):
+        # Move every held note over to source, e.g. when latching.
+        # Nothing starts or stops sounding.
+        self.pending_releases = {}
+        notes = self.sounding()
+        self.holders = {note: {source} for note in notes}
+        self.held = {source: notes} if notes else {}
+        self.sustained = set()
+
+    def release_all(self):
+        # Panic: forget every holder.  Returns every sounding note
+        notes_off = sorted(self.sounding())
+        self.holders = {}
+        self.held = {}
+        self.sustained = set()
+        self.pending_releases = {}
+        return notes_off
+
+    def _release_notes(self, source, notes):
+        notes_off = []
+        for note in notes:
+            holders = self.holders.get(note)
+            if holders is None:
+                continue
+            holders.discard(source)
+            if not holders:
+                del self.holders[note]
+                if self.sustain:
+                    self.sustained.add(note)
+                else:
+                    notes_off.append(note)
+        if source in self.held:
+            self.held[source].difference_update(notes)
+        return sorted(notes_off)
+
+
+class Arpeggiator(object):
+    # Plays the held chord one step at a time, in time with an external
+    # MIDI clock.
+    #
+    # tick() is called for each clock message (24 per quarter note) from
+    # the clock port's own thread, so the timing follows the external tempo
+    # and not the frame rate of the main loop.  The main loop only swaps in
+    # the chord to play with hold() / release().
+    #
+    # pattern is one of "up", "down", "updown", or "chord" (step the
+    # whole chord, like a step sequencer).  division is steps per whole
+    # note: 4 = quarter notes, 16 = sixteenths, 12 = eighth note triplets.
+    # gate is how much of each step a note sounds for.
+    def __init__(self, division=16, pattern="up", gate=0.5):
+        self.ticks_per_step = max(1, 96 // division)  # 24 PPQN * 4
+        self.gate_ticks = max(1, int(self.ticks_per_step * gate))
+        self.pattern = pattern
+
+        self.held = {}  # source -> midi notes, main loop only
+        # The notes being arpeggiated.  Replaced, never modified, so the
+        # clock thread always reads a complete chord.
+        self.chord = ()
+
+        # Clock thread state
+        self.lock = threading.Lock()
+        self.tick_count = 0
+        self.step = 0
+        self.sounding = ()
+
+    def hold(self, source, notes):
+        self.held[source] = tuple(notes)
+        self.chord = tuple(sorted(set().union(*self.held.values())))
+
+    def release(self, source):
+        self.held.pop(source, None)
+        self.chord = tuple(sorted(set().union(*self.held.values())))
+
+    def hand_over(self, source):
+        # Everything held so far is held by source instead, as
+        # VoiceAllocator.hand_over().  The chord itself doesn't change.
+        self.held = {source: self.chord} if self.chord else {}
+
+    def start(self):
+        # MIDI start: begin again from the top of the bar
+        with self.lock:
+            self.tick_count = 0
+            self.step = 0
+
+    def stop(self):
+        # Returns the notes to turn off
+        with self.lock:
+            notes_off = list(self.sounding)
+            self.sounding = ()
+        return notes_off
+
+    def tick(self):
+        # One MIDI clock.  Returns (notes_on, notes_off)
+        with self.lock:
+            notes_on = []
+            notes_off = []
+            position = self.tick_count % self.ticks_per_step
+            self.tick_count += 1
+
+            if position == 0:
+                notes_off.extend(self.sounding)
+                self.sounding = self.next_notes(self.chord)
+                notes_on.extend(self.sounding)
+            elif position == self.gate_ticks:
+                notes_off.extend(self.sounding)
+                self.sounding = ()
+            return notes_on, notes_off
+
+    def next_notes(self, chord):
+        if not chord:
+            return ()
+        if self.pattern == "chord":
+            sequence = (chord, )
+        elif self.pattern == "down":
+            sequence = chord[::-1]
+        elif self.pattern == "updown":
+            sequence = chord + chord[-2:0:-1]
+        else:
+            sequence = chord
+        notes = sequence[self.step % len(sequence)]
+        self.step += 1
+        if self.pattern == "chord":
+            return notes
+        return (notes, )
+
+
+# Status bytes of the channel messages helm sends, before the channel
+note_status = {'note_on': 0x90, 'note_off': 0x80}
+
+
+class MidoOutput(object):
+    # The default output: a mido port, with a mido.Message built and
+    # checked for every note.  Works everywhere mido does.
+    def __init__(self, port):
+        self.port = port
+
+    def send(self, msg):
+        # A mido message, e.g. forwarded from the clock inport
+        self.port.send(msg)
+
+    def send_note(self, mido_message, channel, midi_note, velocity):
+        self.port.send(mido.Message(mido_message, channel=channel,
+                                    note=midi_note, velocity=velocity))
+
+    def close(self):
+        self.port.close()
+
+
+class RtmidiOutput(object):
+    # Straight to python-rtmidi with raw bytes, skipping mido's Message
+    # objects and their validation.  name is the same port name mido
+    # shows, as mido's own rtmidi backend takes its names from here.  A
+    # virtual port is made with that name instead, for others to find.
+    def __init__(self, name, virtual=False):
+        # Import here, as python-rtmidi is only needed for this backend
+        import rtmidi
+        self.port = rtmidi.MidiOut()
+        if virtual:
+            self.port.open_virtual_port(name)
+        else:
+            self.port.open_port(self.port.get_ports().index(name))
+
+    def send(self, msg):
+        self.port.send_message(msg.bytes())
+
+    def send_note(self, mido_message, channel, midi_note, velocity):
+        self.port.send_message((note_status[mido_message] | channel,
+                                midi_note, velocity))
+
+    def close(self):
+        self.port.close_port()
+
+
+class RawMidiOutput(object):
+    # Writes raw bytes to an ALSA rawmidi device file, such as
+    # /dev/snd/midiC1D0.  Linux only, with nothing between helm and the
+    # driver but a write().
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY)
+
+    def send(self, msg):
+        os.write(self.fd, bytes(msg.bytes()))
+
+    def send_note(self, mido_message, channel, midi_note, velocity):
+        os.write(self.fd, bytes((note_status[mido_message] | channel,
+                                 midi_note, velocity)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_output(name, backend="mido", device=None):
+    # One of the outputs above, by helm_globals.midi_backend name
+    if backend == "rtmidi":
+        return RtmidiOutput(name)
+    if backend == "rawmidi":
+        if device:
+            return RawMidiOutput(device)
+        print("The rawmidi backend needs a midi_device, using mido")
+    return MidoOutput(mido.open_output(name, autoreset=True))
 
 
 class Midi(object):
@@ -10,84 +297,352 @@ class Midi(object):
 
         self.channel = 0
 
+        # Controller messages queued by the inport callback thread, when
+        # midi_input_callback is on
+        self.inport_pending = collections.deque()
+        # True while controller messages arrive in inport_pending rather
+        # than being polled from the inport
+        self.controls_queued = helm_globals.midi_input_callback
+        # True once listen() has put every port on a callback
+        self.listening = False
+        # Called from mido's thread as each queued controller message
+        # arrives, e.g. helm_pacing.wake() to end an idle wait
+        self.notify = None
+
+        # Clock messages are taken on the clock port's own thread, see
+        # clock_message(), so neither the frame rate nor idle pacing can
+        # hold them up.  Ports set up any other way are polled by
+        # forward_messages().
+        self.clock_callback = helm_globals.using_midi_clock
+
+        # Controller pad note numbers -> helm_events chord sources
+        self.pad_sources = dict(zip(helm_globals.midi_pads,
+                                    helm_events.chord_sources))
+
         if helm_globals.using_midi:
             print("Inports:")
             print(mido.get_output_names())  # To list the output ports
             print("Outports:")
             print(mido.get_input_names())  # To list the input ports
-            self.inport = mido.open_input(self.inport_name, autoreset=True)
-            self.outport = mido.open_output(self.outport_name, autoreset=True)
+            if helm_globals.midi_input_callback:
+                # mido's own thread receives and queues the messages,
+                # poll_controls() only has to drain the queue
+                self.inport = mido.open_input(
+                    self.inport_name, autoreset=True,
+                    callback=self.control_received)
+            else:
+                self.inport = mido.open_input(self.inport_name,
+                                              autoreset=True)
+            self.outport = open_output(self.outport_name,
+                                       backend=helm_globals.midi_backend,
+                                       device=helm_globals.midi_device)
             if helm_globals.using_midi_clock:
-                self.inport_clock = \
-                    mido.open_input(self.inport_clock_name, autoreset=True)
+                # The forwarded clock, the arpeggiator and quantizing all
+                # keep time with the clock itself, so take every message
+                # on mido's thread as soon as it arrives
+                self.inport_clock = mido.open_input(
+                    self.inport_clock_name, autoreset=True,
+                    callback=self.clock_message)
         self.octave = 2
 
         # c0 = 24
         self.c0_offset = 24
 
-        # Prior fired notes, help send offs to prior selected notes when
-        # the keys have been held
-        self.notes_prior = []
+        # Reference counted notes per source.  Replaces tracking prior
+        # fired notes: a source's release turns off whatever it is holding,
+        # even if the key has been rotated since the notes started.
+        self.voices = VoiceAllocator()
+
+        # Seconds to hold on to notes after their key is released
+        self.release_time = helm_globals.release_time
+
+        # Which of helm_globals.voicings chord_trigger() plays
+        self.voicing_index = helm_globals.voicings.index(helm_globals.voicing)
 
-        # Store prior latched notes so we can turn them off when starting
-        # a new chord
-        self.notes_latched = []
+        # Called on the clock port's callback thread before each message,
+        # e.g. a helm_realtime.MidiThreadSetup in performance mode
+        self.clock_thread_setup = None
+
+        # When on, chords are arpeggiated against the MIDI clock rather
+        # than played straight
+        self.arpeggiator = None
+        if helm_globals.using_arpeggiator:
+            self.arpeggiator = Arpeggiator(
+                division=helm_globals.arp_division,
+                pattern=helm_globals.arp_pattern,
+                gate=helm_globals.arp_gate)
+
+        # Notes played from the main loop go out on time rather than
+        # straight away, when quantizing or making up for latency.  See
+        # helm_schedule.
+        self.grid = helm_schedule.ClockGrid(tempo=helm_globals.tempo)
+        self.ticks_per_step = 0
+        if helm_globals.midi_quantize:
+            self.ticks_per_step = max(1, 96 // helm_globals.midi_quantize)
+        self.scheduler = None
+        if helm_globals.midi_quantize or helm_globals.midi_latency:
+            self.scheduler = helm_schedule.NoteScheduler(
+                self.deliver, lookahead=helm_globals.midi_latency)
+            if helm_globals.using_midi:
+                self.scheduler.latency[self.outport] = \
+                    helm_globals.midi_latency
 
     def forward_messages(self):
-        # Hacky POC at routing messages received at inport_clock interface
-        for msg in self.inport_clock:
-            self.outport.send(msg)
+        # Route messages received at the inport_clock interface, if it's
+        # polled.  Usually they arrive through clock_message() on the
+        # clock port's own thread already.
+        if self.clock_callback:
+            return
+        for msg in self.inport_clock.iter_pending():
+            self.clock_message(msg)
+
+    def clock_message(self, msg):
+        if msg.type == "clock":
+            self.grid.tick()
+        elif msg.type == "start":
+            self.grid.start()
+        if self.clock_thread_setup:
+            self.clock_thread_setup()
+        self.outport.send(msg)
+        helm_metrics.clock_forwarded.inc()
+        if not self.arpeggiator:
+            return
+        if msg.type == "clock":
+            notes_on, notes_off = self.arpeggiator.tick()
+            for midi_note in notes_off:
+                self.send_note("note_off", midi_note, 0)
+            for midi_note in notes_on:
+                self.send_note("note_on", midi_note, 100)
+            helm_metrics.arp_notes_fired.inc(len(notes_on) + len(notes_off))
+        elif msg.type == "start":
+            self.arpeggiator.start()
+        elif msg.type == "stop":
+            for midi_note in self.arpeggiator.stop():
+                self.send_note("note_off", midi_note, 0)
+
+    def poll_controls(self, events):
+        # Drain every controller message received since the last loop, in
+        # one batch, and add the matching events
+        if self.controls_queued:
+            while self.inport_pending:
+                self.control_message(events, self.inport_pending.popleft())
+        else:
+            for msg in self.inport.iter_pending():
+                self.control_message(events, msg)
+
+    def control_received(self, msg):
+        # On mido's thread: queue a controller message for poll_controls()
+        self.inport_pending.append(msg)
+        if self.notify:
+            self.notify()
+
+    def listen(self, notify):
+        # Switch the open ports over to mido's callback threads, for the
+        # asyncio runtime.  Controller messages are queued for
+        # poll_controls() and notify() is called, from mido's thread, as
+        # each one arrives.  Clock messages are forwarded straight away.
+        self.notify = notify
+        if not helm_globals.using_midi:
+            return
+
+        self.inport.callback = self.control_received
+        self.controls_queued = True
+        if helm_globals.using_midi_clock:
+            self.inport_clock.callback = self.clock_message
+            self.clock_callback = True
+        self.listening = True
+
+    def control_message(self, events, msg):
+        # Pads behave like the chord keys, the encoder like the Powermate
+        if msg.type in ("note_on", "note_off") and \
+                msg.note in self.pad_sources:
+            start = msg.type == "note_on" and msg.velocity > 0
+            if not helm_globals.key.notes_latched:
+                helm_events.chord_event(events, self.pad_sources[msg.note],
+                                        start=start)
+            elif not start:
+                helm_events.latch_event(events)
+
+        if msg.type == "control_change":
+            if msg.control == helm_globals.midi_encoder_cc:
+                # Relative encoder: 1-63 clockwise, 65-127 counterclockwise,
+                # by that many detents
+                if 0 < msg.value < 64:
+                    helm_events.knob_event(events, 1, msg.value)
+                if msg.value > 64:
+                    helm_events.knob_event(events, -1, 128 - msg.value)
+            if msg.control == helm_globals.midi_sustain_cc:
+                self.sustain(msg.value >= 64)
+
+        if msg.type == "program_change":
+            helm_events.recall_event(events, msg.program)
 
     def latch(self):
-        if helm_globals.notes_latched:
-            for note in helm_globals.key.notes_on:
-                print("latched:", note)
-                self.notes_latched.append(note)
+        # Everything sounding now keeps sounding until the next chord starts
+        if self.arpeggiator:
+            print("latched:", list(self.arpeggiator.chord))
+            self.arpeggiator.hand_over('latched')
+            return
+        print("latched:", sorted(self.voices.sounding()))
+        self.voices.hand_over('latched')
+
+    def midi_note(self, note):
+        # Calculate 'real' midi note number by adding c0 offset,
+        # octave offset, and using 'kbNum' entry in key.notes
+        return helm_globals.key.notes[note]['kbNum'] + \
+            self.c0_offset + (12 * self.octave)
+
+    def voice_on(self, source, midi_notes):
+        # source starts holding midi_notes
+        notes_on, notes_off = self.voices.press(source, midi_notes)
+        if 'latched' in self.voices.held:
+            # A new chord unlatches the old one.  Notes shared by both keep
+            # sounding rather than being re-triggered.
+            print("unlatching:", sorted(self.voices.held['latched']))
+            notes_off.extend(self.voices.release('latched'))
+        self.send_notes(notes_on, notes_off)
+
+    def voice_off(self, source):
+        # source lets go of whatever it holds
+        self.send_notes((), self.voices.release(source,
+                                                delay=self.release_time))
 
-    def notes_trigger(self, mode="off", notes=None):
+    def sustain(self, sustain):
+        self.send_notes((), self.voices.set_sustain(sustain))
+
+    def update(self):
+        # Called once per loop to perform any timed releases that are due
+        notes_off = self.voices.due()
+        if notes_off:
+            self.send_notes((), notes_off)
+
+    def all_notes_off(self):
+        self.send_notes((), self.voices.release_all())
+        if self.arpeggiator:
+            for midi_note in self.arpeggiator.stop():
+                self.send_note("note_off", midi_note, 0)
+
+    def notes_trigger(self, mode="off", notes=None, source=None):
         # Notes is arriving as form of key.notes index list
-        print("mode:", mode, "notes:", notes)
+        if helm_globals.midi_debug:
+            print("mode:", mode, "notes:", notes, "source:", source)
 
-        if (mode == "on") and len(self.notes_latched) > 0:
-            self.notes_trigger(mode="off", notes=self.notes_latched)
-            print("unlatching:", self.notes_latched)
-            self.notes_latched = []
+        if source is None:
+            # No source to hold them, so each note holds itself
+            for note in notes:
+                self.notes_trigger(mode=mode, notes=(note, ),
+                                   source=('note', note))
+            return
 
-        for note in notes:
-            # Calculate 'real' midi note number by adding c0 offset,
-            # octave offset, and using 'kbNum' entry in key.notes
-            midi_note = helm_globals.key.notes[note]['kbNum'] + \
-                        self.c0_offset + (12 * self.octave)
-            print("  -midi_note:", midi_note)
-            mido_message = "note_off"
-            velocity = 0
-            if mode == "on":
-                mido_message = "note_on"
-                velocity = 100
+        self.midi_notes_trigger(mode, [self.midi_note(note)
+                                       for note in notes], source)
 
-            # Assume there is no action to be taken
-            fire = False
+    def chord_trigger(self, mode, chord, source):
+        # Start or stop one of the helm_globals.chord_types, voiced with
+        # this Midi's voicing.  The notes come straight out of the theory
+        # tables, a single lookup.
+        if helm_globals.midi_debug:
+            print("mode:", mode, "chord:", chord, "source:", source)
+        midi_notes = ()
+        if mode == "on":
+            midi_notes = self.chord_midi_notes(chord)
+        self.midi_notes_trigger(mode, midi_notes, source)
+
+    def chord_midi_notes(self, chord):
+        # MIDI note numbers of one of the chord_types in the current key
+        # and mode, at this Midi's octave and voicing
+        base = self.c0_offset + (12 * self.octave)
+        return [base + note for note in
+                helm_globals.key.state.chord_notes(
+                    helm_globals.theory.chord_index[chord],
+                    self.voicing_index)]
+
+    def recall(self, octave=None, chord=None):
+        # A preset's octave and latched chord, in the key and mode already
+        # recalled.  Everything latched before is let go of, except notes
+        # the new chord shares, in one batch of messages.
+        if octave is not None:
+            self.octave = octave
+        if helm_globals.midi_debug:
+            print("recall: octave", self.octave, "latched:", chord)
+        if self.arpeggiator:
+            if chord:
+                self.midi_notes_trigger("on", self.chord_midi_notes(chord),
+                                        'latched')
+            else:
+                self.midi_notes_trigger("off", (), 'latched')
+            return
+        if chord:
+            notes_on, notes_off = self.voices.press(
+                'latched', self.chord_midi_notes(chord))
+        else:
+            notes_on, notes_off = (), self.voices.release('latched')
+        self.send_notes(notes_on, notes_off)
+
+    def midi_notes_trigger(self, mode, midi_notes, source):
+        if self.arpeggiator:
+            # The clock thread plays them, just show what's held
+            if mode == "on":
+                if source != 'latched':
+                    # A new chord unlatches the old one, as in voice_on()
+                    self.arpeggiator.release('latched')
+                self.arpeggiator.hold(source, midi_notes)
+            else:
+                self.arpeggiator.release(source)
+            helm_globals.key.set_notes_on(
+                (midi_note % 12) * 7 % 12
+                for midi_note in self.arpeggiator.chord)
+            return
 
-            # Send a MIDI message if the mode is "on" and this
-            # note isn't already currently playing:
-            if (mode == "on") and note not in helm_globals.key.notes_on:
-                fire = True
-                helm_globals.key.notes_on.append(note)
+        if mode == "on":
+            self.voice_on(source, midi_notes)
+        else:
+            self.voice_off(source)
 
-            # Send a MIDI message if the mode is "off" and this
-            # note is already currently playing:
-            if (mode == "off") and note in helm_globals.key.notes_on:
-                fire = True
-                helm_globals.key.notes_on.remove(note)
+    def note_time(self):
+        # When notes played now should sound: lookahead from now, on the
+        # next quantize step
+        at = time.perf_counter() + self.scheduler.lookahead
+        if self.ticks_per_step:
+            at = self.grid.step_time(at, self.ticks_per_step)
+        return at
 
-            if fire:
-                print("***** FIRED MESSAGE OVER MIDI *****")
-                if helm_globals.using_midi:
-                    msg = mido.Message(mido_message,
-                                       channel=self.channel,
-                                       note=midi_note,
-                                       velocity=velocity)  # 1 - 127
-                    self.outport.send(msg)
+    def send_notes(self, notes_on, notes_off):
+        at = None
+        if self.scheduler:
+            at = self.note_time()
+        for midi_note in notes_off:
+            self.send_note("note_off", midi_note, 0, at)
+        for midi_note in notes_on:
+            self.send_note("note_on", midi_note, 100, at)  # 1 - 127
+        helm_metrics.notes_fired.inc(len(notes_on) + len(notes_off))
 
+        if notes_on or notes_off:
+            # Show the sounding notes on the wheel, as key.notes indices.
+            # Circle of fifths position is the pitch class times 7, mod 12
+            helm_globals.key.set_notes_on(
+                (midi_note % 12) * 7 % 12
+                for midi_note in self.voices.sounding())
 
+    def send_note(self, mido_message, midi_note, velocity, at=None):
+        # at is the time.perf_counter() to play it at, or None for now
+        if helm_globals.midi_debug:
+            print("***** FIRED MESSAGE OVER MIDI *****", mido_message,
+                  midi_note)
+        if not helm_globals.using_midi:
+            return
+        if at is not None:
+            self.scheduler.schedule(at, self.outport, mido_message,
+                                    midi_note, velocity)
+        else:
+            self.deliver(self.outport, mido_message, midi_note, velocity)
 
+    def deliver(self, output, mido_message, midi_note, velocity):
+        # Send a note message now, from whichever thread
+        try:
+            output.send_note(mido_message, self.channel, midi_note,
+                             velocity)
+        except (IOError, OSError) as error:
+            # e.g. the device went away mid-set.  Keep playing.
+            helm_metrics.notes_dropped.inc()
+            print("MIDI send failed:", error)
@@ -0,0 +1,240 @@
+import glob
+import os
+import time
+import pygame
+import helm_metrics
+
+# Adaptive frame pacing, so that helm only wakes as often as there's
+# something to do.
+#
+# While the wheel is animating, a redraw is deferred or input is coming
+# in, the loop runs at active_fps: the display's refresh rate, unless
+# max_fps says otherwise.  Once everything has been still for linger
+# seconds it drops to idle_fps, waiting in pygame.event.wait() so any
+# key, mouse or touch event wakes it straight away.  Input read on other
+# threads, the Powermate and MIDI controls on callbacks, wakes it with
+# wake().  idle_fps = 0 sleeps until the next event.  Polled MIDI
+# controls can't wake anything, so with those the loop never idles.  The
+# MIDI clock is forwarded on mido's thread, so pacing never holds it up.
+#
+# The pacer keeps account of the wall and CPU time spent each way, and
+# the power drawn where the battery reports it, for summary() and
+# helm_metrics.  CPU time is as measured by time.process_time(), so it
+# includes any render thread.
+
+# What a plain pygame.time.Clock loop would run at, to count against
+fixed_fps = 60
+
+# How often power readings are taken, in seconds
+power_interval = 1.0
+
+# Posted by wake(), for nothing but ending an idle wait
+wake_event = pygame.event.custom_type()
+
+
+def wake():
+    # Wake an idle loop for input which came in on another thread.  Safe
+    # from any thread, and harmless once pygame has quit.
+    try:
+        pygame.event.post(pygame.event.Event(wake_event))
+    except pygame.error:
+        pass
+
+
+def display_refresh_rate(default=60):
+    # The desktop's refresh rate, where this pygame can tell
+    refresh_rates = getattr(pygame.display, 'get_desktop_refresh_rates',
+                            None)
+    if refresh_rates:
+        try:
+            rates = [rate for rate in refresh_rates() if rate > 0]
+        except pygame.error:
+            rates = []
+        if rates:
+            return rates[0]
+    return default
+
+
+class PowerMeter(object):
+    # Reads the power drawn from the battery, in watts, from Linux's
+    # power_supply class.  available is False on mains power, or where
+    # there's no battery to ask.
+    def __init__(self, supply_path='/sys/class/power_supply'):
+        self.power_now = None
+        self.current_now = None
+        self.voltage_now = None
+        for battery in sorted(glob.glob(os.path.join(supply_path,
+                                                     'BAT*'))):
+            power_now = os.path.join(battery, 'power_now')
+            current_now = os.path.join(battery, 'current_now')
+            if os.path.exists(power_now):
+                self.power_now = power_now
+                break
+            if os.path.exists(current_now):
+                self.current_now = current_now
+                self.voltage_now = os.path.join(battery, 'voltage_now')
+                break
+
+    @property
+    def available(self):
+        return self.power_now is not None or self.current_now is not None
+
+    def watts(self):
+        # None if there's no reading
+        try:
+            if self.power_now:
+                return read_number(self.power_now) / 1e6
+            if self.current_now:
+                return read_number(self.current_now) * \
+                    read_number(self.voltage_now) / 1e12
+        except (OSError, ValueError):
+            pass
+        return None
+
+
+def read_number(path):
+    # sysfs reports microwatts, microamps and microvolts
+    with open(path) as reading:
+        return int(reading.read())
+
+
+class FramePacer(object):
+    # Takes the place of clock.tick(60) at the end of each loop
+    def __init__(self, clock, max_fps=0, idle_fps=15, linger=0.5,
+                 polling=False, power=None):
+        self.clock = clock
+        self.active_fps = max_fps or display_refresh_rate()
+        self.idle_fps = idle_fps
+        # Whether some input is only ever polled, so can't wake an idle
+        # wait.  The loop then stays at active_fps.
+        self.polling = polling
+        self.linger = linger
+        self.power = power  # A PowerMeter, if measuring power
+
+        self.active_until = 0.0
+        self.active = True
+
+        # Time and loops spent each way, by active
+        self.wall_seconds = {True: 0.0, False: 0.0}
+        self.cpu_seconds = {True: 0.0, False: 0.0}
+        # CPU time in the loops themselves, leaving out the waits
+        self.work_seconds = {True: 0.0, False: 0.0}
+        self.loops = {True: 0, False: 0}
+        self.joules = {True: 0.0, False: 0.0}
+        self.power_seconds = {True: 0.0, False: 0.0}
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.process_time()
+        self.last_power = self.last_wall
+        self.watts = None
+
+    def busy(self, active, now=None):
+        # Note whether this loop had anything to do.  Returns True while
+        # running at active_fps.
+        now = time.perf_counter() if now is None else now
+        if active:
+            self.active_until = now + self.linger
+        self.active = self.polling or active or now < self.active_until
+        return self.active
+
+    def idle_timeout(self, release_at=None):
+        # Milliseconds to wait for an event when idle, or None for as
+        # long as it takes
+        timeout = None
+        if self.idle_fps:
+            timeout = 1 / self.idle_fps
+        if release_at is not None:
+            until_release = max(0.0, release_at - time.monotonic())
+            timeout = until_release if timeout is None else \
+                min(timeout, until_release)
+        if timeout is None:
+            return None
+        # A timeout of 0 would be taken as forever
+        return max(1, int(timeout * 1000))
+
+    def pace(self, active, release_at=None):
+        # Wait until the next loop is due.  active is whether this loop
+        # had anything to do, release_at the time.monotonic() of the next
+        # timed note release, if there is one.  Returns the pygame event
+        # which ended an idle wait, for the next loop to handle, or None.
+        event = None
+        self.work_seconds[self.busy(active)] += time.process_time() - \
+            self.last_cpu
+        if self.active:
+            self.clock.tick(self.active_fps)
+        else:
+            timeout = self.idle_timeout(release_at)
+            if timeout is None:
+                event = pygame.event.wait()
+            else:
+                event = pygame.event.wait(timeout)
+            if event.type == pygame.NOEVENT:
+                event = None
+            # Don't let the next tick make up for the time spent idle
+            self.clock.tick()
+        self.account(self.active)
+        return event
+
+    def account(self, active):
+        now = time.perf_counter()
+        cpu = time.process_time()
+        self.wall_seconds[active] += now - self.last_wall
+        self.cpu_seconds[active] += cpu - self.last_cpu
+        self.loops[active] += 1
+        self.last_wall = now
+        self.last_cpu = cpu
+
+        if self.power and now - self.last_power >= power_interval:
+            self.watts = self.power.watts()
+            if self.watts is not None:
+                self.joules[active] += self.watts * (now - self.last_power)
+                self.power_seconds[active] += now - self.last_power
+                helm_metrics.power_watts.set(self.watts)
+            self.last_power = now
+
+        helm_metrics.pacing_active.set(int(active))
+        helm_metrics.cpu_fraction.set(self.cpu_fraction(active))
+        helm_metrics.wakeups_saved.set(self.wakeups_saved())
+
+    def cpu_fraction(self, active):
+        if not self.wall_seconds[active]:
+            return 0.0
+        return self.cpu_seconds[active] / self.wall_seconds[active]
+
+    def wakeups_saved(self):
+        # Loops not run, against a fixed_fps loop over the same time
+        elapsed = self.wall_seconds[True] + self.wall_seconds[False]
+        return max(0, int(elapsed * fixed_fps) - sum(self.loops.values()))
+
+    def cpu_saved(self):
+        # Estimated CPU seconds saved while idle: the loops not run, at
+        # what an idle loop's work costs.  Waiting costs something too,
+        # more with some SDL video drivers than others, so this leaves
+        # it out.
+        if not self.loops[False]:
+            return 0.0
+        per_loop = self.work_seconds[False] / self.loops[False]
+        not_run = self.wall_seconds[False] * fixed_fps - self.loops[False]
+        return max(0.0, not_run * per_loop)
+
+    def mean_watts(self, active):
+        if not self.power_seconds[active]:
+            return None
+        return self.joules[active] / self.power_seconds[active]
+
+    def summary(self):
+        lines = ["Pacing: {:.1f} s active at {} fps, {:.1f} s idle at {}"
+                 .format(self.wall_seconds[True], self.active_fps,
+                         self.wall_seconds[False],
+                         "{} fps".format(self.idle_fps) if self.idle_fps
+                         else "no fixed rate"),
+                 "{} wakeups saved against a fixed {} fps loop".format(
+                     self.wakeups_saved(), fixed_fps),
+                 "CPU {:.1%} active, {:.1%} idle, about {:.2f} CPU seconds "
+                 "saved".format(self.cpu_fraction(True),
+                                self.cpu_fraction(False), self.cpu_saved())]
+        if self.power_seconds[True] or self.power_seconds[False]:
+            lines.append("Power {} active, {} idle".format(
+                *("{:.2f} W".format(watts) if watts is not None else "n/a"
+                  for watts in (self.mean_watts(True),
+                                self.mean_watts(False)))))
+        return "\n".join(lines)
@@ -0,0 +1,82 @@
+import helm_globals
+
+# Presets: a key, mode, octave and latched chord to jump straight to,
+# for songs which change key from one section to the next.
+#
+# They come from [preset ...] sections of the config, in order:
+#
+# [preset verse]
+# key = F#
+# mode = Dorian
+# octave = 3
+# latched = 1, 3, 5
+#
+# key is a note name or key.notes index, mode a mode name or number (see
+# mode_numbers), and latched one of helm_globals.chord_types, or left out
+# to let go of any latched notes.  Without an octave the current one is
+# kept.  F1 to F12 recall the first twelve, and a MIDI program change on
+# the controller inport recalls the preset with that number, from 0.
+#
+# The chord root isn't set separately: on the wheel it's wherever the
+# mode ring points, so it comes from the mode.
+
+# Mode name -> current_key_mode.  Mode n has the pointer on
+# chord_positions[n], whose label names it.
+mode_numbers = {
+    helm_globals.note_wheel_labels[position]['mode'].lower(): mode
+    for mode, position in enumerate(helm_globals.chord_positions)}
+
+
+class Preset(object):
+    __slots__ = ('name', 'key', 'mode', 'chord_root', 'octave', 'latched')
+
+    def __init__(self, name, key=0, mode=0, octave=None, latched=None):
+        self.name = name
+        self.key = key % 12  # current_key
+        self.mode = mode % 7  # current_key_mode
+        # Worked out here, once, for WheelControl.recall()
+        self.chord_root = (self.key +
+                           helm_globals.chord_positions[self.mode]) % 12
+        self.octave = octave  # Midi.octave, or None to keep it
+        self.latched = latched  # A chord_types name, or None
+
+    def __repr__(self):
+        return "Preset(" + ", ".join(
+            "{}={!r}".format(field, getattr(self, field))
+            for field in self.__slots__) + ")"
+
+
+def parse_key(text):
+    text = text.strip()
+    for number, note in enumerate(helm_globals.key_notes):
+        if text in (note['noteName'], note['sharpName']):
+            return number
+    return int(text)
+
+
+def parse_mode(text):
+    text = text.strip()
+    if text.lower() in mode_numbers:
+        return mode_numbers[text.lower()]
+    return int(text)
+
+
+def presets_from_config(config):
+    # Every [preset ...] section of a ConfigParser, in order.  Raises
+    # ValueError for a value it can't make sense of.
+    presets = []
+    for section in config.sections():
+        if not section.startswith('preset '):
+            continue
+        options = config[section]
+        latched = options.get('latched', fallback=None)
+        if latched is not None and latched not in helm_globals.chord_types:
+            raise ValueError("Unknown chord in [{}]: {}".format(section,
+                                                                latched))
+        presets.append(Preset(
+            section[len('preset '):].strip(),
+            key=parse_key(options.get('key', fallback='0')),
+            mode=parse_mode(options.get('mode', fallback='0')),
+            octave=options.getint('octave', fallback=None),
+            latched=latched))
+    return presets
@@ -0,0 +1,122 @@
+import ctypes
+import ctypes.util
+import gc
+import os
+import helm_metrics
+
+# Performance mode: keeping Python's garbage collector and the OS scheduler
+# out of the way of the notes.
+#
+# After startup the collector is frozen and turned off, and collections
+# only happen in idle loops, see IdleCollector.  On Linux the threads
+# sending MIDI ask for SCHED_FIFO (or failing that, a better nice value)
+# and their own CPU, and memory is locked so a page fault can't stall a
+# note.  Each of these is best effort: without the privileges, helm says
+# so and carries on.
+
+# mlockall() flags, from sys/mman.h
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+def freeze_gc():
+    # Call once startup is done.  Everything which exists by now lives for
+    # the whole run, so it's moved out of the collector's sight for good,
+    # and automatic collection stops.
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+
+
+def thaw_gc():
+    gc.unfreeze()
+    gc.enable()
+
+
+class IdleCollector(object):
+    # Runs the collections the collector would have, but only in loops
+    # with nothing to play or draw.  If there's never an idle loop, young
+    # objects are collected anyway once limit of them have piled up.
+    def __init__(self, limit_factor=10):
+        self.thresholds = gc.get_threshold()
+        self.limit = self.thresholds[0] * limit_factor
+
+    def update(self, idle):
+        # Called once per loop.  Returns the generation collected, or None.
+        counts = gc.get_count()
+        if counts[0] < self.thresholds[0]:
+            return None
+        if not idle and counts[0] < self.limit:
+            return None
+        generation = 0
+        if counts[1] >= self.thresholds[1]:
+            generation = 1
+            # The oldest generation is only ever collected when idle
+            if idle and counts[2] >= self.thresholds[2]:
+                generation = 2
+        gc.collect(generation)
+        helm_metrics.gc_collections.inc()
+        return generation
+
+
+def realtime_priority(priority=10, nice=-10):
+    # Ask for SCHED_FIFO for the calling thread, or failing that a better
+    # nice value.  Threads started afterwards inherit it, so call this
+    # after starting any thread which shouldn't have it.
+    # Returns what was granted, for printing.
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return "SCHED_FIFO priority {}".format(priority)
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, nice)
+        return "nice {}".format(nice)
+    except (AttributeError, OSError):
+        return "normal priority"
+
+
+def pin_cpus(cpus):
+    # Keep the calling thread on cpus, e.g. {2}.  Returns True if it could.
+    if not cpus:
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+def lock_memory():
+    # Keep every page helm has, or will have, in RAM.  Returns True if it
+    # could.
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return False
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        return libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0
+    except (AttributeError, OSError):
+        return False
+
+
+def parse_cpus(text):
+    # "2, 3" -> {2, 3}
+    return {int(cpu) for cpu in text.split(",") if cpu.strip()}
+
+
+class MidiThreadSetup(object):
+    # Realtime priority and CPU for a thread helm doesn't start itself,
+    # such as mido's callback thread for the clock port.  Called from that
+    # thread, it does the setup on its first call only.
+    def __init__(self, priority=10, cpus=None):
+        self.priority = priority
+        self.cpus = cpus
+        self.done = False
+
+    def __call__(self):
+        if self.done:
+            return
+        self.done = True
+        print("MIDI clock thread:", realtime_priority(self.priority))
+        pin_cpus(self.cpus)
@@ -0,0 +1,189 @@
+import threading
+import time
+import pygame
+import helm_metrics
+
+
+def render_frame(canvas, controls, snapshots, scheduler=None):
+    # Draw every control from its snapshot and present the frame.
+    # controls and snapshots are parallel lists, as produced by
+    # snapshot_controls().  A control whose snapshot is None isn't being
+    # redrawn this frame, and keeps what's already on the canvas.
+    started = time.perf_counter()
+    for control, snapshot in zip(controls, snapshots):
+        if snapshot is None:
+            continue
+        control_started = time.perf_counter()
+        # The drawControl method should update the control's visual
+        # elements and draw to the control's surface
+        control.draw_control(snapshot)
+        # Blit the control's surface to the canvas
+        canvas.blit(control.surface, [control.blit_x, control.blit_y])
+        if scheduler:
+            scheduler.control_drawn(control,
+                                    time.perf_counter() - control_started)
+    # Headless canvases are plain Surfaces with no display behind them
+    if pygame.display.get_surface() is canvas:
+        pygame.display.update()
+    frame_seconds = time.perf_counter() - started
+    helm_metrics.frame_seconds.observe(frame_seconds)
+    if scheduler:
+        scheduler.frame_drawn(frame_seconds)
+
+
+def snapshot_controls(controls, drawing=None):
+    # Capture everything the controls need to draw themselves, as of right
+    # now.  The snapshots are detached from the live state, so the input
+    # side can keep changing things while a frame is being drawn.
+    # drawing is the controls to redraw, from FrameScheduler.plan(), or
+    # None for all of them.  The rest get a None snapshot.
+    return [control.snapshot()
+            if drawing is None or control in drawing else None
+            for control in controls]
+
+
+def merge_snapshots(older, newer):
+    # Coalesce two frames which were never drawn: the newer snapshot of
+    # each control, or the older one where the newer frame skips it
+    return [old if new is None else new for old, new in zip(older, newer)]
+
+
+class FrameScheduler(object):
+    # Decides which controls draw each frame, so that a slow frame can't
+    # hold up input.
+    #
+    # Each control has a render_budget, in seconds.  Controls which aren't
+    # deferrable (the wheel's pointer and highlights) draw whenever they
+    # need to.  A deferrable control (the chord labels) is put off while
+    # the frames are running long, or while its own drawing runs over its
+    # budget.  Its redraws pile up in to one, which is drawn once things
+    # calm down, or after max_deferred frames at the most.
+    #
+    # The frame time also sets each control's animation_step: the number
+    # of animation frames to move on by per update.  When frames take two
+    # or three times the frame budget, animations skip the in between
+    # frames and still arrive on time.
+    def __init__(self, controls, frame_budget=1 / 60, max_deferred=6,
+                 max_animation_step=4):
+        self.controls = controls
+        self.frame_budget = frame_budget
+        self.max_deferred = max_deferred
+        self.max_animation_step = max_animation_step
+
+        # Moving averages of the time taken to draw, in seconds.  Written
+        # by whichever thread draws, read by plan() on the main loop.
+        self.frame_seconds = 0.0
+        self.draw_seconds = {control: 0.0 for control in controls}
+
+        # Deferrable controls waiting to redraw -> frames put off so far
+        self.deferred = {}
+
+    def control_drawn(self, control, seconds):
+        self.draw_seconds[control] = (self.draw_seconds[control] * 0.75) + \
+            (seconds * 0.25)
+
+    def frame_drawn(self, seconds):
+        self.frame_seconds = (self.frame_seconds * 0.75) + (seconds * 0.25)
+
+    def overloaded(self):
+        return self.frame_seconds > self.frame_budget
+
+    def over_budget(self, control):
+        return self.overloaded() or \
+            self.draw_seconds[control] > control.render_budget
+
+    def plan(self):
+        # The set of controls to draw this frame, which is empty if
+        # nothing needs drawing
+        drawing = set()
+        for control in self.controls:
+            if not control.needs_rendering and \
+                    control not in self.deferred:
+                continue
+            if control.deferrable and self.over_budget(control) and \
+                    self.deferred.get(control, 0) < self.max_deferred:
+                self.deferred[control] = self.deferred.get(control, 0) + 1
+                helm_metrics.redraws_deferred.inc()
+                continue
+            self.deferred.pop(control, None)
+            drawing.add(control)
+
+        animation_step = max(1, min(self.max_animation_step,
+                                    int(self.frame_seconds /
+                                        self.frame_budget)))
+        for control in self.controls:
+            control.animation_step = animation_step
+        return drawing
+
+
+class RenderThread(threading.Thread):
+    # Draws frames away from the input / MIDI loop.
+    #
+    # The main loop keeps pygame.event.get(), update_control and all MIDI
+    # output.  Whenever something needs a redraw it hands over a list of
+    # state snapshots with submit(), which never waits on drawing.  If the
+    # renderer falls behind, older snapshots are simply replaced by newer
+    # ones, so a slow frame can't hold up the next note.
+    #
+    # SDL expects events to be pumped from the thread that opened the
+    # display, which is why input stays on the main thread and only
+    # drawing moves over here.
+    def __init__(self, canvas, controls, capture=None, scheduler=None):
+        super(RenderThread, self).__init__(name="helm-render", daemon=True)
+        self.canvas = canvas
+        self.controls = controls
+        self.capture = capture  # A helm_capture.FrameCapture, if capturing
+        self.scheduler = scheduler  # A FrameScheduler, to time the frames
+
+        # Single slot mailbox: the most recent frame's snapshots, or None
+        self.pending = None
+        self.frame_ready = threading.Condition()
+        self.rendering = True
+
+        self.frames_rendered = 0
+        self.frames_superseded = 0  # Submitted but replaced before drawing
+
+    def submit(self, snapshots):
+        with self.frame_ready:
+            if self.pending is not None:
+                self.frames_superseded += 1
+                helm_metrics.frames_superseded.inc()
+                # Keep the older frame's snapshot of any control the
+                # newer frame isn't redrawing
+                snapshots = merge_snapshots(self.pending, snapshots)
+            self.pending = snapshots
+            self.frame_ready.notify()
+
+    def present(self):
+        # Frames are shown by this thread as soon as they're drawn
+        pass
+
+    def stop(self):
+        with self.frame_ready:
+            self.rendering = False
+            self.frame_ready.notify()
+        self.join()
+
+    def run(self):
+        while True:
+            with self.frame_ready:
+                while self.pending is None and self.rendering:
+                    if self.capture and self.capture.dirty:
+                        # Only until a skipped frame capture is due
+                        self.frame_ready.wait(self.capture.interval)
+                        break
+                    self.frame_ready.wait()
+                snapshots = self.pending
+                self.pending = None
+            if snapshots is None:
+                if not self.rendering:
+                    # Stopped, and any last submitted frame is drawn
+                    break
+                self.capture.flush(self.canvas)
+                continue
+
+            render_frame(self.canvas, self.controls, snapshots,
+                         self.scheduler)
+            self.frames_rendered += 1
+            if self.capture:
+                self.capture.capture(self.canvas)
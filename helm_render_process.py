@@ -0,0 +1,235 @@
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+import pygame
+import helm_globals
+import helm_fonts
+import helm_layout
+import helm_metrics
+from helm_controls import build_controls, control_factories, \
+    default_controls, register_control
+from helm_ipc import note_mask, mask_notes, rotation_rings
+from helm_render import render_frame
+
+# Drawing in a separate process, so pygame's drawing never holds the GIL
+# that input and MIDI need.
+#
+# The worker builds its own copies of the controls, from the same
+# helm_controls.control_factories entries, and draws them in to a
+# framebuffer in shared memory.  The main process sends it a compact
+# frame request down a pipe, packed with request_format:
+#
+#   controls to draw (bit n for control n, up to 16, see
+#   helm_controls.max_controls), key, mode, chord root, notes_on mask,
+#   rotation ring, latched, rotate_offset, rotate_offset_chord
+#
+# and the worker answers with done_format: the controls it drew, the
+# frame's drawing time and each control's.  The main process then only
+# blits the redrawn parts of the framebuffer to the display.
+#
+# There's never more than one frame in flight.  Requests made while the
+# worker is drawing are merged in to one, sent once the frame before it
+# has been blit, so the worker never draws over a frame being shown.
+
+request_format = '<HBBBHBBii'
+stop_request = b''
+
+
+def encode_request(snapshots):
+    # A frame request for the snapshots from snapshot_controls()
+    drawing = 0
+    state = None
+    for control_no, snapshot in enumerate(snapshots):
+        if snapshot is not None:
+            drawing |= 1 << control_no
+            state = snapshot
+    return drawing, state
+
+
+def pack_request(drawing, state):
+    return struct.pack(request_format, drawing, state.current_key,
+                       state.current_key_mode, state.current_chord_root,
+                       note_mask(state.notes_on),
+                       rotation_rings.index(state.rotation_ring),
+                       state.notes_latched, state.rotate_offset,
+                       state.rotate_offset_chord)
+
+
+def unpack_request(data):
+    # (controls to draw, HelmState)
+    (drawing, current_key, current_key_mode, current_chord_root, notes_on,
+     rotation_ring, notes_latched, rotate_offset,
+     rotate_offset_chord) = struct.unpack(request_format, data)
+    return drawing, helm_globals.HelmState(
+        current_key=current_key, current_key_mode=current_key_mode,
+        current_chord_root=current_chord_root,
+        notes_on=mask_notes(notes_on),
+        rotation_ring=rotation_rings[rotation_ring],
+        notes_latched=bool(notes_latched), rotate_offset=rotate_offset,
+        rotate_offset_chord=rotate_offset_chord)
+
+
+def done_format(controls):
+    return '<Hd' + 'd' * controls
+
+
+def render_worker(connection, framebuffer_name, width, height,
+                  layout_cache=None, factories=None):
+    # The worker process.  Never opens a window, the main process shows
+    # what's drawn here.  factories are (name, control_factories entry)
+    # for each control to draw, in order, as a spawned process only has
+    # the controls registered on import.
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    layout = helm_layout.layout_for(width, height, cache_file=layout_cache)
+    helm_fonts.init_fonts(layout.font_sizes)
+    if factories is None:
+        factories = [(name, control_factories[name])
+                     for name in default_controls]
+    for name, factory in factories:
+        register_control(name, factory)
+    controls = build_controls(layout, [name for name, _ in factories])
+    answer_format = done_format(len(controls))
+
+    framebuffer = shared_memory.SharedMemory(name=framebuffer_name)
+    canvas = pygame.image.frombuffer(framebuffer.buf, (width, height),
+                                     'RGBX')
+    canvas.fill(helm_globals.color_black)
+
+    while True:
+        data = connection.recv_bytes()
+        if data == stop_request:
+            break
+        drawing, state = unpack_request(data)
+        control_seconds = [0.0] * len(controls)
+        started = time.perf_counter()
+        for control_no, control in enumerate(controls):
+            if not drawing & (1 << control_no):
+                continue
+            control_started = time.perf_counter()
+            control.draw_control(state)
+            canvas.blit(control.surface, (control.blit_x, control.blit_y))
+            control_seconds[control_no] = time.perf_counter() - \
+                control_started
+        connection.send_bytes(struct.pack(
+            answer_format, drawing, time.perf_counter() - started,
+            *control_seconds))
+
+    # The surface has to let go of the shared memory before it's closed
+    del canvas
+    framebuffer.close()
+    pygame.quit()
+
+
+class RenderProcess(object):
+    # Draws frames in a worker process.  Used like a RenderThread: the
+    # main loop hands over snapshots with submit(), which never waits on
+    # drawing, and calls present() to show whatever the worker has
+    # finished.  fileno() is readable when a frame is ready.
+    #
+    # If the worker dies, frames are drawn right here instead.
+    def __init__(self, canvas, controls, layout_cache=None, capture=None,
+                 scheduler=None, control_names=default_controls):
+        self.canvas = canvas
+        self.controls = controls
+        self.capture = capture  # A helm_capture.FrameCapture, if capturing
+        self.scheduler = scheduler  # A FrameScheduler, to time the frames
+        self.done_format = done_format(len(controls))
+
+        width, height = canvas.get_size()
+        self.framebuffer = shared_memory.SharedMemory(
+            create=True, size=width * height * 4)
+        self.frame = pygame.image.frombuffer(self.framebuffer.buf,
+                                             (width, height), 'RGBX')
+
+        # Spawned rather than forked: SDL doesn't survive a fork
+        context = multiprocessing.get_context('spawn')
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(
+            target=render_worker, name="helm-render", daemon=True,
+            args=(worker_connection, self.framebuffer.name, width, height,
+                  layout_cache, [(name, control_factories[name])
+                                 for name in control_names]))
+
+        self.in_flight = False
+        # A request merged from those made while a frame was in flight
+        self.pending_drawing = 0
+        self.pending_state = None
+
+        self.frames_rendered = 0
+        self.frames_superseded = 0  # Requested but merged before drawing
+
+    def start(self):
+        self.process.start()
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def submit(self, snapshots):
+        drawing, state = encode_request(snapshots)
+        if self.process.exitcode is not None:
+            render_frame(self.canvas, self.controls, snapshots,
+                         self.scheduler)
+            if self.capture:
+                self.capture.capture(self.canvas)
+            return
+        if self.in_flight:
+            if self.pending_state is not None:
+                self.frames_superseded += 1
+                helm_metrics.frames_superseded.inc()
+            self.pending_drawing |= drawing
+            self.pending_state = state
+            return
+        self.request(drawing, state)
+
+    def request(self, drawing, state):
+        self.connection.send_bytes(pack_request(drawing, state))
+        self.in_flight = True
+
+    def present(self):
+        # Show the frame the worker has finished, if it has, then send it
+        # the next one
+        if not self.in_flight or self.process.exitcode is not None or \
+                not self.connection.poll():
+            if self.capture and not self.in_flight:
+                # Capture the last frame shown, if it came too soon to be
+                self.capture.flush(self.canvas)
+            return
+        done = struct.unpack(self.done_format,
+                             self.connection.recv_bytes())
+        drawing, frame_seconds = done[:2]
+        for control_no, control in enumerate(self.controls):
+            if not drawing & (1 << control_no):
+                continue
+            area = control.surface.get_rect(topleft=(control.blit_x,
+                                                     control.blit_y))
+            self.canvas.blit(self.frame, area, area)
+            if self.scheduler:
+                self.scheduler.control_drawn(control, done[2 + control_no])
+        # Headless canvases are plain Surfaces with no display behind them
+        if pygame.display.get_surface() is self.canvas:
+            pygame.display.update()
+        helm_metrics.frame_seconds.observe(frame_seconds)
+        if self.scheduler:
+            self.scheduler.frame_drawn(frame_seconds)
+        if self.capture:
+            self.capture.capture(self.canvas)
+        self.frames_rendered += 1
+
+        self.in_flight = False
+        if self.pending_state is not None:
+            self.request(self.pending_drawing, self.pending_state)
+            self.pending_drawing = 0
+            self.pending_state = None
+
+    def stop(self):
+        if self.process.is_alive():
+            self.connection.send_bytes(stop_request)
+            self.process.join(timeout=5)
+        self.connection.close()
+        # As in the worker, the surface goes before the shared memory
+        self.frame = None
+        self.framebuffer.close()
+        self.framebuffer.unlink()
@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+import helm_metrics
+
+# Timestamped note output.  Notes played from the main loop are given a
+# time to sound, rather than going out whenever the loop gets to them,
+# and a NoteScheduler thread sends each one on time.
+#
+# With quantize on, that time is the next step of a ClockGrid: the ticks
+# of the external MIDI clock, once it's running, or an internal clock at
+# helm_globals.tempo until then.  quantize is steps per whole note, as
+# for the arpeggiator, so 96 is the next clock tick.  The frame loop's
+# jitter then doesn't reach the synth at all, only the clock's.
+#
+# Each output has its own latency, in seconds, for the time its
+# messages take to make a sound: USB, the synth's own buffering, and so
+# on.  Messages are sent that much early.  Notes are quantized to steps
+# at least lookahead (the largest latency) in the future, so there's
+# always time to send them early enough.
+#
+# Everything here keeps time with time.perf_counter(), unless a
+# NoteScheduler is given a clock of its own.
+
+
+class ClockGrid(object):
+    # Where the MIDI clock's ticks (24 per quarter note) fall.  Until an
+    # external clock ticks they're at tempo, from when the grid was made.
+    # tick() and start() come from the clock port's thread, so the timing
+    # is replaced in one go for step_time() on the main loop.
+    def __init__(self, tempo=120, now=None):
+        now = time.perf_counter() if now is None else now
+        # (time of the latest tick, its number since start, seconds per
+        # tick)
+        self.timing = (now, 0, 60 / (tempo * 24))
+        self.external_ticks = 0
+        self.started = False
+
+    def start(self):
+        # MIDI start: the next tick is the top of the bar
+        self.started = True
+
+    def tick(self, now=None):
+        now = time.perf_counter() if now is None else now
+        last_tick, number, period = self.timing
+        interval = now - last_tick
+        if self.started:
+            number = 0
+            self.started = False
+        else:
+            number += 1
+        if self.external_ticks == 1:
+            # The clock's own tempo replaces the tempo setting outright
+            period = interval
+        elif self.external_ticks and interval < period * 4:
+            # Smooth out the clock's own jitter.  A long gap is the clock
+            # having stopped, not a change of tempo.
+            period = (period * 0.9) + (interval * 0.1)
+        self.external_ticks += 1
+        self.timing = (now, number, period)
+
+    @property
+    def tempo(self):
+        return 60 / (self.timing[2] * 24)
+
+    def step_time(self, after, ticks_per_step=1):
+        # The time of the first tick at or after after which is on a step
+        # of ticks_per_step ticks
+        last_tick, number, period = self.timing
+        ticks = max(0, math.ceil((after - last_tick) / period - 1e-9))
+        ticks += -(number + ticks) % ticks_per_step
+        return last_tick + (ticks * period)
+
+
+class NoteScheduler(threading.Thread):
+    # Sends notes from a priority queue, each at its own time, on a
+    # thread of its own.  deliver(output, mido_message, midi_note,
+    # velocity) does the sending, e.g. Midi.deliver().
+    #
+    # The thread sleeps on a condition until spin seconds before the
+    # next message is due, then yields in a loop until it is, as sleeps
+    # alone can wake a little late.  How late each message actually goes
+    # out is measured, see dispatch().  clock is the time they're all
+    # measured against.
+    #
+    # Started after performance mode's setup, it inherits the main
+    # thread's realtime priority and CPUs.  Otherwise it starts itself
+    # with the first note.  Only this thread ever sends, so the outputs
+    # and the dispatch_error metric each have the one writer.
+    def __init__(self, deliver, lookahead=0.0, spin=0.001,
+                 clock=time.perf_counter):
+        super(NoteScheduler, self).__init__(name="helm-midi-schedule",
+                                            daemon=True)
+        self.deliver = deliver
+        self.lookahead = lookahead
+        self.spin = spin
+        self.clock = clock
+
+        self.latency = {}  # output -> seconds
+
+        # (send at, order scheduled, output, mido_message, midi_note,
+        # velocity).  The order keeps simultaneous messages, like a
+        # note_off and the note_on after it, in the order they were
+        # scheduled.
+        self.queue = []
+        self.order = itertools.count()
+        self.ready = threading.Condition()
+        self.scheduling = True
+
+        # Seconds each message went out off its time, measured
+        self.dispatched = 0
+        self.error_sum = 0.0
+        self.error_max = 0.0
+
+    def schedule(self, at, output, mido_message, midi_note, velocity):
+        # Play a note message at time at, allowing for output's latency
+        send_at = at - self.latency.get(output, 0.0)
+        if not self.scheduling:
+            raise RuntimeError("Note scheduled after the scheduler stopped")
+        if self.ident is None:
+            self.start()
+        with self.ready:
+            heapq.heappush(self.queue, (send_at, next(self.order), output,
+                                        mido_message, midi_note, velocity))
+            self.ready.notify()
+
+    def stop(self):
+        # Stop, sending anything still waiting straight away, in order
+        with self.ready:
+            self.scheduling = False
+            self.ready.notify()
+        if self.ident is not None:
+            self.join()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while self.scheduling:
+                    if not self.queue:
+                        self.ready.wait()
+                        continue
+                    wait = self.queue[0][0] - self.clock() - self.spin
+                    if wait <= 0:
+                        break
+                    self.ready.wait(wait)
+                if not self.scheduling:
+                    due = [heapq.heappop(self.queue)
+                           for _ in range(len(self.queue))]
+                    break
+                send_at = self.queue[0][0]
+
+            # The last stretch, without holding the lock or the GIL
+            while self.clock() < send_at:
+                time.sleep(0)
+
+            with self.ready:
+                now = self.clock()
+                due = []
+                while self.queue and self.queue[0][0] <= now:
+                    due.append(heapq.heappop(self.queue))
+            for entry in due:
+                self.dispatch(entry)
+
+        for entry in due:
+            self.dispatch(entry)
+
+    def dispatch(self, entry):
+        send_at, _, output, mido_message, midi_note, velocity = entry
+        error = abs(self.clock() - send_at)
+        self.deliver(output, mido_message, midi_note, velocity)
+        self.dispatched += 1
+        self.error_sum += error
+        self.error_max = max(self.error_max, error)
+        helm_metrics.dispatch_error.observe(error)
+
+    def summary(self):
+        if not self.dispatched:
+            return "Scheduled MIDI: nothing sent"
+        return "Scheduled MIDI: {} messages, {:.3f} ms off on average, " \
+            "{:.3f} ms at most".format(
+                self.dispatched, self.error_sum / self.dispatched * 1000,
+                self.error_max * 1000)
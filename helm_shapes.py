@@ -3,6 +3,14 @@ import helm_globals
 
 
 class Shape(object):
+    # Shapes are kept for the life of a control and looked up every frame,
+    # so they're slotted records rather than dicts
+    __slots__ = ('coordinates', 'degrees', 'coordinates_boxes',
+                 'canvas_size', 'r', 'origin_x', 'origin_y',
+                 'circle_divisions', 'slice_no', 'offset_orientation',
+                 'offset_degrees', 'spacing_width', 'line_spacing',
+                 'left_margin')
+
     def __init__(self, **kwargs):
         # Informal interface for Shape
 
@@ -47,6 +55,8 @@ class Shape(object):
 
 
 class ShapeNotesList(Shape):
+    __slots__ = ()
+
     def find_coordinates(self):
         for i in range(1, 13):
             self.coordinates.append(
@@ -73,6 +83,8 @@ class ShapeNotesList(Shape):
 
 
 class ShapeWheel(Shape):
+    __slots__ = ()
+
     def find_coordinates(self):
         for i in range(12):
             self.coordinates.append(
@@ -108,6 +120,8 @@ class ShapeWheel(Shape):
 
 
 class ShapeWheelSlice(Shape):
+    __slots__ = ()
+
     def find_coordinates(self):
         self.coordinates.append(  # Origin
             (
@@ -176,6 +190,8 @@ class ShapeWheelSlice(Shape):
 
 
 class ShapeWheelRay(Shape):
+    __slots__ = ()
+
     def find_coordinates(self):
         self.coordinates.append(  # Origin
             (
@@ -0,0 +1,282 @@
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+import pygame
+import helm_globals
+from helm import Helm
+from helm_events import EventBuffer, knob_event
+from helm_render import FrameScheduler, render_frame, snapshot_controls
+
+# Load generator for the control pipeline.
+#
+# Runs a headless Helm flat out, feeding every loop a random burst of
+# keyboard and knob input: chord keys going down and up over each other,
+# rotations of every ring, 'e' / 'w' ring modifiers and 'q' latch toggles.
+# MIDI goes to a VirtualSink instead of a port.  After every loop the
+# invariants below are checked, and throughput and memory are reported
+# every so often, so a long run can shake out stuck notes and wheel
+# desyncs:
+#
+#   python helm_soak.py --seconds 14400
+#
+# Invariants:
+#   - The sink hears exactly the notes the VoiceAllocator says are sounding
+#   - No note_on for a note already sounding, no note_off for a silent one
+#   - key.notes_on shows exactly the sounding notes
+#   - With no key down, nothing latched, sustained or waiting on a timed
+#     release, nothing is sounding
+#   - The key, mode and chord agree with how far the rings have turned
+
+chord_keys = (pygame.K_a, pygame.K_s, pygame.K_d,
+              pygame.K_z, pygame.K_x, pygame.K_c)
+modifier_keys = (pygame.K_e, pygame.K_w, pygame.K_q)
+rotate_keys = (pygame.K_COMMA, pygame.K_PERIOD)
+
+
+class VirtualSink(object):
+    # Stands in for a helm_midi output, and keeps track of what a synth
+    # on the other end would be playing
+    def __init__(self):
+        self.sounding = set()
+        self.messages = 0
+        self.problems = []
+
+    def send(self, msg):
+        if msg.type in ('note_on', 'note_off'):
+            self.send_note(msg.type, msg.channel, msg.note, msg.velocity)
+        else:
+            self.messages += 1
+
+    def send_note(self, mido_message, channel, midi_note, velocity):
+        self.messages += 1
+        if mido_message == 'note_on' and velocity > 0:
+            if midi_note in self.sounding:
+                self.problems.append("note_on for sounding note {}"
+                                     .format(midi_note))
+            self.sounding.add(midi_note)
+        else:
+            if midi_note not in self.sounding:
+                self.problems.append("note_off for silent note {}"
+                                     .format(midi_note))
+            self.sounding.discard(midi_note)
+
+    def close(self):
+        pass
+
+
+def rss_bytes():
+    # Resident set size of this process, or 0 where it can't be found
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+class Soak(object):
+    def __init__(self, helm, seed=0, events_per_loop=8, render=False):
+        self.helm = helm
+        self.wheel = helm.controlSurfaces[0]
+        self.random = random.Random(seed)
+        self.events_per_loop = events_per_loop
+        self.scheduler = None
+        if render:
+            self.scheduler = FrameScheduler(helm.controlSurfaces)
+
+        # MIDI out goes to the sink, until close()
+        self.sink = VirtualSink()
+        self.outport = getattr(helm_globals.midi, 'outport', None)
+        self.using_midi = helm_globals.using_midi
+        helm_globals.midi.outport = self.sink
+        helm_globals.using_midi = True
+        # Anything already playing
+        self.sink.sounding.update(helm_globals.midi.voices.sounding())
+
+        self.keys_down = set()
+        self.events_buffer = EventBuffer()
+        self.loops = 0
+        self.events = 0
+
+        # Where the rings started, see check()
+        state = helm_globals.key.state
+        self.start_key = state.current_key
+        self.start_mode = state.current_key_mode
+        self.start_position = (state.current_chord_root -
+                               state.current_key) % 12
+        self.start_target = self.wheel.rotate_target
+        self.start_target_chord = self.wheel.rotate_target_chord
+
+    def close(self):
+        helm_globals.midi.outport = self.outport
+        helm_globals.using_midi = self.using_midi
+
+    def press(self, key, events):
+        # A key going down if it's up, or up if it's down
+        if key in self.keys_down:
+            self.keys_down.discard(key)
+            event_type = pygame.KEYUP
+        else:
+            self.keys_down.add(key)
+            event_type = pygame.KEYDOWN
+        self.helm.handle_event(pygame.event.Event(event_type, key=key),
+                               events)
+
+    def next_events(self):
+        # The EventBuffer, emptied for the next loop
+        self.events_buffer.clear()
+        return self.events_buffer
+
+    def loop(self):
+        events = self.next_events()
+        for _ in range(self.random.randint(0, self.events_per_loop)):
+            choice = self.random.random()
+            if choice < 0.5:
+                self.press(self.random.choice(chord_keys), events)
+            elif choice < 0.65:
+                self.press(self.random.choice(modifier_keys), events)
+            elif choice < 0.8:
+                # A quick tap of , or .
+                key = self.random.choice(rotate_keys)
+                self.press(key, events)
+                self.press(key, events)
+            else:
+                knob_event(events, self.random.choice((1, -1)),
+                           self.random.randint(1, 8))
+        self.helm.update(events)
+        if self.scheduler:
+            drawing = self.scheduler.plan()
+            if drawing:
+                render_frame(self.helm.canvas, self.helm.controlSurfaces,
+                             snapshot_controls(self.helm.controlSurfaces,
+                                               drawing),
+                             self.scheduler)
+        self.loops += 1
+        self.events += len(events)
+
+    def release_everything(self):
+        # Let go of every key, modifiers first, then play and release one
+        # more chord to end any latch.  Wait out any timed releases.
+        for key in sorted(self.keys_down,
+                          key=lambda key: key not in modifier_keys):
+            events = self.next_events()
+            self.press(key, events)
+            self.helm.update(events)
+        for _ in range(2):
+            events = self.next_events()
+            self.press(chord_keys[0], events)
+            self.helm.update(events)
+        while helm_globals.midi.voices.pending_releases:
+            time.sleep(0.01)
+            self.helm.update(self.next_events())
+        # Let the wheel animation finish
+        while self.wheel.rotate_offset != self.wheel.rotate_target or \
+                self.wheel.rotate_offset_chord != \
+                self.wheel.rotate_target_chord:
+            self.helm.update(self.next_events())
+
+    def check(self):
+        # Every invariant which doesn't hold right now
+        problems = list(self.sink.problems)
+        del self.sink.problems[:]
+        voices = helm_globals.midi.voices
+        state = helm_globals.key.state
+
+        if self.sink.sounding != voices.sounding():
+            problems.append("sink plays {} but the voices hold {}".format(
+                sorted(self.sink.sounding), sorted(voices.sounding())))
+        shown = frozenset((note % 12) * 7 % 12 for note in self.sink.sounding)
+        if state.notes_on != shown:
+            problems.append("notes_on {} for sounding notes {}".format(
+                sorted(state.notes_on), sorted(self.sink.sounding)))
+        chord_key_down = self.keys_down.intersection(chord_keys)
+        if not chord_key_down and 'latched' not in voices.held and \
+                not voices.pending_releases and not voices.sustained and \
+                self.sink.sounding:
+            problems.append("hanging notes {}".format(
+                sorted(self.sink.sounding)))
+
+        # Each 30 degrees turned is one slice of the wheel
+        slices = round(self.wheel.rotate_target / 30) - \
+            round(self.start_target / 30)
+        if state.current_key != (self.start_key - slices) % 12:
+            problems.append("key {} after turning the key ring {} slices"
+                            .format(state.current_key, slices))
+        position = (state.current_chord_root - state.current_key) % 12
+        slices = round(self.wheel.rotate_target_chord / 30) - \
+            round(self.start_target_chord / 30)
+        if position not in helm_globals.chord_positions or \
+                position != (self.start_position + slices) % 12:
+            problems.append("chord at {} after turning the mode ring {} "
+                            "slices".format(position, slices))
+        else:
+            # The mode moves on by one for every diatonic chord passed
+            steps = helm_globals.chord_positions.index(position) - \
+                helm_globals.chord_positions.index(self.start_position)
+            if state.current_key_mode != (self.start_mode + steps) % 7:
+                problems.append("mode {} with the chord at {}".format(
+                    state.current_key_mode, position))
+        return problems
+
+
+def soak(helm, seconds=None, loops=None, seed=0, events_per_loop=8,
+         render=False, report_every=60, report=print):
+    # Run the load until seconds or loops run out, or an invariant breaks.
+    # Returns a list of the problems found, which is empty if all is well.
+    runner = Soak(helm, seed, events_per_loop, render)
+    started = last_report = time.monotonic()
+    start_rss = rss_bytes()
+    problems = []
+    with open(os.devnull, 'w') as devnull:
+        while not problems:
+            if loops is not None and runner.loops >= loops:
+                break
+            if seconds is not None and \
+                    time.monotonic() - started >= seconds:
+                break
+            with contextlib.redirect_stdout(devnull):
+                runner.loop()
+            problems = runner.check()
+
+            now = time.monotonic()
+            if report and now - last_report >= report_every:
+                last_report = now
+                report("{:.0f}s {} loops {:.0f} events/s {} MIDI messages "
+                       "rss {:.1f} MB ({:+.1f} MB)".format(
+                           now - started, runner.loops,
+                           runner.events / (now - started),
+                           runner.sink.messages, rss_bytes() / 1e6,
+                           (rss_bytes() - start_rss) / 1e6))
+
+        if not problems:
+            with contextlib.redirect_stdout(devnull):
+                runner.release_everything()
+            problems = runner.check()
+    runner.close()
+    if problems and report:
+        report("After {} loops, seed {}:".format(runner.loops, seed))
+        for problem in problems:
+            report("  " + problem)
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Flood helm's controls with random input and check "
+                    "for stuck notes and wheel desyncs")
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--events-per-loop', type=int, default=8)
+    parser.add_argument('--report-every', type=float, default=60)
+    parser.add_argument('--render', action='store_true',
+                        help="Draw frames as well, on an offscreen canvas")
+    parser.add_argument('--config', default="helm.cfg")
+    args = parser.parse_args()
+
+    soak_helm = Helm(init_gfx=False, configfile=args.config)
+    found = soak(soak_helm, seconds=args.seconds, seed=args.seed,
+                 events_per_loop=args.events_per_loop,
+                 render=args.render, report_every=args.report_every)
+    sys.exit(1 if found else 0)
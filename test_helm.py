@@ -1,5 +1,67 @@
+import gc
+import math
+import threading
+import time
+import tracemalloc
+import mido
+import pygame
 from helm import Helm
+import helm_async
+from helm_async import AsyncRuntime
+from helm_capture import FrameCapture, FrameReader
+from helm_controls import ControlSystem, build_controls, \
+    control_factories, register_control
+from helm_events import EventBuffer, EventRouter, RECALL, ROTATE, TRIGGER, \
+    chord_event, powermate_event, powermate_rotate, recall_event, \
+    PowermateReader
+from helm_ipc import StatePublisher, StateReader
+from helm_pacing import FramePacer, wake, wake_event
+from helm_render_process import RenderProcess
+from helm_render import RenderThread, FrameScheduler, render_frame, \
+    snapshot_controls
 from helm_shapes import Shape, ShapeNotesList
+import helm_globals
+import helm_layout
+import helm_metrics
+import helm_realtime
+from helm_midi import VoiceAllocator, Arpeggiator, Midi, MidoOutput, \
+    RawMidiOutput, open_output
+from helm_soak import soak, Soak, VirtualSink
+from helm_presets import Preset, presets_from_config
+from helm_schedule import ClockGrid, NoteScheduler
+import helm_bench
+
+
+def rotation(wheel, direction, steps=1):
+    # An EventBuffer turning one ring, whichever ring is under control
+    events = EventBuffer()
+    event = events.add(ROTATE)
+    event.wheel = wheel
+    event.direction = direction
+    event.steps = steps
+    return events
+
+
+class PendingInput(object):
+    # Stands in for a mido input port with messages waiting on it
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.callback = None
+
+    def iter_pending(self):
+        while self.messages:
+            yield self.messages.pop(0)
+
+
+class ProbeControl(ControlSystem):
+    # Keeps the kinds of the events it's handed
+    def __init__(self, **kwargs):
+        super(ProbeControl, self).__init__(**kwargs)
+        self.event_kinds = {RECALL}
+        self.handed = []
+
+    def update_control(self, events):
+        self.handed.extend(event.kind for event in events)
 
 
 def test_helm_top_level():
@@ -25,3 +87,813 @@ def test_shapenoteslist():
                                                   spacing_width=44,
                                                   line_spacing=2,
                                                   left_margin=226)
+
+
+def test_render_thread_draws_snapshots():
+    helm_test_instance = Helm(init_gfx=False)
+    canvas = pygame.Surface((helm_test_instance.canvas_width,
+                             helm_test_instance.canvas_height))
+    renderer = RenderThread(canvas, helm_test_instance.controlSurfaces)
+    renderer.start()
+    snapshots = snapshot_controls(helm_test_instance.controlSurfaces)
+    # Changing the live state after the snapshot must not affect it
+    helm_globals.key.rotate_key(add_by=1)
+    renderer.submit(snapshots)
+    renderer.stop()
+    helm_globals.key.rotate_key(add_by=-1)
+    assert snapshots[0].current_key == 0
+    assert renderer.frames_rendered + renderer.frames_superseded == 1
+
+
+def test_render_process_draws_the_same_frame():
+    helm_test_instance = Helm(init_gfx=False)
+    size = (helm_test_instance.canvas_width, helm_test_instance.canvas_height)
+    helm_globals.key.set_notes_on((0, 4, 1))
+    snapshots = snapshot_controls(helm_test_instance.controlSurfaces)
+    expected = pygame.Surface(size)
+    render_frame(expected, helm_test_instance.controlSurfaces, snapshots)
+
+    canvas = pygame.Surface(size)
+    renderer = RenderProcess(canvas, helm_test_instance.controlSurfaces)
+    renderer.start()
+    try:
+        renderer.submit(snapshots)
+        # Merged in to one request, sent once the first frame is shown
+        renderer.submit(snapshots)
+        renderer.submit(snapshots)
+        deadline = time.monotonic() + 30
+        while renderer.frames_rendered < 2 and time.monotonic() < deadline:
+            renderer.present()
+            time.sleep(0.01)
+    finally:
+        renderer.stop()
+    helm_globals.key.set_notes_on(())
+    assert renderer.frames_rendered == 2
+    assert renderer.frames_superseded == 1
+    assert pygame.image.tobytes(canvas, 'RGB') == \
+        pygame.image.tobytes(expected, 'RGB')
+
+
+def test_frame_scheduler_defers_chord_labels_under_load():
+    helm_test_instance = Helm(init_gfx=False)
+    wheel, chords = helm_test_instance.controlSurfaces
+    scheduler = FrameScheduler(helm_test_instance.controlSurfaces,
+                               max_deferred=2)
+    assert scheduler.plan() == {wheel, chords}
+
+    # Frames taking three times the budget
+    scheduler.frame_drawn(scheduler.frame_budget * 12)
+    wheel.needs_rendering = chords.needs_rendering = True
+    assert scheduler.plan() == {wheel}
+    assert wheel.animation_step == 3
+    # The chord redraw is still owed, even once nothing flags it
+    wheel.needs_rendering = chords.needs_rendering = False
+    assert scheduler.plan() == set()
+    assert scheduler.plan() == {chords}
+    assert scheduler.plan() == set()
+
+    # Skipped snapshots keep what is already drawn
+    snapshots = snapshot_controls(helm_test_instance.controlSurfaces,
+                                  {wheel})
+    assert snapshots[1] is None
+
+
+def test_steady_state_render_does_not_allocate():
+    helm_test_instance = Helm(init_gfx=False)
+    controls = helm_test_instance.controlSurfaces
+    turns = [rotation(wheel, 1) for wheel in ('key', 'chord')
+             for _ in range(36)]
+
+    def spin():
+        # Both rings all the way round, a frame per detent
+        for events in turns:
+            helm_test_instance.update(events)
+            render_frame(helm_test_instance.canvas, controls,
+                         snapshot_controls(controls))
+
+    spin()
+    gc.collect()
+    shape_hits = helm_metrics.shape_hits.value
+    objects = len(gc.get_objects())
+    spin()
+    gc.collect()
+    assert len(gc.get_objects()) - objects < 50
+    # Every angle's shapes were worked out the first time round
+    assert helm_metrics.shape_hits.value - shape_hits == len(turns) * 2
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    spin()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    drawing = [tracemalloc.Filter(True, "*" + name) for name in
+               ("helm_controls.py", "helm_shapes.py", "helm_fonts.py",
+                "helm_render.py")]
+    growth = after.filter_traces(drawing).compare_to(
+        before.filter_traces(drawing), 'filename')
+    assert sum(stat.size_diff for stat in growth) < 1024
+
+
+def test_helm_state_transitions():
+    state = helm_globals.HelmState()
+    rotated = state.rotate_key(add_by=13).rotate_key_mode(add_by=1)
+    # Transitions return new states and leave the original alone
+    assert state.current_key == 0
+    assert rotated.current_key == 1
+    assert rotated.current_key_mode == 1
+    assert rotated.chord_scale == (2, 3, 4, 5, 6, 0, 1)
+    assert rotated.diff(state) == {'current_key', 'current_key_mode',
+                                   'diatonic', 'chord_scale'}
+    playing = rotated.note_on((1, 4)).note_off((4, ))
+    assert playing.notes_on == frozenset((1, ))
+    assert playing.diff(rotated) == {'notes_on'}
+    try:
+        state.current_key = 3
+        assert False, "HelmState should be immutable"
+    except AttributeError:
+        pass
+
+
+def test_voice_allocator_reference_counts():
+    voices = VoiceAllocator()
+    assert voices.press('a', (60, 64, 67)) == ([60, 64, 67], [])
+    # A second chord sharing notes only starts what isn't already sounding
+    assert voices.press('s', (60, 67)) == ([], [])
+    assert voices.release('a') == [64]
+    assert voices.release('s') == [60, 67]
+    assert voices.sounding() == set()
+
+
+def test_voice_allocator_sustain_and_timed_release():
+    voices = VoiceAllocator()
+    voices.press('a', (60, ))
+    voices.set_sustain(True)
+    assert voices.release('a') == []
+    assert voices.set_sustain(False) == [60]
+    voices.press('a', (62, ))
+    assert voices.release('a', delay=1, now=10) == []
+    assert voices.due(now=10.5) == []
+    assert voices.due(now=11) == [62]
+    assert voices.release_all() == []
+
+
+def test_midi_controls_make_the_same_events_as_the_keyboard():
+    helm_test_instance = Helm(init_gfx=False)
+    assert helm_test_instance.controlSurfaces
+    events = EventBuffer()
+    helm_globals.midi.control_message(
+        events, mido.Message('note_on', note=helm_globals.midi_pads[0],
+                             velocity=100))
+    helm_globals.midi.control_message(
+        events, mido.Message('control_change',
+                             control=helm_globals.midi_encoder_cc, value=1))
+    trigger, rotate = events
+    assert (trigger.kind, trigger.source, trigger.chord, trigger.start) == \
+        (TRIGGER, 'a', '1', True)
+    assert (rotate.kind, rotate.wheel, rotate.direction, rotate.steps) == \
+        (ROTATE, 'chord', 1, 1)
+
+
+def test_event_buffer_keeps_every_event_in_order():
+    helm_test_instance = Helm(init_gfx=False)
+    events = EventBuffer(size=2)
+    # Down, up and down again within one loop leaves the chord playing
+    for start in (True, False, True):
+        chord_event(events, 'a', start)
+    assert [event.start for event in events] == [True, False, True]
+    helm_test_instance.update(events)
+    assert helm_globals.key.notes_on
+
+    # Reused records, and growing rather than dropping any
+    events.clear()
+    assert len(events) == 0
+    for steps in range(1, 6):
+        events.add(ROTATE).steps = steps
+    assert len(events.records) == 8
+    assert [event.steps for event in events] == [1, 2, 3, 4, 5]
+    events.clear()
+    chord_event(events, 'a', False)
+    helm_test_instance.update(events)
+    assert not helm_globals.key.notes_on
+
+
+def test_touch_taps_and_drags_the_wheel_and_chord_rows():
+    helm_test_instance = Helm(init_gfx=False)
+    wheel, chords = helm_test_instance.controlSurfaces
+
+    def wheel_point(degrees, radius):
+        # Canvas point at degrees around the wheel, as the Shapes measure
+        angle = math.radians(degrees)
+        return (wheel.blit_x + wheel.origin[0] - radius * math.cos(angle),
+                wheel.blit_y + wheel.origin[1] - radius * math.sin(angle))
+
+    def touch(*moves):
+        # One finger going down at the first point, up at the last
+        events = EventBuffer()
+        types = [pygame.FINGERDOWN] + [pygame.FINGERMOTION] * \
+            (len(moves) - 2) + [pygame.FINGERUP]
+        for event_type, (x, y) in zip(types, moves):
+            helm_test_instance.handle_event(pygame.event.Event(
+                event_type, touch_id=0, finger_id=1,
+                x=x / helm_test_instance.canvas_width,
+                y=y / helm_test_instance.canvas_height), events)
+        helm_test_instance.update(events)
+        return events
+
+    # The lookup agrees with the middle of every slice
+    for slice_no in range(12):
+        assert wheel.hit_slices[30 * slice_no + 90 - 360 * (
+            slice_no > 8)] == slice_no
+
+    # Tapping the key label two slices clockwise makes it the key
+    key = helm_globals.key.current_key
+    touch(*[wheel_point(150, wheel.radii['key_labels'])] * 2)
+    assert helm_globals.key.current_key == (key + 2) % 12
+
+    # Tapping a slice inside turns the pointer to its chord
+    touch(*[wheel_point(120, wheel.radii['pointer'])] * 2)
+    state = helm_globals.key.state
+    assert (state.current_chord_root - state.current_key) % 12 == 1
+
+    # Dragging a quarter turn clockwise round the key ring is 9 detents
+    target = wheel.rotate_target
+    events = touch(*[wheel_point(degrees, wheel.radii['key_labels'])
+                     for degrees in list(range(90, 181, 15)) + [182]])
+    assert {event.kind for event in events} == {ROTATE}
+    assert sum(event.steps for event in events) == 9
+    assert wheel.rotate_target == target + 90
+
+    # Holding a chord row plays it until let go
+    x, y = chords.lines[2][1].coordinates_boxes[5][:2]
+    events = EventBuffer()
+    helm_test_instance.handle_event(pygame.event.Event(
+        pygame.MOUSEBUTTONDOWN, button=1,
+        pos=(chords.blit_x + x + 1, chords.blit_y + y + 1)), events)
+    helm_test_instance.update(events)
+    assert events.records[0].chord == chords.lines[2][0]
+    assert helm_globals.key.notes_on
+    events.clear()
+    helm_test_instance.handle_event(pygame.event.Event(
+        pygame.MOUSEBUTTONUP, button=1, pos=(0, 0)), events)
+    helm_test_instance.update(events)
+    assert not helm_globals.key.notes_on
+
+
+def test_async_runtime_sleeps_once_settled():
+    helm_test_instance = Helm(init_gfx=False)
+    runtime = AsyncRuntime(helm_test_instance,
+                           FrameScheduler(helm_test_instance.controlSurfaces))
+    wheel = helm_test_instance.controlSurfaces[0]
+    # Start with the rings at rest
+    wheel.rotate_offset = wheel.rotate_target
+    wheel.rotate_offset_chord = target = wheel.rotate_target_chord
+    pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_PERIOD))
+    pygame.time.set_timer(pygame.QUIT, 1000, 1)
+    helm_test_instance.running = True
+    runtime.run()
+    assert wheel.rotate_target_chord != target
+    assert wheel.rotate_offset_chord == wheel.rotate_target_chord
+    # The first frame, the turn's animation, then nothing until the quit,
+    # and headless, only a few looks for pygame events
+    assert runtime.frames_run < 10
+    assert runtime.pygame_wakeups < 10
+
+    # Where SDL can sleep until an event, pygame.event.wait() does
+    helm_async.waiting_drivers.add('dummy')
+    try:
+        runtime = AsyncRuntime(helm_test_instance, FrameScheduler(
+            helm_test_instance.controlSurfaces))
+        pygame.event.post(pygame.event.Event(pygame.KEYDOWN,
+                                             key=pygame.K_COMMA))
+        pygame.time.set_timer(pygame.QUIT, 300, 1)
+        helm_test_instance.running = True
+        runtime.run()
+    finally:
+        helm_async.waiting_drivers.discard('dummy')
+    assert wheel.rotate_target_chord == target
+    assert runtime.pygame_wakeups == 2
+
+
+def test_frame_pacer_idles_until_input():
+    helm_test_instance = Helm(init_gfx=False)
+    wheel = helm_test_instance.controlSurfaces[0]
+    wheel.rotate_offset = wheel.rotate_target
+    wheel.rotate_offset_chord = wheel.rotate_target_chord
+    pacer = FramePacer(pygame.time.Clock(), max_fps=60, idle_fps=5,
+                       linger=0)
+    # An event ends an idle wait straight away, and is handed back
+    key = pygame.event.Event(pygame.KEYDOWN, key=pygame.K_PERIOD)
+    pygame.event.post(key)
+    started = time.perf_counter()
+    assert pacer.pace(False).key == pygame.K_PERIOD
+    assert time.perf_counter() - started < 0.1
+
+    # Half a second of the main loop turns the chord ring once, animates
+    # and settles, then idles at 5 fps rather than looping 30 times
+    pygame.event.post(key)
+    pygame.time.set_timer(pygame.QUIT, 500, 1)
+    helm_test_instance.running = True
+    helm_test_instance.run_loop(FrameScheduler(
+        helm_test_instance.controlSurfaces), pacer=pacer)
+    assert wheel.rotate_offset_chord == wheel.rotate_target_chord
+    assert pacer.loops[True] > 0
+    assert pacer.loops[False] <= 6
+    assert pacer.wakeups_saved() > 10
+    assert "wakeups saved" in pacer.summary()
+
+
+class FakePowermate(object):
+    # Stands in for a pypowermate.Powermate, turned once after a moment
+    def __init__(self):
+        self.events = [(0.0, powermate_rotate, 1)]
+
+    def read_event(self, timeout=None):
+        time.sleep(0.05)
+        if self.events:
+            return self.events.pop()
+        return None
+
+
+def test_input_on_other_threads_wakes_an_idle_loop():
+    Helm(init_gfx=False)
+    pygame.event.clear()
+    pacer = FramePacer(pygame.time.Clock(), max_fps=60, idle_fps=1,
+                       linger=0)
+    # A MIDI control on mido's thread ends an idle wait straight away
+    midi = Midi()
+    midi.controls_queued = True  # As with midi_input_callback
+    midi.notify = wake
+    sender = threading.Timer(0.05, midi.control_received,
+                             (mido.Message('note_on', note=36), ))
+    sender.start()
+    started = time.perf_counter()
+    assert pacer.pace(False).type == wake_event
+    assert time.perf_counter() - started < 0.5
+    events = EventBuffer()
+    midi.poll_controls(events)
+    assert [event.kind for event in events] == [TRIGGER]
+
+    # And so does the Powermate, read on its own thread
+    reader = PowermateReader(FakePowermate(), wake)
+    reader.start()
+    started = time.perf_counter()
+    assert pacer.pace(False).type == wake_event
+    assert time.perf_counter() - started < 0.5
+    reader.stop()
+    events.clear()
+    reader.drain(events)
+    assert [(event.kind, event.direction) for event in events] == \
+        [(ROTATE, 1)]
+
+    # Polled controls can't wake it, so it never idles
+    polled = FramePacer(pygame.time.Clock(), max_fps=60, idle_fps=1,
+                        linger=0, polling=True)
+    assert polled.busy(False)
+
+
+def test_controls_built_by_name_see_only_their_events():
+    layout = helm_layout.layout_for(1920, 1080)
+    register_control('probe', lambda layout: ProbeControl(layout=layout))
+    register_control('absent', 'helm_no_such_module:absent_control')
+    try:
+        # A control which is off is never imported
+        wheel, chord, probe = build_controls(layout,
+                                             ('wheel', 'chord', 'probe'))
+        try:
+            build_controls(layout, ('absent', ))
+            assert False
+        except ImportError:
+            pass
+        try:
+            build_controls(layout, ('nothing', ))
+            assert False
+        except ValueError:
+            pass
+        # Every control has its bit in the render process's frame requests
+        try:
+            build_controls(layout, ('probe', ) * 17)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        del control_factories['probe']
+        del control_factories['absent']
+
+    router = EventRouter([wheel, chord, probe])
+    events = rotation('key', 1)
+    events.add(RECALL)
+    chord_event(events, 'a', start=True)
+    wheel_inbox, chord_inbox, probe_inbox = router.route(events)
+    assert [event.kind for event in wheel_inbox] == [ROTATE, RECALL,
+                                                     TRIGGER]
+    assert chord_inbox == []
+    probe.update_control(probe_inbox)
+    assert probe.handed == [RECALL]
+    # Each route starts the inboxes afresh
+    assert router.route(EventBuffer()) == [[], [], []]
+
+
+def test_powermate_fast_spin_turns_several_detents():
+    events = EventBuffer()
+    powermate_event(events, (0.0, powermate_rotate, 3))
+    turns = {(event.direction, event.steps) for event in events}
+    assert turns == {(1, 3)}
+    events.clear()
+    powermate_event(events, (0.0, powermate_rotate, -2))
+    turns = {(event.direction, event.steps) for event in events}
+    assert turns == {(-1, 2)}
+    events.clear()
+    # Pressing the knob isn't a turn
+    powermate_event(events, (0.0, 0x01, 1))
+    assert not events
+
+
+def test_chord_rotation_many_steps_at_once():
+    helm_test_instance = Helm(init_gfx=False)
+    wheel = helm_test_instance.controlSurfaces[0]
+    start = helm_globals.key.state
+
+    # One step at a time, letting the animation finish each time
+    stepped = []
+    for direction in (1,) * 25 + (-1,) * 9:
+        wheel.update_control(rotation('chord', direction))
+        while wheel.rotate_offset_chord != wheel.rotate_target_chord:
+            wheel.update_control(EventBuffer())
+        stepped.append((helm_globals.key.current_key_mode,
+                        helm_globals.key.current_chord_root,
+                        wheel.rotate_offset_chord))
+
+    # The same turns as two fast spins, without waiting for animation
+    helm_globals.key.state = start
+    wheel.rotate_target_chord = wheel.rotate_offset_chord = 0
+    wheel.update_control(rotation('chord', 1, 25))
+    wheel.update_control(rotation('chord', -1, 9))
+    assert (helm_globals.key.current_key_mode,
+            helm_globals.key.current_chord_root,
+            wheel.rotate_target_chord) == stepped[-1]
+
+    # A whole turn of the mode ring is 21 detents and one 150 degree jump
+    assert stepped[20][2] == 360
+    assert stepped[20][:2] == (start.current_key_mode,
+                               start.current_chord_root)
+
+
+def test_soak_finds_no_stuck_notes_or_desyncs():
+    helm_test_instance = Helm(init_gfx=False)
+    for seed in range(3):
+        assert soak(helm_test_instance, loops=2000, seed=seed,
+                    report=None) == []
+    assert not helm_globals.using_midi
+
+
+def test_preset_recall_jumps_in_one_transition():
+    import configparser
+    config = configparser.ConfigParser()
+    config.read_string("[preset verse]\nkey = F#\nmode = Dorian\n"
+                       "octave = 3\nlatched = 1, 3, 5\n"
+                       "[preset chorus]\nkey = 1\nmode = lydian\n")
+    verse, chorus = presets_from_config(config)
+    assert (verse.key, verse.mode, verse.chord_root) == (6, 2, 8)
+    assert (chorus.key, chorus.mode, chorus.chord_root) == (1, 6, 0)
+
+    helm_test_instance = Helm(init_gfx=False)
+    helm_globals.presets = [verse, chorus, Preset('home')]
+    runner = Soak(helm_test_instance)
+    octave = helm_globals.midi.octave
+    try:
+        for number, preset in ((0, verse), (1, chorus), (0, verse),
+                               (2, Preset('home'))):
+            events = EventBuffer()
+            recall_event(events, number)
+            recall_event(events, 99)  # No such preset
+            helm_test_instance.update(events)
+            state = helm_globals.key.state
+            assert (state.current_key, state.current_key_mode,
+                    state.current_chord_root) == \
+                (preset.key, preset.mode, preset.chord_root)
+            # Once the animation is done the rings agree, and nothing
+            # hangs or doubles up
+            wheel = runner.wheel
+            while wheel.rotate_offset != wheel.rotate_target or \
+                    wheel.rotate_offset_chord != wheel.rotate_target_chord:
+                helm_test_instance.update(EventBuffer())
+            assert runner.check() == []
+            if preset.latched:
+                assert runner.sink.sounding == set(
+                    helm_globals.midi.chord_midi_notes(preset.latched))
+                assert helm_globals.midi.octave == 3
+            else:
+                assert not runner.sink.sounding
+    finally:
+        runner.close()
+        helm_globals.presets = []
+        helm_globals.midi.octave = octave
+
+
+def test_rawmidi_output_writes_the_bytes_mido_would(tmp_path):
+    device = tmp_path / "midiC1D0"
+    device.write_bytes(b"")
+    output = RawMidiOutput(str(device))
+    output.send_note('note_on', 3, 60, 100)
+    output.send_note('note_off', 3, 60, 0)
+    output.send(mido.Message('clock'))
+    output.close()
+    assert device.read_bytes() == bytes(
+        mido.Message('note_on', channel=3, note=60, velocity=100).bytes() +
+        mido.Message('note_off', channel=3, note=60, velocity=0).bytes() +
+        mido.Message('clock').bytes())
+
+
+def test_rawmidi_without_a_device_falls_back_to_mido(monkeypatch):
+    monkeypatch.setattr(mido, 'open_output',
+                        lambda name, autoreset: helm_bench.NullPort())
+    output = open_output("helm", backend="rawmidi", device=None)
+    assert isinstance(output, MidoOutput)
+
+
+def test_benchmarks_run_and_check_against_baselines():
+    helm_test_instance = Helm(init_gfx=False)
+    state = helm_globals.key.state
+    results = helm_bench.run_benchmarks(helm_test_instance,
+                                        min_seconds=0.001, repeat=1)
+    assert helm_globals.key.state is state
+    assert all(seconds > 0 for seconds in results.values())
+    # Every stored baseline is still being measured
+    baselines = helm_bench.load_baselines()
+    assert set(baselines) - {'midi_output rtmidi'} <= set(results)
+    assert helm_bench.regressions(
+        {'a': 1.4, 'b': 1.6, 'new': 9.0}, {'a': 1.0, 'b': 1.0},
+        threshold=0.5) == {'b': (1.6, 1.0)}
+
+
+def test_clock_forwarded_while_controls_arrive_on_callbacks():
+    # midi_input_callback only puts the controller inport on a callback,
+    # so the clock port is still polled
+    helm_globals.midi_input_callback = True
+    try:
+        midi = Midi()
+    finally:
+        helm_globals.midi_input_callback = False
+    midi.inport_clock = PendingInput([mido.Message('clock')] * 3)
+    midi.outport = VirtualSink()
+    midi.forward_messages()
+    assert midi.outport.messages == 3
+    assert midi.inport_clock.messages == []
+
+
+def test_arpeggiator_steps_on_clock_ticks():
+    arpeggiator = Arpeggiator(division=16, pattern="up", gate=0.5)
+    arpeggiator.hold('a', (67, 60, 64))
+    played = []
+    for tick in range(20):
+        notes_on, notes_off = arpeggiator.tick()
+        if notes_on:
+            played.append((tick, notes_on[0]))
+        if tick == 3:
+            # Gate is half of a six tick step
+            assert notes_off == [60]
+    assert played == [(0, 60), (6, 64), (12, 67), (18, 60)]
+    # Letting go mid-step still ends the sounding note
+    arpeggiator.release('a')
+    assert arpeggiator.tick() == ([], [])
+    assert arpeggiator.tick() == ([], [60])
+    assert arpeggiator.tick() == ([], [])
+
+
+def test_scheduled_notes_land_on_the_clock_grid():
+    # 120 bpm is a tick every 1/48 s, so sixteenths are 6 ticks apart
+    grid = ClockGrid(tempo=120, now=0.0)
+    assert math.isclose(grid.step_time(0.01, 6), 6 / 48)
+    # An external clock takes over from its start, wherever that falls
+    grid.start()
+    grid.tick(now=10.0)
+    for tick in range(1, 4):
+        grid.tick(now=10.0 + tick / 50)
+    assert math.isclose(grid.step_time(10.07, 6), 10.12)
+    assert 124 < grid.tempo < 126
+
+    # Sent a latency early, in time order, simultaneous notes in the order
+    # they were scheduled.  On a clock stopped at 1 s, everything before
+    # is due, and goes out as late as it was due early.
+    sent = []
+    scheduler = NoteScheduler(lambda output, *note: sent.append(note),
+                              clock=lambda: 1.0)
+    scheduler.latency['synth'] = 0.01
+    with scheduler.ready:
+        # Held until all three are queued
+        scheduler.schedule(0.5, 'synth', 'note_off', 60, 0)
+        scheduler.schedule(0.5, 'synth', 'note_on', 64, 100)
+        scheduler.schedule(0.48, 'synth', 'note_on', 60, 100)
+        assert [entry[0] for entry in sorted(scheduler.queue)] == \
+            [0.47, 0.49, 0.49]
+    scheduler.stop()
+    assert sent == [('note_on', 60, 100), ('note_off', 60, 0),
+                    ('note_on', 64, 100)]
+    assert scheduler.dispatched == 3
+    assert math.isclose(scheduler.error_max, 0.53)
+
+    # Sending is only ever done by the scheduler's own thread, which
+    # starts with the first note
+    scheduler = NoteScheduler(lambda *note: None)
+    scheduler.schedule(time.perf_counter(), 'synth', 'note_on', 60, 100)
+    assert scheduler.is_alive()
+    scheduler.stop()
+    assert scheduler.dispatched == 1
+    try:
+        scheduler.schedule(time.perf_counter(), 'synth', 'note_off', 60, 0)
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_arpeggiator_latch_replaced_by_the_next_chord():
+    helm_globals.using_arpeggiator = True
+    try:
+        midi = Midi()
+    finally:
+        helm_globals.using_arpeggiator = False
+    midi.midi_notes_trigger("on", (48, 52, 55), 'a')
+    midi.latch()
+    midi.midi_notes_trigger("off", (), 'a')
+    assert midi.arpeggiator.chord == (48, 52, 55)
+    # The next chord plays on its own, and letting go of it leaves nothing
+    midi.midi_notes_trigger("on", (50, 53, 57), 's')
+    assert midi.arpeggiator.chord == (50, 53, 57)
+    midi.midi_notes_trigger("off", (), 's')
+    assert midi.arpeggiator.held == {}
+    assert midi.arpeggiator.chord == ()
+
+
+def test_bad_config_values_fall_back_to_the_defaults(tmp_path):
+    configfile = tmp_path / "helm.cfg"
+    configfile.write_text("[helm]\nvoicing = stacked\n")
+    Helm(init_gfx=False, configfile=str(configfile))
+    assert helm_globals.voicing == "octave"
+    assert helm_globals.midi.voicing_index == \
+        helm_globals.voicings.index("octave")
+    # An arpeggiator division of nothing is the default too
+    configfile.write_text("[helm]\narpeggiator = True\narp_division = 0\n")
+    try:
+        Helm(init_gfx=False, configfile=str(configfile))
+        assert helm_globals.arp_division == 16
+        assert helm_globals.midi.arpeggiator.ticks_per_step == 6
+    finally:
+        helm_globals.using_arpeggiator = False
+
+
+def test_theory_tables_voicings():
+    theory = helm_globals.TheoryTables()
+    state = helm_globals.HelmState()  # C Ionian
+    seventh = theory.chord_index['1, 3, 5, 7']
+    # The original sound, every note in one octave from C
+    assert list(theory.lookup(0, 0, seventh,
+                              theory.voicing_index['octave'])) == \
+        [0, 4, 7, 11]
+    assert list(theory.lookup(0, 0, seventh,
+                              theory.voicing_index['inv1'])) == \
+        [4, 7, 11, 12]
+    # Two fifths round from C is D Dorian: a ninth stacked up from D
+    ninth = theory.chord_index['1, 3, 5, 7, 9']
+    assert list(theory.lookup(0, 2, ninth,
+                              theory.voicing_index['close'])) == \
+        [2, 5, 9, 12, 16]
+    # Table lookups agree with working it out on the spot
+    for voicing in helm_globals.voicings:
+        assert list(theory.lookup(0, 0, seventh,
+                                  theory.voicing_index[voicing])) == \
+            theory.voice_chord(state, (1, 3, 5, 7), voicing)
+
+
+def test_layout_per_resolution(tmp_path):
+    layout = helm_layout.Layout(1920, 1080)
+    # The original hand tuned 1920x1080 layout
+    assert layout.wheel_size == 1058
+    assert layout.chord_blit_x == 1100
+    assert layout.chord_size == 768
+    assert layout.wheel_radii['mode_labels'] == 529 - 365
+    # A small touch panel still fits the chord control beside the wheel
+    small = helm_layout.Layout(800, 480)
+    assert small.chord_blit_x > small.wheel_size
+    assert small.chord_blit_x + small.chord_size <= 800
+    # Saved layouts load back unchanged
+    cache_file = str(tmp_path / "layout.json")
+    small.save(cache_file)
+    helm_layout.layouts.clear()
+    loaded = helm_layout.layout_for(800, 480, cache_file=cache_file)
+    assert loaded.to_dict() == small.to_dict()
+    assert helm_layout.layout_for(800, 480) is loaded
+    # A corrupt cache is recomputed and saved over, an unwritable one
+    # only recomputed
+    with open(cache_file, "w") as layout_file:
+        layout_file.write("{bad")
+    helm_layout.layouts.clear()
+    assert helm_layout.layout_for(
+        800, 480, cache_file=cache_file).to_dict() == small.to_dict()
+    helm_layout.layouts.clear()
+    assert helm_layout.layout_for(800, 480, cache_file=cache_file) \
+        .to_dict() == small.to_dict()
+    helm_layout.layouts.clear()
+    helm_layout.layout_for(800, 480, cache_file=str(tmp_path))
+
+
+def test_headless_frame_capture(tmp_path):
+    helm_test_instance = Helm(init_gfx=False)
+    canvas = helm_test_instance.canvas
+    capture_path = str(tmp_path / "frames")
+    capture = FrameCapture(canvas.get_width(), canvas.get_height(),
+                           path=capture_path, slots=2, fps=5)
+    reader = FrameReader(capture_path)
+    assert reader.latest() is None
+
+    canvas.fill(helm_globals.color_orange)
+    assert capture.capture(canvas, now=0)
+    # Throttled to 5 fps
+    assert not capture.capture(canvas, now=0.1)
+    # Written on the capture's own thread
+    capture.wait()
+    seq, timestamp, data = reader.latest()
+    assert seq == 1
+    # ... but the frame skipped is captured once it's due
+    assert not capture.flush(canvas, now=0.15)
+    assert capture.flush(canvas, now=0.2)
+    assert not capture.flush(canvas, now=0.5)
+    capture.wait()
+    seq, timestamp, data = reader.latest()
+    assert seq == 2
+    assert reader.latest_surface().get_at((0, 0))[:3] == \
+        helm_globals.color_orange
+    reader.close()
+    capture.close()
+
+
+def test_state_shared_with_other_processes(tmp_path):
+    path = str(tmp_path / "helm_state")
+    publisher = StatePublisher(path)
+    reader = StateReader(path)
+    assert reader.read() is None
+
+    state = helm_globals.HelmState(current_key=2, current_key_mode=3,
+                                   current_chord_root=4,
+                                   rotate_offset=-60).set_notes_on((2, 5))
+    publisher.publish(state)
+    seq, shared = reader.read()
+    assert seq == 2
+    assert (shared['current_key'], shared['current_key_mode'],
+            shared['current_chord_root']) == (2, 3, 4)
+    assert shared['notes_on'] == frozenset((2, 5))
+    assert shared['diatonic'] == frozenset(state.diatonic)
+    assert shared['rotate_offset'] == -60
+    assert shared['rotation_ring'] == "mode"
+
+    publisher.publish(state.set_notes_latched(True))
+    assert reader.seq() == 4
+    assert reader.read()[1]['notes_latched']
+    reader.close()
+    publisher.close()
+
+
+def test_performance_mode_collects_only_when_idle():
+    helm_realtime.freeze_gc()
+    try:
+        assert not gc.isenabled()
+        collector = helm_realtime.IdleCollector()
+        # Some cyclic garbage, more than one collection's worth
+        for _ in range(collector.thresholds[0] + 1):
+            cycle = []
+            cycle.append(cycle)
+        assert collector.update(idle=False) is None
+        assert collector.update(idle=True) is not None
+        assert gc.get_count()[0] < collector.thresholds[0]
+        # Busy for too long: collected anyway
+        for _ in range(collector.limit + 100):
+            cycle = []
+            cycle.append(cycle)
+        assert collector.update(idle=False) is not None
+    finally:
+        helm_realtime.thaw_gc()
+    assert gc.isenabled()
+    assert helm_realtime.parse_cpus("2, 3") == {2, 3}
+
+
+def test_metrics_exposition_over_unix_socket(tmp_path):
+    import socket
+    helm_metrics.notes_fired.inc(3)
+    socket_path = str(tmp_path / "metrics.sock")
+    server = helm_metrics.MetricsServer(socket_path=socket_path)
+    server.start()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+    response = b""
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        response += data
+    client.close()
+    server.stop()
+    assert response.startswith(b"HTTP/1.0 200")
+    assert "# TYPE helm_notes_fired_total counter\n" \
+           "helm_notes_fired_total {}".format(
+               helm_metrics.notes_fired.value).encode() in response
+    assert b'helm_frame_seconds_bucket{le="+Inf"}' in response